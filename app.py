@@ -63,34 +63,49 @@ import re
 import random
 import uuid
 import hashlib
+import base64
 import unicodedata
 import traceback
 import threading
 import atexit
 import glob
+import sqlite3
+import zlib
+import heapq
+import math
+import array as _array
 import concurrent.futures as _cf  # ← これも先頭の import ブロックに追加
 from html import escape
+from types import SimpleNamespace
 from datetime import datetime, timedelta, timezone
 from urllib.parse import quote_plus, urljoin, urlparse
 from functools import wraps, lru_cache
+from itertools import islice
 from threading import Lock, RLock
-from concurrent.futures import ThreadPoolExecutor
-from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
+from collections import OrderedDict, defaultdict, deque, Counter
 from contextlib import contextmanager
 from dataclasses import dataclass, field
-from typing import Optional, Dict, List, Any, Tuple, Tuple, Tuple, Tuple, Tuple, Tuple
+from typing import Optional, Dict, List, Any, Tuple, Tuple, Tuple, Tuple, Tuple, Tuple, Iterator, Set
 
 # ===== サードパーティライブラリ =====
 from flask import Flask, request, jsonify, send_from_directory, Response
 from flask_cors import CORS
-from sqlalchemy import create_engine, Column, String, DateTime, Integer, Text, Boolean, Index, text
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy import create_engine, Column, String, DateTime, Integer, Text, Boolean, Index, text, or_, and_
+from sqlalchemy.orm import declarative_base, sessionmaker, aliased
 from sqlalchemy import pool
 from bs4 import BeautifulSoup
 import schedule
 import google.generativeai as genai
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 from groq import Groq
+# Gemini のコンテキストキャッシュ (静的プロンプトプレフィックスの使い回し) は新しめのSDKのみ
+try:
+    from google.generativeai import caching as genai_caching
+    HAS_GEMINI_CACHING = True
+except ImportError:
+    genai_caching = None
+    HAS_GEMINI_CACHING = False
 
 # ===== Memvid風RAGシステム (pgvector + Gemini Embedding) =====
 # Memvidの設計思想: テキストをチャンク分割→埋め込みベクトル化→高速検索
@@ -152,6 +167,8 @@ MIN_MESSAGES_FOR_ANALYSIS = 10
 SEARCH_TIMEOUT = 10
 VOICE_FILE_MAX_AGE_HOURS = 24
 _CHAT_TIMEOUT_SECONDS = 18  # ✨ これを追加！ (Add this line)
+# タイムアウト後も生成を続けて回復タスクとして保存する猶予 (開始から数えた上限)。過ぎたら打ち切る
+_CHAT_RECOVERY_SECONDS = 60
 
 # パーソナライズ設定
 FRIEND_THRESHOLD = 5
@@ -165,6 +182,13 @@ GEMINI_MODELS = [
     "gemini-3.1-flash-lite",  # フォールバック1
     "gemini-2.5-flash",       # フォールバック2
 ]
+# モデル別クォータ (rpm: 1分あたりリクエスト / tpm: 1分あたりトークン / rpd: 1日あたりリクエスト)
+# 送信前にこの枠から予算を確保し、枠が無ければ 429 を待たずに別モデルへ回す。
+GEMINI_MODEL_QUOTAS = {
+    "gemini-3.5-flash":      {'rpm': 10, 'tpm': 250000, 'rpd': 250},
+    "gemini-3.1-flash-lite": {'rpm': 15, 'tpm': 250000, 'rpd': 1000},
+    "gemini-2.5-flash":      {'rpm': 10, 'tpm': 250000, 'rpd': 250},
+}
 # ==========================================
 # Groqで使用するモデルの優先順位 (v33.8.2 更新)
 # 参考: https://console.groq.com/docs/models
@@ -198,6 +222,38 @@ GROQ_TASK_MODELS = {
                  'llama-4-maverick-17b-128e-instruct'],
     'default':  GROQ_MODELS,
 }
+GROQ_MODEL_QUOTAS = {
+    "llama-3.3-70b-versatile":            {'rpm': 30, 'tpm': 12000, 'rpd': 1000},
+    "llama-4-maverick-17b-128e-instruct": {'rpm': 30, 'tpm': 6000,  'rpd': 1000},
+    "compound-beta":                      {'rpm': 15, 'tpm': 70000, 'rpd': 200},
+    "llama-3.1-8b-instant":               {'rpm': 30, 'tpm': 6000,  'rpd': 14400},
+    "deepseek-r1-distill-llama-70b":      {'rpm': 30, 'tpm': 6000,  'rpd': 1000},
+}
+LLM_DEFAULT_QUOTA = {'rpm': 10, 'tpm': 6000, 'rpd': 500}
+# 優先度ごとに「確保した後も残しておく枠の割合」。
+# バックグラウンドタスクが会話用の枠まで使い切らないようにする。
+LLM_PRIORITY_RESERVE = {'interactive': 0.0, 'search': 0.15, 'deferred': 0.3, 'batch': 0.4}
+# Groq の task_type → 優先度 (それ以外は 'batch')
+LLM_TASK_PRIORITY = {'chat': 'interactive', 'search': 'search'}
+# ★ LLM呼び出しの優先度クラス (小さいほど優先)
+#   interactive - 会話の応答
+#   search      - ユーザーが頼んだ検索の要約
+#   deferred    - 会話に付随するユーザー単位の後処理 (心理分析・プロフィール・要約)
+#   batch       - 配信感想・まとめ等の一括処理
+LLM_PRIORITY_RANK = {'interactive': 0, 'search': 1, 'deferred': 2, 'batch': 3}
+# プロバイダごとの同時送信数
+LLM_PROVIDER_CONCURRENCY = {'gemini': 3, 'groq': 4}
+# 送信枠が空くまで待つ最大秒数 (超えたら LLMAdmissionDenied → 呼び出し側のフォールバックへ)
+LLM_PRIORITY_WAIT_SECONDS = {'interactive': 8, 'search': 20, 'deferred': 60, 'batch': 180}
+# ★ モデルの健全性 (EWMAレイテンシ・エラー率・サーキットブレーカー)
+LLM_EWMA_ALPHA = 0.3
+LLM_LATENCY_PRIOR_SECONDS = 4.0       # 実績の無いモデルの想定レイテンシ
+LLM_BREAKER_FAILURES = 3              # 連続失敗でオープン
+LLM_BREAKER_ERROR_RATE = 0.5          # EWMAエラー率がこれ以上でオープン
+LLM_BREAKER_MIN_SAMPLES = 5
+LLM_BREAKER_COOLDOWN_SECONDS = 60     # オープン後、試験送信 (ハーフオープン) までの秒数
+LLM_BREAKER_MAX_COOLDOWN_SECONDS = 600
+# LLM_QUOTA_OVERRIDES='{"gemini-2.5-flash": {"rpm": 5}}' のように環境変数で上書き可能
 
 USER_AGENTS = [
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
@@ -256,6 +312,18 @@ class GeminiModelStatus:
     current_model: str = "gemini-1.5-flash"
     last_error: Optional[str] = None
 
+@dataclass
+class LLMModelHealth:
+    ewma_latency: Optional[float] = None
+    error_rate: float = 0.0
+    samples: int = 0
+    consecutive_failures: int = 0
+    state: str = 'closed'              # closed / open / half_open
+    opened_at: float = 0.0
+    cooldown: float = LLM_BREAKER_COOLDOWN_SECONDS
+    probing: bool = False
+    last_error: Optional[str] = None
+
 @dataclass
 class UserData:
     uuid: str
@@ -313,7 +381,13 @@ class GeminiModelManager:
                 logger.info(f"🔄 Geminiモデル切り替え: {self._status.current_model}")
             
             model_name = self._models[self._current_index]
-            
+            if self.get_instance(model_name) is None:
+                return None
+            # 送信時に予算を確保するプロキシを返す (枠が無ければ別モデルへ回る)
+            return GeminiQuotaProxy(self, model_name)
+    
+    def get_instance(self, model_name: str) -> Optional[Any]:
+        with self._lock:
             if model_name not in self._gemini_instances:
                 try:
                     self._gemini_instances[model_name] = genai.GenerativeModel(model_name)
@@ -321,9 +395,12 @@ class GeminiModelManager:
                 except Exception as e:
                     logger.error(f"❌ Gemini初期化失敗 ({model_name}): {e}")
                     return None
-            
             return self._gemini_instances[model_name]
     
+    def candidate_names(self, first: str) -> List[str]:
+        """first を先頭に、残りを GEMINI_MODELS の順で並べる"""
+        return [first] + [m for m in self._models if m != first]
+    
     def mark_limited(self, wait_seconds: int = 60):
         with self._lock:
             self._status.is_limited = True
@@ -372,19 +449,882 @@ class GroqModelManager:
                     lines.append(f"  ✅ {model}: OK")
             return "\n".join(lines)
 
-    def get_available_models(self) -> List[str]:
-        with self._lock: return [m for m in self._models if self.is_available(m)]
+    def _usable(self, model: str, priority: str) -> bool:
+        return self.is_available(model) and llm_quota.has_budget('groq', model, priority)
+
+    def get_available_models(self, priority: str = 'batch') -> List[str]:
+        with self._lock:
+            return llm_health.rank('groq', [m for m in self._models if self._usable(m, priority)])
 
-    def get_models_for_task(self, task_type: str = 'default') -> List[str]:
-        """用途別に最適なモデルリストを返す (利用可能なもののみ)"""
+    def get_models_for_task(self, task_type: str = 'default', priority: Optional[str] = None) -> List[str]:
+        """
+        用途別の候補のうち、利用可能・予算あり・ブレーカーが閉じているものを
+        想定レイテンシの短い順に返す (実績が無い間は GROQ_TASK_MODELS の順)
+        """
         candidates = GROQ_TASK_MODELS.get(task_type, GROQ_TASK_MODELS['default'])
+        priority = priority or LLM_TASK_PRIORITY.get(task_type, 'batch')
         with self._lock:
-            available = [m for m in candidates if self.is_available(m)]
+            available = llm_health.rank('groq', [m for m in candidates if self._usable(m, priority)])
             if not available:
                 # 全滅した場合は全利用可能モデルにフォールバック
-                available = [m for m in self._models if self.is_available(m)]
+                available = llm_health.rank('groq', [m for m in self._models if self._usable(m, priority)])
             return available
 
+# ==============================================================================
+# ★ 協調キャンセル (期限付きの生成処理)
+# ==============================================================================
+# 生成スレッドに CancellationToken を持たせ、コンテキスト取得の区切り・LLM送信の前で確認する。
+# HTTP / LLM のタイムアウトは残り時間から決めるので、期限を過ぎた通信が worker を握り続けない。
+class GenerationCancelled(BaseException):
+    """
+    期限切れ・キャンセルで生成を打ち切る。
+    途中の `except Exception` (コンテキスト注入やLLMフォールバック) に握りつぶされず
+    生成の入口まで抜けるよう BaseException を継承する。
+    """
+
+
+class CancellationToken:
+    def __init__(self, deadline_seconds: float):
+        self.deadline = time.monotonic() + deadline_seconds
+        self._cancelled = False
+        self.reason = ''
+
+    def cancel(self, reason: str = 'cancelled'):
+        self._cancelled = True
+        self.reason = self.reason or reason
+
+    @property
+    def cancelled(self) -> bool:
+        if not self._cancelled and time.monotonic() >= self.deadline:
+            self.cancel('deadline')
+        return self._cancelled
+
+    def remaining(self) -> float:
+        return max(0.0, self.deadline - time.monotonic())
+
+    def check(self, stage: str):
+        """区切りごとに呼ぶ。キャンセル済みなら GenerationCancelled"""
+        if self.cancelled:
+            raise GenerationCancelled(stage)
+
+
+_cancel_local = threading.local()
+
+
+def current_cancel_token() -> Optional[CancellationToken]:
+    return getattr(_cancel_local, 'token', None)
+
+
+@contextmanager
+def cancel_scope(token: Optional[CancellationToken]):
+    """このスレッドで実行する処理に token を持たせる"""
+    prev = current_cancel_token()
+    _cancel_local.token = token
+    try:
+        yield token
+    finally:
+        _cancel_local.token = prev
+
+
+def cancel_checkpoint(stage: str):
+    token = current_cancel_token()
+    if token is not None:
+        token.check(stage)
+
+
+def deadline_timeout(default: float, floor: float = 1.0) -> float:
+    """通信タイムアウト: トークンがあれば残り時間で頭打ちにする"""
+    token = current_cancel_token()
+    if token is None:
+        return default
+    return max(floor, min(default, token.remaining()))
+
+
+class WorkAccounting:
+    """タイムアウトした生成の行方 (回復 / 打ち切り / 失敗) を数える"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counts: Counter = Counter()
+        self._abandoned_stages: Counter = Counter()
+
+    def note(self, event: str, stage: Optional[str] = None):
+        with self._lock:
+            self._counts[event] += 1
+            if stage:
+                self._abandoned_stages[stage] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**dict(self._counts), 'abandoned_stages': dict(self._abandoned_stages)}
+
+
+generation_accounting = WorkAccounting()
+
+
+# ==============================================================================
+# ★ シングルフライト (同一の外部問い合わせを同時実行させない)
+# ==============================================================================
+# 複数のアバターが同じ新作アニメ・同じホロメン・同じ地域の天気を同時に聞くと、
+# キャッシュミスした全員が同じ上流リクエストを並列に投げていた。
+# (関数名, 正規化した引数) をキーに実行中の Future を共有し、後から来た呼び出しは
+# 先行の結果 (または例外) をそのまま受け取る。完了したらキーは消える (結果は保持しない)。
+class SingleFlightGroup:
+    def __init__(self):
+        self._lock = Lock()
+        self._calls: Dict[Tuple, Future] = {}
+        self._stats: Dict[str, Counter] = defaultdict(Counter)
+
+    def do(self, key: Tuple, fn, *args, **kwargs):
+        name = key[0]
+        while True:
+            with self._lock:
+                future = self._calls.get(key)
+                leader = future is None
+                if leader:
+                    future = self._calls[key] = Future()
+                self._stats[name]['leader' if leader else 'shared'] += 1
+
+            if leader:
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                    raise
+                else:
+                    future.set_result(result)
+                    return result
+                finally:
+                    with self._lock:
+                        self._calls.pop(key, None)
+
+            try:
+                return self._wait(future)
+            except GenerationCancelled:
+                # 先行が自分の期限で打ち切られただけなら、こちらで改めて実行する
+                cancel_checkpoint(f'single_flight:{name}')
+                continue
+
+    @staticmethod
+    def _wait(future: Future):
+        token = current_cancel_token()
+        if token is None:
+            return future.result()
+        while True:
+            token.check('single_flight_wait')
+            try:
+                return future.result(timeout=max(0.05, min(1.0, token.remaining())))
+            except FutureTimeoutError:
+                continue
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                'in_flight': len(self._calls),
+                'functions': {name: dict(c) for name, c in self._stats.items()},
+            }
+
+
+single_flight_group = SingleFlightGroup()
+
+
+def _single_flight_norm(value, normalize: bool):
+    """キー用に引数を hashable にそろえる (normalize なら文字列を NFKC・小文字・前後空白除去)"""
+    if isinstance(value, str):
+        return unicodedata.normalize('NFKC', value).strip().lower() if normalize else value
+    if isinstance(value, (list, tuple)):
+        return tuple(_single_flight_norm(v, normalize) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _single_flight_norm(v, normalize)) for k, v in value.items()))
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return repr(value)
+
+
+def single_flight(normalize: bool = True):
+    """同じ引数で同時に呼ばれたら1回だけ実行して結果を共有するデコレータ"""
+    def decorator(fn):
+        name = fn.__name__
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            key = (name, _single_flight_norm(args, normalize), _single_flight_norm(kwargs, normalize))
+            return single_flight_group.do(key, fn, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# ==============================================================================
+# ★ LLM使用量アカウンティング (機能別・ユーザー別)
+# ==============================================================================
+# すべての LLM 呼び出し (GeminiQuotaProxy / QuotaGuardedGroq) で入力・出力トークン、
+# レイテンシ、モデルを記録し、llm_usage_scope で付けた (機能, user_uuid) タグごとに
+# 1時間バケットでメモリ集計する。定期タスクで llm_usage_rollups テーブルへ加算 upsert し、
+# /admin/llm_usage で重い利用者・機能を確認する。
+# タグはスレッドローカルなので、別スレッドに投げる処理は llm_usage_tagged で包む。
+LLM_USAGE_BUCKET_SECONDS = 3600   # 1日 (86400秒) を割り切れる値にする (UTC 0時起点で区切る)
+LLM_USAGE_DEFAULT_HOURS = 24
+
+_usage_local = threading.local()
+
+
+def current_llm_usage_tags() -> Tuple[Optional[str], Optional[str]]:
+    return getattr(_usage_local, 'tags', (None, None))
+
+
+@contextmanager
+def llm_usage_scope(feature: str, user_uuid: Optional[str] = None):
+    """このスレッドの LLM 呼び出しに (機能, user_uuid) を付ける。user_uuid 省略時は外側を引き継ぐ"""
+    prev = current_llm_usage_tags()
+    _usage_local.tags = (feature, user_uuid if user_uuid is not None else prev[1])
+    try:
+        yield
+    finally:
+        _usage_local.tags = prev
+
+
+def llm_usage_tagged(fn, feature: str, user_uuid: Optional[str] = None):
+    """executor に渡す関数をタグ付きで実行するラッパーを返す"""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        with llm_usage_scope(feature, user_uuid):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+class LLMUsageAccounting:
+    _FIELDS = ('calls', 'errors', 'input_tokens', 'output_tokens', 'cached_tokens', 'latency_ms_sum')
+
+    def __init__(self):
+        self._lock = Lock()
+        # (bucket_start, feature, user_uuid, provider, model) -> 集計値
+        self._pending: Dict[Tuple, Dict[str, int]] = {}
+        self._flushed_rows = 0
+        self._last_flush: Optional[datetime] = None
+
+    def record(self, provider: str, model: str, priority: str, latency: float, ok: bool,
+               input_tokens: Optional[int] = None, output_tokens: Optional[int] = None,
+               cached_tokens: Optional[int] = None):
+        feature, user_uuid = current_llm_usage_tags()
+        feature = feature or f"untagged:{priority}"
+        now = datetime.utcnow()
+        # naive UTC なので timestamp() (ローカル時刻扱い) は使わず、日内の経過秒で切り捨てる
+        day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        elapsed = now.hour * 3600 + now.minute * 60 + now.second
+        bucket = day + timedelta(seconds=elapsed - elapsed % LLM_USAGE_BUCKET_SECONDS)
+        key = (bucket, feature, user_uuid or '', provider, model)
+        latency_ms = int(latency * 1000)
+        with self._lock:
+            agg = self._pending.get(key)
+            if agg is None:
+                agg = self._pending[key] = {f: 0 for f in self._FIELDS}
+                agg['latency_ms_max'] = 0
+            agg['calls'] += 1
+            agg['errors'] += 0 if ok else 1
+            agg['input_tokens'] += input_tokens or 0
+            agg['output_tokens'] += output_tokens or 0
+            agg['cached_tokens'] += cached_tokens or 0
+            agg['latency_ms_sum'] += latency_ms
+            agg['latency_ms_max'] = max(agg['latency_ms_max'], latency_ms)
+
+    @staticmethod
+    def _rollup_key(key: Tuple) -> str:
+        bucket, feature, user_uuid, provider, model = key
+        raw = f"{bucket.isoformat()}|{feature}|{user_uuid}|{provider}|{model}"
+        return raw if len(raw) <= 255 else raw[:200] + '|' + hashlib.md5(raw.encode('utf-8')).hexdigest()
+
+    def flush(self) -> int:
+        """メモリの集計を llm_usage_rollups に加算する。失敗したら次回に持ち越す"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        rows = [
+            {'key': self._rollup_key(k), 'bucket': k[0], 'feature': k[1][:80], 'uuid': k[2],
+             'provider': k[3], 'model': k[4][:100], **agg}
+            for k, agg in pending.items()
+        ]
+        try:
+            with engine.connect() as conn:
+                with conn.begin():
+                    conn.execute(text(
+                        "INSERT INTO llm_usage_rollups (rollup_key, bucket_start, feature, user_uuid, provider, model,"
+                        " calls, errors, input_tokens, output_tokens, cached_tokens, latency_ms_sum, latency_ms_max)"
+                        " VALUES (:key, :bucket, :feature, :uuid, :provider, :model, :calls, :errors,"
+                        " :input_tokens, :output_tokens, :cached_tokens, :latency_ms_sum, :latency_ms_max)"
+                        " ON CONFLICT (rollup_key) DO UPDATE SET"
+                        "  calls = llm_usage_rollups.calls + excluded.calls,"
+                        "  errors = llm_usage_rollups.errors + excluded.errors,"
+                        "  input_tokens = llm_usage_rollups.input_tokens + excluded.input_tokens,"
+                        "  output_tokens = llm_usage_rollups.output_tokens + excluded.output_tokens,"
+                        "  cached_tokens = llm_usage_rollups.cached_tokens + excluded.cached_tokens,"
+                        "  latency_ms_sum = llm_usage_rollups.latency_ms_sum + excluded.latency_ms_sum,"
+                        "  latency_ms_max = CASE WHEN excluded.latency_ms_max > llm_usage_rollups.latency_ms_max"
+                        "                  THEN excluded.latency_ms_max ELSE llm_usage_rollups.latency_ms_max END"
+                    ), rows)
+        except Exception as e:
+            logger.error(f"LLM使用量の書き出しエラー (次回に持ち越し): {e}")
+            with self._lock:
+                for k, agg in pending.items():
+                    cur = self._pending.get(k)
+                    if cur is None:
+                        self._pending[k] = agg
+                        continue
+                    for f in self._FIELDS:
+                        cur[f] += agg[f]
+                    cur['latency_ms_max'] = max(cur['latency_ms_max'], agg['latency_ms_max'])
+            return 0
+        with self._lock:
+            self._flushed_rows += len(rows)
+            self._last_flush = datetime.utcnow()
+        logger.info(f"🧮 LLM使用量を集計テーブルへ書き出し: {len(rows)}行")
+        return len(rows)
+
+    def report(self, hours: float = LLM_USAGE_DEFAULT_HOURS, group_by: str = 'feature', limit: int = 50) -> List[Dict]:
+        """直近 hours 時間の使用量を group_by (feature / user / model / feature_user) ごとに多い順で返す"""
+        columns = {
+            'feature': ['feature'],
+            'user': ['user_uuid'],
+            'model': ['provider', 'model'],
+            'feature_user': ['feature', 'user_uuid'],
+        }.get(group_by)
+        if columns is None:
+            raise ValueError(f"group_by は feature / user / model / feature_user のいずれか: {group_by}")
+        self.flush()
+        cols = ', '.join(columns)
+        with engine.connect() as conn:
+            rows = conn.execute(text(
+                f"SELECT {cols}, SUM(calls), SUM(errors), SUM(input_tokens), SUM(output_tokens),"
+                f" SUM(cached_tokens), SUM(latency_ms_sum), MAX(latency_ms_max)"
+                f" FROM llm_usage_rollups WHERE bucket_start >= :since GROUP BY {cols}"
+                f" ORDER BY SUM(input_tokens) + SUM(output_tokens) DESC LIMIT :n"
+            ), {'since': datetime.utcnow() - timedelta(hours=hours), 'n': limit}).fetchall()
+        result = []
+        for r in rows:
+            entry = dict(zip(columns, r[:len(columns)]))
+            calls, errors, tin, tout, tcached, lat_sum, lat_max = (int(v or 0) for v in r[len(columns):])
+            entry.update({
+                'calls': calls,
+                'errors': errors,
+                'input_tokens': tin,
+                'output_tokens': tout,
+                'cached_tokens': tcached,
+                'total_tokens': tin + tout,
+                'avg_latency_ms': round(lat_sum / calls) if calls else 0,
+                'max_latency_ms': lat_max,
+            })
+            result.append(entry)
+        return result
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                'pending_keys': len(self._pending),
+                'pending_calls': sum(a['calls'] for a in self._pending.values()),
+                'flushed_rows': self._flushed_rows,
+                'last_flush': self._last_flush.isoformat() if self._last_flush else None,
+            }
+
+
+llm_usage = LLMUsageAccounting()
+
+
+# ==============================================================================
+# ★ LLMクォータ スケジューラ (送信前の予算確保)
+# ==============================================================================
+class LLMAdmissionDenied(Exception):
+    """予算が無いため送信しなかった (呼び出し側は別モデル/別プロバイダへ回す)"""
+
+
+class TokenBucket:
+    """capacity 個を per_seconds かけて満タンに戻すトークンバケット"""
+
+    def __init__(self, capacity: float, per_seconds: float):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / per_seconds
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def can_take(self, n: float, reserve: float = 0.0) -> bool:
+        self._refill()
+        # 1回で枠を超える大きな要求は、予約分を除いた枠いっぱいまで空いていれば通す
+        n = min(n, self.capacity * (1.0 - reserve))
+        return self.tokens - n >= self.capacity * reserve
+
+    def take(self, n: float):
+        self.tokens -= n
+
+    def give(self, n: float):
+        self.tokens = min(self.capacity, self.tokens + n)
+
+
+class LLMQuotaScheduler:
+    """(プロバイダ, モデル) ごとに RPM / TPM / RPD の3つのバケットを持つ"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._buckets: Dict[Tuple[str, str], Dict[str, TokenBucket]] = {}
+        self._admitted: Counter = Counter()
+        self._denied: Counter = Counter()
+        self._quotas = {'gemini': dict(GEMINI_MODEL_QUOTAS), 'groq': dict(GROQ_MODEL_QUOTAS)}
+        try:
+            for model, q in json.loads(os.environ.get('LLM_QUOTA_OVERRIDES', '') or '{}').items():
+                provider = 'gemini' if model.startswith('gemini') else 'groq'
+                self._quotas[provider][model] = {**self._quotas[provider].get(model, LLM_DEFAULT_QUOTA), **q}
+        except Exception as e:
+            logger.warning(f"⚠️ LLM_QUOTA_OVERRIDES の解析に失敗: {e}")
+
+    def _get(self, provider: str, model: str) -> Dict[str, TokenBucket]:
+        key = (provider, model)
+        if key not in self._buckets:
+            q = self._quotas.get(provider, {}).get(model, LLM_DEFAULT_QUOTA)
+            self._buckets[key] = {
+                'rpm': TokenBucket(q['rpm'], 60),
+                'tpm': TokenBucket(q['tpm'], 60),
+                'rpd': TokenBucket(q['rpd'], 86400),
+            }
+        return self._buckets[key]
+
+    def try_acquire(self, provider: str, model: str, est_tokens: int, priority: str = 'batch') -> bool:
+        """3つのバケットすべてに余裕があれば確保して True。1つでも足りなければ何も取らずに False"""
+        reserve = LLM_PRIORITY_RESERVE.get(priority, LLM_PRIORITY_RESERVE['batch'])
+        with self._lock:
+            b = self._get(provider, model)
+            if not (b['rpm'].can_take(1, reserve) and b['rpd'].can_take(1, reserve)
+                    and b['tpm'].can_take(est_tokens, reserve)):
+                self._denied[f"{provider}:{model}"] += 1
+                return False
+            b['rpm'].take(1)
+            b['rpd'].take(1)
+            b['tpm'].take(est_tokens)
+            self._admitted[f"{provider}:{model}"] += 1
+            return True
+
+    def has_budget(self, provider: str, model: str, priority: str = 'batch') -> bool:
+        """確保せずに、リクエスト1回分の枠があるかだけを見る"""
+        reserve = LLM_PRIORITY_RESERVE.get(priority, LLM_PRIORITY_RESERVE['batch'])
+        with self._lock:
+            b = self._get(provider, model)
+            return b['rpm'].can_take(1, reserve) and b['rpd'].can_take(1, reserve)
+
+    def settle(self, provider: str, model: str, reserved_tokens: int, actual_tokens: Optional[int]):
+        """応答の実トークン数で TPM を補正する (見積もりより少なければ返却)"""
+        if actual_tokens is None:
+            return
+        with self._lock:
+            tpm = self._get(provider, model)['tpm']
+            diff = reserved_tokens - actual_tokens
+            if diff > 0:
+                tpm.give(diff)
+            else:
+                tpm.take(-diff)
+
+    def penalize(self, provider: str, model: str):
+        """実際に 429 が返った = こちらの見積もりが甘い。このモデルの分単位の枠を空にする"""
+        with self._lock:
+            b = self._get(provider, model)
+            b['rpm'].tokens = min(b['rpm'].tokens, 0.0)
+            b['tpm'].tokens = min(b['tpm'].tokens, 0.0)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out = {}
+            for (provider, model), b in self._buckets.items():
+                for bucket in b.values():
+                    bucket._refill()
+                key = f"{provider}:{model}"
+                out[key] = {
+                    'rpm_left': round(b['rpm'].tokens, 1),
+                    'tpm_left': int(b['tpm'].tokens),
+                    'rpd_left': round(b['rpd'].tokens, 1),
+                    'admitted': self._admitted[key],
+                    'denied': self._denied[key],
+                }
+            return out
+
+
+llm_quota = LLMQuotaScheduler()
+
+
+class LLMPriorityGate:
+    """
+    1プロバイダ分の送信枠。待っている中で最も優先度の高いリクエストから順に通す。
+      - deferred / batch は最後の1枠を使えない (会話用に常に1枠空けておく)
+      - batch は会話の送信中・待機中は始めない
+    """
+
+    def __init__(self, provider: str, capacity: int):
+        self.provider = provider
+        self.capacity = max(1, capacity)
+        self._cond = threading.Condition(Lock())
+        self._in_use: Counter = Counter()
+        self._waiting: List[Tuple[int, int]] = []   # (rank, 通し番号) のヒープ
+        self._seq = 0
+        self._waited: Counter = Counter()
+        self._timeouts: Counter = Counter()
+        self._max_wait: Dict[str, float] = defaultdict(float)
+
+    def _limit(self, priority: str) -> int:
+        if LLM_PRIORITY_RANK.get(priority, 3) >= LLM_PRIORITY_RANK['deferred']:
+            return max(1, self.capacity - 1)
+        return self.capacity
+
+    def _can_start(self, priority: str) -> bool:
+        if sum(self._in_use.values()) >= self._limit(priority):
+            return False
+        if priority == 'batch' and (
+            self._in_use['interactive'] or
+            any(rank == LLM_PRIORITY_RANK['interactive'] for rank, _ in self._waiting)
+        ):
+            return False
+        return True
+
+    def acquire(self, priority: str, timeout: float) -> bool:
+        rank = LLM_PRIORITY_RANK.get(priority, LLM_PRIORITY_RANK['batch'])
+        started = time.monotonic()
+        deadline = started + timeout
+        with self._cond:
+            self._seq += 1
+            ticket = (rank, self._seq)
+            heapq.heappush(self._waiting, ticket)
+            while True:
+                if self._waiting[0] == ticket and self._can_start(priority):
+                    heapq.heappop(self._waiting)
+                    self._in_use[priority] += 1
+                    waited = time.monotonic() - started
+                    if waited > 0.05:
+                        self._waited[priority] += 1
+                        self._max_wait[priority] = max(self._max_wait[priority], waited)
+                    self._cond.notify_all()
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                    self._timeouts[priority] += 1
+                    self._cond.notify_all()
+                    return False
+                self._cond.wait(remaining)
+
+    def release(self, priority: str):
+        with self._cond:
+            self._in_use[priority] -= 1
+            self._cond.notify_all()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                'capacity': self.capacity,
+                'in_use': {k: v for k, v in self._in_use.items() if v},
+                'waiting': len(self._waiting),
+                'waited': dict(self._waited),
+                'timeouts': dict(self._timeouts),
+                'max_wait_sec': {k: round(v, 2) for k, v in self._max_wait.items()},
+            }
+
+
+class LLMDispatcher:
+    """全LLM呼び出しが通る送信口 (プロバイダ別の優先度付き同時実行制限)"""
+
+    def __init__(self):
+        self._gates = {
+            provider: LLMPriorityGate(provider, n) for provider, n in LLM_PROVIDER_CONCURRENCY.items()
+        }
+
+    @contextmanager
+    def slot(self, provider: str, priority: str):
+        gate = self._gates.get(provider)
+        if gate is None:
+            yield
+            return
+        timeout = deadline_timeout(LLM_PRIORITY_WAIT_SECONDS.get(priority, LLM_PRIORITY_WAIT_SECONDS['batch']), floor=0.1)
+        if not gate.acquire(priority, timeout):
+            raise LLMAdmissionDenied(f"{provider}送信枠待ちタイムアウト ({priority}, {timeout}秒)")
+        try:
+            yield
+        finally:
+            gate.release(priority)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {provider: gate.get_stats() for provider, gate in self._gates.items()}
+
+
+llm_dispatcher = LLMDispatcher()
+
+
+class LLMHealthTracker:
+    """
+    モデルごとの EWMA レイテンシ・EWMA エラー率とサーキットブレーカー。
+      closed    → 通常どおり選ぶ
+      open      → 選ばない (連続失敗 or エラー率超過)。cooldown 経過で1回だけ試験送信
+      half_open → 試験送信中。成功で closed、失敗で cooldown を倍にして open に戻す
+    レート制限 (429) はクォータ側の問題なので健全性には数えない。
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._health: Dict[Tuple[str, str], LLMModelHealth] = {}
+
+    def _get(self, provider: str, model: str) -> LLMModelHealth:
+        key = (provider, model)
+        if key not in self._health:
+            self._health[key] = LLMModelHealth()
+        return self._health[key]
+
+    def is_selectable(self, provider: str, model: str) -> bool:
+        with self._lock:
+            h = self._get(provider, model)
+            if h.state == 'closed':
+                return True
+            if h.state == 'open':
+                return time.monotonic() - h.opened_at >= h.cooldown
+            return not h.probing
+
+    def begin(self, provider: str, model: str) -> bool:
+        """送信直前に呼ぶ。オープン中なら False。クールダウン明けなら試験送信として通す"""
+        with self._lock:
+            h = self._get(provider, model)
+            if h.state == 'closed':
+                return True
+            if h.state == 'open' and time.monotonic() - h.opened_at < h.cooldown:
+                return False
+            if h.probing:
+                return False
+            h.state = 'half_open'
+            h.probing = True
+            logger.info(f"🔌 {provider}:{model} 試験送信 (ハーフオープン)")
+            return True
+
+    def record(self, provider: str, model: str, latency: float, ok: Optional[bool], error: str = ''):
+        """ok=None は成否を数えない (レート制限など) — 試験送信の枠だけ解放する"""
+        a = LLM_EWMA_ALPHA
+        with self._lock:
+            h = self._get(provider, model)
+            h.probing = False
+            if ok is None:
+                if h.state == 'half_open':
+                    h.state, h.opened_at = 'open', time.monotonic()
+                return
+            h.samples += 1
+            if ok or h.ewma_latency is None or latency > h.ewma_latency:
+                # 失敗でも遅かった分はレイテンシに反映する (タイムアウト級の遅さを見逃さない)
+                h.ewma_latency = latency if h.ewma_latency is None else (1 - a) * h.ewma_latency + a * latency
+            if ok:
+                h.error_rate *= (1 - a)
+                h.consecutive_failures = 0
+                if h.state != 'closed':
+                    logger.info(f"✅ {provider}:{model} 回復 (ブレーカー閉)")
+                h.state, h.cooldown = 'closed', LLM_BREAKER_COOLDOWN_SECONDS
+                return
+            h.error_rate = (1 - a) * h.error_rate + a
+            h.consecutive_failures += 1
+            h.last_error = error[:120]
+            if h.state == 'half_open':
+                h.cooldown = min(h.cooldown * 2, LLM_BREAKER_MAX_COOLDOWN_SECONDS)
+                h.state, h.opened_at = 'open', time.monotonic()
+                logger.warning(f"⚠️ {provider}:{model} 試験送信失敗 → {int(h.cooldown)}秒遮断")
+            elif h.state == 'closed' and (
+                h.consecutive_failures >= LLM_BREAKER_FAILURES or
+                (h.samples >= LLM_BREAKER_MIN_SAMPLES and h.error_rate >= LLM_BREAKER_ERROR_RATE)
+            ):
+                h.state, h.opened_at = 'open', time.monotonic()
+                logger.warning(f"⚠️ {provider}:{model} ブレーカー開 ({h.consecutive_failures}連続失敗, エラー率{h.error_rate:.0%})")
+
+    def expected_latency(self, provider: str, model: str) -> float:
+        """失敗すると別モデルでやり直しになるので、エラー率の分だけ割り増しする"""
+        with self._lock:
+            h = self._get(provider, model)
+            latency = h.ewma_latency if h.ewma_latency is not None else LLM_LATENCY_PRIOR_SECONDS
+            return latency / max(0.1, 1.0 - h.error_rate)
+
+    def rank(self, provider: str, models: List[str]) -> List[str]:
+        """選べるモデルを想定レイテンシの短い順に並べる (同点なら元の順)"""
+        usable = [m for m in models if self.is_selectable(provider, m)]
+        return sorted(usable, key=lambda m: self.expected_latency(provider, m))
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                f"{provider}:{model}": {
+                    'state': h.state,
+                    'ewma_latency_sec': round(h.ewma_latency, 2) if h.ewma_latency is not None else None,
+                    'error_rate': round(h.error_rate, 3),
+                    'samples': h.samples,
+                    'consecutive_failures': h.consecutive_failures,
+                    'last_error': h.last_error,
+                }
+                for (provider, model), h in self._health.items()
+            }
+
+
+llm_health = LLMHealthTracker()
+
+
+def _is_rate_limit_error(e: Exception) -> bool:
+    err = str(e).lower()
+    return '429' in err or 'quota' in err or 'rate limit' in err or 'exhausted' in err
+
+
+def estimate_contents_tokens(contents) -> int:
+    """generate_content に渡す contents (文字列 / リスト / dict) の入力トークン概算"""
+    if contents is None:
+        return 0
+    if isinstance(contents, str):
+        return estimate_tokens(contents)
+    if isinstance(contents, dict):
+        return estimate_contents_tokens(contents.get('parts') or contents.get('text'))
+    if isinstance(contents, (list, tuple)):
+        return sum(estimate_contents_tokens(c) for c in contents)
+    return estimate_tokens(getattr(contents, 'text', '') or '')
+
+
+class GeminiQuotaProxy:
+    """
+    GeminiModelManager.get_current_model() が返すモデル。
+    llm_dispatcher の送信枠を優先度順に待ってから予算を確保し、現在のモデルに枠が無ければ
+    次のモデルへ即座に回す。全滅なら LLMAdmissionDenied (送信しない)。
+    priority= ('interactive' / 'search' / 'deferred' / 'batch') を追加で受け取る。
+    """
+
+    def __init__(self, manager: 'GeminiModelManager', model_name: str):
+        self._manager = manager
+        self.model_name = model_name
+
+    def generate_content(self, contents, *args, priority: str = 'batch',
+                         prompt_prefix: Optional[str] = None, **kwargs):
+        """prompt_prefix: 静的プレフィックス。キャッシュ済みならハンドル経由、無ければ contents の先頭に付けて送る"""
+        config = kwargs.get('generation_config') or {}
+        max_out = config.get('max_output_tokens', 600) if isinstance(config, dict) else 600
+        est = estimate_contents_tokens(contents) + estimate_tokens(prompt_prefix or '') + int(max_out)
+        with llm_dispatcher.slot('gemini', priority):
+            return self._send(contents, args, kwargs, est, priority, prompt_prefix)
+
+    def _send(self, contents, args, kwargs, est: int, priority: str, prompt_prefix: Optional[str] = None):
+        # 健全なモデルを想定レイテンシ順に試す (実績が無ければ現在のモデルから GEMINI_MODELS 順)
+        for name in llm_health.rank('gemini', self._manager.candidate_names(self.model_name)):
+            cancel_checkpoint(f"gemini:{name}")
+            if not llm_quota.try_acquire('gemini', name, est, priority):
+                continue
+            model = self._manager.get_instance(name)
+            send_contents = contents
+            if prompt_prefix and model is not None:
+                cached = prompt_prefix_cache.gemini_model(name, prompt_prefix)
+                if cached is not None:
+                    model = cached
+                else:
+                    send_contents = ([prompt_prefix] + list(contents) if isinstance(contents, (list, tuple))
+                                     else f"{prompt_prefix}\n\n{contents}")
+            if model is None or not llm_health.begin('gemini', name):
+                llm_quota.settle('gemini', name, est, 0)
+                continue
+            if name != self.model_name:
+                logger.info(f"🔀 Gemini切替: {self.model_name} → {name} ({priority})")
+            token = current_cancel_token()
+            if token is not None:
+                kwargs['request_options'] = {'timeout': deadline_timeout(60)}
+            started = time.monotonic()
+            try:
+                resp = transport.call(
+                    'gemini', name, [name, prompt_prefix, _contents_material(contents), kwargs.get('generation_config')],
+                    lambda: model.generate_content(send_contents, *args, **kwargs),
+                    _encode_gemini_response, _decode_gemini_response,
+                )
+            except Exception as e:
+                llm_quota.settle('gemini', name, est, 0)
+                if _is_rate_limit_error(e):
+                    llm_quota.penalize('gemini', name)
+                    llm_health.record('gemini', name, time.monotonic() - started, None)
+                elif token is not None and token.cancelled:
+                    # 期限で切った通信はモデルの不調として数えない
+                    llm_health.record('gemini', name, time.monotonic() - started, None)
+                else:
+                    llm_health.record('gemini', name, time.monotonic() - started, False, str(e))
+                llm_usage.record('gemini', name, priority, time.monotonic() - started, False)
+                raise
+            llm_health.record('gemini', name, time.monotonic() - started, True)
+            usage = getattr(resp, 'usage_metadata', None)
+            llm_usage.record('gemini', name, priority, time.monotonic() - started, True,
+                             getattr(usage, 'prompt_token_count', None),
+                             getattr(usage, 'candidates_token_count', None),
+                             getattr(usage, 'cached_content_token_count', None))
+            llm_quota.settle('gemini', name, est, getattr(usage, 'total_token_count', None))
+            if getattr(usage, 'prompt_token_count', None) is not None:
+                logger.info(
+                    f"📏 {name} 入力{usage.prompt_token_count}トークン"
+                    f" (キャッシュ{getattr(usage, 'cached_content_token_count', 0) or 0})"
+                    f" / 出力{getattr(usage, 'candidates_token_count', None)}トークン"
+                )
+            return resp
+        raise LLMAdmissionDenied(f"Gemini予算不足 ({priority}, 約{est}トークン)")
+
+    def __getattr__(self, item):
+        return getattr(self._manager.get_instance(self.model_name), item)
+
+
+class QuotaGuardedGroq:
+    """
+    Groq クライアントのラッパー。chat.completions.create の前に送信枠と予算を確保し、
+    枠が無ければ送信せずに LLMAdmissionDenied を投げる (呼び出し側は次のモデルへ)。
+    """
+
+    def __init__(self, client: Groq):
+        self._client = client
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, *, model: str, messages: List[Dict], priority: str = 'batch', **kwargs):
+        est = sum(estimate_tokens(m.get('content') or '') for m in messages) + int(kwargs.get('max_tokens', 600))
+        with llm_dispatcher.slot('groq', priority):
+            return self._send(model, messages, kwargs, est, priority)
+
+    def _send(self, model: str, messages: List[Dict], kwargs: Dict, est: int, priority: str):
+        cancel_checkpoint(f"groq:{model}")
+        if not llm_quota.try_acquire('groq', model, est, priority):
+            raise LLMAdmissionDenied(f"Groq予算不足: {model} ({priority}, 約{est}トークン)")
+        if not llm_health.begin('groq', model):
+            llm_quota.settle('groq', model, est, 0)
+            raise LLMAdmissionDenied(f"Groq遮断中: {model}")
+        token = current_cancel_token()
+        if token is not None:
+            kwargs['timeout'] = deadline_timeout(60)
+        started = time.monotonic()
+        try:
+            resp = transport.call(
+                'groq', model, [model, messages, {k: v for k, v in kwargs.items() if k != 'timeout'}],
+                lambda: self._client.chat.completions.create(model=model, messages=messages, **kwargs),
+                _encode_groq_response, _decode_groq_response,
+            )
+        except Exception as e:
+            llm_quota.settle('groq', model, est, 0)
+            if _is_rate_limit_error(e):
+                llm_quota.penalize('groq', model)
+                llm_health.record('groq', model, time.monotonic() - started, None)
+            elif token is not None and token.cancelled:
+                llm_health.record('groq', model, time.monotonic() - started, None)
+            else:
+                llm_health.record('groq', model, time.monotonic() - started, False, str(e))
+            llm_usage.record('groq', model, priority, time.monotonic() - started, False)
+            raise
+        llm_health.record('groq', model, time.monotonic() - started, True)
+        usage = getattr(resp, 'usage', None)
+        llm_quota.settle('groq', model, est, getattr(usage, 'total_tokens', None))
+        cached = getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', None) or 0
+        llm_usage.record('groq', model, priority, time.monotonic() - started, True,
+                         getattr(usage, 'prompt_tokens', None), getattr(usage, 'completion_tokens', None), cached)
+        if getattr(usage, 'prompt_tokens', None) is not None:
+            logger.info(f"📏 {model} 入力{usage.prompt_tokens}トークン (キャッシュ{cached}) / 出力{getattr(usage, 'completion_tokens', None)}トークン")
+        return resp
+
+    def __getattr__(self, item):
+        return getattr(self._client, item)
+
+
 global_state = GlobalState()
 gemini_model_manager = GeminiModelManager()
 # ★ v33.8.2: GROQ_TASK_MODELS に含まれる全ユニークモデルも管理対象に追加
@@ -466,6 +1406,7 @@ conversation_activity = ConversationActivityTracker()
 NEVER_SKIP_TASKS = {
     'cleanup_voices',          # ローカルファイル削除のみ
     'cleanup_rate_limiter',    # メモリ操作のみ
+    'flush_llm_usage',         # メモリの集計をDBに書くだけ
 }
 
 
@@ -473,7 +1414,7 @@ NEVER_SKIP_TASKS = {
 # ★ v33.15: 会話中の遅延タスクキュー
 # ==============================================================================
 # /chat_lsl 内で発生するGemini消費の重いタスクを、会話中は実行せずに
-# キューに溜めておき、アイドル時に間隔を空けて1個ずつ処理する。
+# キューに溜めておき、アイドル時にまとめて処理する。
 #
 # 対象タスク:
 #   - analyze_user_psychology       (Gemini: 性格分析)
@@ -482,71 +1423,261 @@ NEVER_SKIP_TASKS = {
 #   - get_anime_info_from_cache_or_search (Web検索)
 #
 # 設計:
-#   - 同じ user_uuid + task_type は重複登録しない（最新の値で上書き）
-#   - キューはメモリ内（再起動で消える）
-#   - アイドルスケジューラが30秒ごとにキューを見る
-#   - 処理間隔は5秒（Gemini Rate Limit 15RPM=4秒に1回 を超えない）
+#   - キューは deferred_tasks テーブル (DB) に置く → Render のスリープ/再起動でも消えない
+#   - 同じ user_uuid + task_type は task_key のユニーク制約で upsert (最新の値で上書き)
+#   - 優先度 (小さいほど先) と not_before (この時刻までは取り出さない) を持つ
+#   - 取り出しはリース方式: lease_until までは他のワーカーが取らない
+#     → 処理中に落ちてもリース切れで再実行される。失敗は指数バックオフで再試行
+#   - アイドル時に LLM クォータ ('deferred' 枠) が許す限り数件まとめて処理
+#   - 心理分析・プロフィール更新は数人分を1回の LLM 呼び出しにまとめる (analyze_users_batch)
 # ==============================================================================
 
+DEFERRED_TASK_PRIORITY = {
+    'proactive_message': 10,      # 次の会話で使う → 最優先
+    'update_friend_profile': 20,
+    'analyze_psychology': 30,
+    'fetch_anime': 40,
+}
+DEFERRED_TASK_DEFAULT_PRIORITY = 50
+# task_key にこの extra フィールドも含める (タイトル毎に別タスクとして積む)
+DEFERRED_TASK_KEY_FIELDS = {'fetch_anime': 'title'}
+# LLM を消費するタスク (クォータが無ければ取り出しても処理しない)
+DEFERRED_LLM_TASKS = {'analyze_psychology', 'update_friend_profile', 'proactive_message'}
+DEFERRED_LEASE_SECONDS = 300        # リース期限 (処理中にプロセスが落ちたらこの後に再実行)
+DEFERRED_DRAIN_BATCH = 10           # アイドル1回あたりに取り出す最大件数
+DEFERRED_MAX_ATTEMPTS = 5           # これを超えて失敗したタスクは破棄
+DEFERRED_RETRY_BASE_SECONDS = 60    # 失敗時のバックオフ (60s, 120s, 240s ... 上限1時間)
+DEFERRED_RETRY_MAX_SECONDS = 3600
+
+
 class DeferredTaskQueue:
-    """会話中に発生したGemini消費タスクを保留するキュー"""
+    """会話中に発生したGemini消費タスクを保留する永続キュー (deferred_tasks テーブル)"""
+
+    DEFERRED_TASK_INTERVAL = 5.0  # キュー確認間隔（秒）
 
-    DEFERRED_TASK_INTERVAL = 5.0  # タスク処理間隔（秒）
+    _COLUMNS = "id, revision, task_type, user_uuid, user_name, extra_json, attempts, queued_at"
 
     def __init__(self):
-        self._queue: List[Dict] = []
         self._lock = Lock()
-        self._processing = False
+        self._stats = {'added': 0, 'merged': 0, 'completed': 0, 'failed': 0, 'dropped': 0, 'released': 0}
+
+    @staticmethod
+    def task_key(task_type: str, user_uuid: str, extra: Dict) -> str:
+        key = f"{task_type}:{user_uuid}"
+        field = DEFERRED_TASK_KEY_FIELDS.get(task_type)
+        if field:
+            key += f":{extra.get(field, '')}"
+        # 長いタイトル対策 (ユニーク列の長さ内に収める)
+        if len(key) > 200:
+            key = key[:160] + ':' + hashlib.md5(key.encode('utf-8')).hexdigest()
+        return key
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
 
-    def add(self, task_type: str, user_uuid: str, user_name: str, **kwargs):
+    def add(self, task_type: str, user_uuid: str, user_name: str,
+            priority: Optional[int] = None, delay_seconds: float = 0, **kwargs):
         """
         タスクを追加。同じ user_uuid + task_type は上書きされる
         （古いタスクの更新を待つより最新の状態で1回処理する方が効率的）
+        上書き時は優先度・not_before とも早い方を残す。
         """
-        with self._lock:
-            # 既存の同じタスクを削除（最新だけ残す）
-            self._queue = [
-                t for t in self._queue
-                if not (t['type'] == task_type and t['user_uuid'] == user_uuid)
-            ]
-            self._queue.append({
-                'type': task_type,
-                'user_uuid': user_uuid,
-                'user_name': user_name,
-                'queued_at': datetime.utcnow(),
-                'extra': kwargs,
-            })
-            logger.info(f"📥 遅延タスク追加: {task_type} for {user_name} (キュー残: {len(self._queue)})")
+        now = datetime.utcnow()
+        if priority is None:
+            priority = DEFERRED_TASK_PRIORITY.get(task_type, DEFERRED_TASK_DEFAULT_PRIORITY)
+        params = {
+            'key': self.task_key(task_type, user_uuid, kwargs),
+            'type': task_type, 'uuid': user_uuid, 'name': user_name,
+            'extra': json.dumps(kwargs, ensure_ascii=False),
+            'prio': priority, 'nb': now + timedelta(seconds=max(0.0, delay_seconds)), 'now': now,
+        }
+        try:
+            with engine.connect() as conn:
+                with conn.begin():
+                    revision = conn.execute(text(
+                        "INSERT INTO deferred_tasks (task_key, task_type, user_uuid, user_name, extra_json,"
+                        " priority, not_before, attempts, revision, queued_at, updated_at)"
+                        " VALUES (:key, :type, :uuid, :name, :extra, :prio, :nb, 0, 1, :now, :now)"
+                        " ON CONFLICT (task_key) DO UPDATE SET"
+                        "  user_name = excluded.user_name,"
+                        "  extra_json = excluded.extra_json,"
+                        "  priority = CASE WHEN excluded.priority < deferred_tasks.priority"
+                        "             THEN excluded.priority ELSE deferred_tasks.priority END,"
+                        "  not_before = CASE WHEN excluded.not_before < deferred_tasks.not_before"
+                        "               THEN excluded.not_before ELSE deferred_tasks.not_before END,"
+                        "  revision = deferred_tasks.revision + 1,"
+                        "  updated_at = excluded.updated_at"
+                        " RETURNING revision"
+                    ), params).scalar()
+            self._count('added' if revision == 1 else 'merged')
+            logger.info(f"📥 遅延タスク{'追加' if revision == 1 else '更新'}: {task_type} for {user_name} "
+                        f"(優先度{priority}, rev{revision})")
+        except Exception as e:
+            logger.error(f"遅延タスク登録エラー ({task_type}): {e}")
 
     def size(self) -> int:
-        with self._lock:
-            return len(self._queue)
+        try:
+            with engine.connect() as conn:
+                return conn.execute(text("SELECT COUNT(*) FROM deferred_tasks")).scalar() or 0
+        except Exception:
+            return 0
+
+    def ready_count(self) -> int:
+        """今すぐ取り出せる件数 (not_before 到来済み・リース無し)"""
+        now = datetime.utcnow()
+        try:
+            with engine.connect() as conn:
+                return conn.execute(text(
+                    "SELECT COUNT(*) FROM deferred_tasks WHERE not_before <= :now"
+                    " AND (lease_until IS NULL OR lease_until < :now)"
+                ), {'now': now}).scalar() or 0
+        except Exception:
+            return 0
+
+    def lease(self, limit: int = 1, lease_seconds: float = DEFERRED_LEASE_SECONDS) -> List[Dict]:
+        """
+        取り出し可能なタスクを優先度順に最大 limit 件リースする。
+        行ごとに条件付き UPDATE で確保するので、複数ワーカーが同時に呼んでも二重に取らない。
+        """
+        now = datetime.utcnow()
+        until = now + timedelta(seconds=lease_seconds)
+        leased = []
+        try:
+            with engine.connect() as conn:
+                with conn.begin():
+                    ids = [r[0] for r in conn.execute(text(
+                        "SELECT id FROM deferred_tasks WHERE not_before <= :now"
+                        " AND (lease_until IS NULL OR lease_until < :now)"
+                        " ORDER BY priority, not_before, id LIMIT :n"
+                    ), {'now': now, 'n': limit}).fetchall()]
+                    for task_id in ids:
+                        row = conn.execute(text(
+                            "UPDATE deferred_tasks SET lease_until = :until, attempts = attempts + 1"
+                            " WHERE id = :id AND (lease_until IS NULL OR lease_until < :now)"
+                            f" RETURNING {self._COLUMNS}"
+                        ), {'until': until, 'id': task_id, 'now': now}).fetchone()
+                        if row:
+                            leased.append(self._row_to_task(row))
+        except Exception as e:
+            logger.error(f"遅延タスク取り出しエラー: {e}")
+        return leased
+
+    @staticmethod
+    def _row_to_task(row) -> Dict:
+        try:
+            extra = json.loads(row[5]) if row[5] else {}
+        except (ValueError, TypeError):
+            extra = {}
+        return {
+            'id': row[0], 'revision': row[1], 'type': row[2], 'user_uuid': row[3],
+            'user_name': row[4], 'extra': extra, 'attempts': row[6], 'queued_at': row[7],
+        }
 
     def pop_one(self) -> Optional[Dict]:
-        with self._lock:
-            if self._queue:
-                return self._queue.pop(0)
-            return None
+        """1件リースして返す (処理後に complete / fail / release を呼ぶこと)"""
+        tasks = self.lease(1)
+        return tasks[0] if tasks else None
+
+    def complete(self, task: Dict):
+        """処理済みタスクを消す。処理中に同じキーで再登録されていたらリースだけ外して残す"""
+        try:
+            with engine.connect() as conn:
+                with conn.begin():
+                    deleted = conn.execute(text(
+                        "DELETE FROM deferred_tasks WHERE id = :id AND revision = :rev"
+                    ), {'id': task['id'], 'rev': task['revision']}).rowcount
+                    if not deleted:
+                        conn.execute(text(
+                            "UPDATE deferred_tasks SET lease_until = NULL, attempts = 0 WHERE id = :id"
+                        ), {'id': task['id']})
+            self._count('completed')
+        except Exception as e:
+            logger.error(f"遅延タスク完了処理エラー ({task.get('type')}): {e}")
+
+    def fail(self, task: Dict):
+        """失敗したタスクを指数バックオフで再スケジュール (上限回数を超えたら破棄)"""
+        attempts = task.get('attempts', 1)
+        try:
+            with engine.connect() as conn:
+                with conn.begin():
+                    if attempts >= DEFERRED_MAX_ATTEMPTS:
+                        conn.execute(text("DELETE FROM deferred_tasks WHERE id = :id"), {'id': task['id']})
+                        self._count('dropped')
+                        logger.warning(f"🗑️ 遅延タスク破棄: {task['type']} for {task['user_name']} ({attempts}回失敗)")
+                        return
+                    delay = min(DEFERRED_RETRY_BASE_SECONDS * (2 ** (attempts - 1)), DEFERRED_RETRY_MAX_SECONDS)
+                    conn.execute(text(
+                        "UPDATE deferred_tasks SET lease_until = NULL, not_before = :nb WHERE id = :id"
+                    ), {'nb': datetime.utcnow() + timedelta(seconds=delay), 'id': task['id']})
+            self._count('failed')
+            logger.info(f"🔁 遅延タスク再試行予約: {task['type']} for {task['user_name']} ({delay}秒後)")
+        except Exception as e:
+            logger.error(f"遅延タスク失敗処理エラー ({task.get('type')}): {e}")
+
+    def release(self, task: Dict):
+        """未処理のままリースを返す (試行回数には数えない)"""
+        try:
+            with engine.connect() as conn:
+                with conn.begin():
+                    conn.execute(text(
+                        "UPDATE deferred_tasks SET lease_until = NULL,"
+                        " attempts = CASE WHEN attempts > 0 THEN attempts - 1 ELSE 0 END WHERE id = :id"
+                    ), {'id': task['id']})
+            self._count('released')
+        except Exception as e:
+            logger.error(f"遅延タスク返却エラー ({task.get('type')}): {e}")
 
-    def get_status(self) -> List[Dict]:
+    def get_status(self, limit: int = 50) -> List[Dict]:
         """管理画面表示用"""
+        now = datetime.utcnow()
+        try:
+            with engine.connect() as conn:
+                rows = conn.execute(text(
+                    "SELECT task_type, user_name, priority, not_before, lease_until, attempts, queued_at"
+                    " FROM deferred_tasks ORDER BY priority, not_before, id LIMIT :n"
+                ), {'n': limit}).fetchall()
+        except Exception as e:
+            logger.error(f"遅延タスク一覧取得エラー: {e}")
+            return []
+        result = []
+        for r in rows:
+            queued_at, not_before, lease_until = (_as_datetime(v) for v in (r[6], r[3], r[4]))
+            result.append({
+                'type': r[0],
+                'user_name': r[1],
+                'priority': r[2],
+                'queued_at': queued_at.isoformat() if queued_at else None,
+                'waited_seconds': int((now - queued_at).total_seconds()) if queued_at else None,
+                'ready_in_seconds': max(0, int((not_before - now).total_seconds())) if not_before else 0,
+                'leased': bool(lease_until and lease_until > now),
+                'attempts': r[5],
+            })
+        return result
+
+    def get_stats(self) -> Dict:
         with self._lock:
-            return [
-                {
-                    'type': t['type'],
-                    'user_name': t['user_name'],
-                    'queued_at': t['queued_at'].isoformat(),
-                    'waited_seconds': int((datetime.utcnow() - t['queued_at']).total_seconds()),
-                }
-                for t in self._queue
-            ]
+            stats = dict(self._stats)
+        stats['size'] = self.size()
+        stats['ready'] = self.ready_count()
+        return stats
+
+
+def _as_datetime(value) -> Optional[datetime]:
+    """raw SQL の日時列 (SQLite では文字列で返る) を datetime に揃える"""
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
 
 
 deferred_queue = DeferredTaskQueue()
 
 
-def process_deferred_task(task: Dict):
-    """1個の遅延タスクを処理する。例外は握りつぶしてキュー処理を止めない"""
+def process_deferred_task(task: Dict) -> bool:
+    """1個の遅延タスクを処理する。例外は握りつぶしてキュー処理を止めない (戻り値: 成功したか)"""
     try:
         task_type = task['type']
         user_uuid = task['user_uuid']
@@ -608,14 +1739,82 @@ def process_deferred_task(task: Dict):
         else:
             logger.warning(f"⚠️ 未知の遅延タスクタイプ: {task_type}")
 
+        return True
+
     except Exception as e:
         logger.error(f"遅延タスク処理エラー ({task.get('type','?')}): {e}")
+        return False
+
+
+def _deferred_llm_budget_available() -> bool:
+    """'deferred' 優先度で使える LLM 枠がどこかに残っているか"""
+    if any(llm_quota.has_budget('gemini', m, 'deferred') for m in GEMINI_MODELS):
+        return True
+    return bool(groq_model_manager.get_available_models('deferred'))
+
+
+def drain_deferred_queue(max_tasks: int = DEFERRED_DRAIN_BATCH) -> int:
+    """
+    アイドル中に遅延タスクをまとめて処理する。
+    会話が始まったら残りはリースを返して次の機会に回す。
+    LLM 枠が尽きた時は LLM を使うタスクだけ返却し、それ以外 (fetch_anime 等) は続ける。
+    戻り値: 処理した件数
+    """
+    tasks = deferred_queue.lease(max_tasks)
+
+    # 心理分析・プロフィール更新は同種を ANALYSIS_BATCH_USERS 人ずつまとめて1回の LLM 呼び出しにする
+    units: List[List[Dict]] = []
+    open_batches: Dict[str, List[Dict]] = {}
+    for task in tasks:
+        if task['type'] in ANALYSIS_BATCH_TASKS:
+            batch = open_batches.get(task['type'])
+            if batch is None or len(batch) >= ANALYSIS_BATCH_USERS:
+                batch = open_batches[task['type']] = []
+                units.append(batch)
+            batch.append(task)
+        else:
+            units.append([task])
+
+    processed = 0
+    llm_exhausted = False
+    llm_released = 0
+    for i, unit in enumerate(units):
+        if not conversation_activity.is_idle():
+            rest = [t for u in units[i:] for t in u]
+            for task in rest:
+                deferred_queue.release(task)
+            logger.info(f"⏸️ 遅延タスク中断 (会話再開): 残り{len(rest)}件を返却")
+            break
+        if unit[0]['type'] in DEFERRED_LLM_TASKS:
+            if not llm_exhausted and not _deferred_llm_budget_available():
+                llm_exhausted = True
+            if llm_exhausted:
+                for task in unit:
+                    deferred_queue.release(task)
+                llm_released += len(unit)
+                continue
+        if len(unit) == 1:
+            with llm_usage_scope(unit[0]['type'], unit[0]['user_uuid']):
+                ok_ids = {unit[0]['id']} if process_deferred_task(unit[0]) else set()
+        else:
+            with llm_usage_scope(unit[0]['type'], '_batch_'):
+                done = analyze_users_batch(unit[0]['type'], [(t['user_uuid'], t['user_name']) for t in unit])
+            ok_ids = {t['id'] for t in unit if t['user_uuid'] in done}
+        for task in unit:
+            if task['id'] in ok_ids:
+                deferred_queue.complete(task)
+            else:
+                deferred_queue.fail(task)
+        processed += len(unit)
+    if llm_released:
+        logger.info(f"⏸️ LLM枠不足: LLMタスク{llm_released}件を返却")
+    return processed
 
 
 def process_deferred_queue_loop():
     """
-    アイドル時に遅延タスクを1つずつ処理するループ。
-    別スレッドで常駐する。
+    アイドル時に遅延タスクを処理するループ。
+    別スレッドで常駐する。1回のアイドル確認で LLM 枠が許す限り数件まとめて処理する。
     """
     logger.info("📨 遅延タスク処理ループ起動")
     while True:
@@ -626,13 +1825,10 @@ def process_deferred_queue_loop():
             if not conversation_activity.is_idle():
                 continue
 
-            # キューが空ならスキップ
-            task = deferred_queue.pop_one()
-            if not task:
-                continue
-
-            # 処理（さらに会話が来ても次回ループで止まる）
-            process_deferred_task(task)
+            # 処理（会話が来たら drain 内で止まる）
+            # 1バッチ分処理できたら間隔を空けずに次のバッチへ
+            while drain_deferred_queue() >= DEFERRED_DRAIN_BATCH:
+                pass
 
         except Exception as e:
             logger.error(f"遅延タスクループエラー: {e}")
@@ -641,6 +1837,9 @@ def process_deferred_queue_loop():
 
 # Gemini File API用の知識ドキュメントパス（MochikoKnowledgeFileクラスで使用）
 MOCHIKO_KNOWLEDGE_PATH = "/tmp/mochiko_knowledge.txt"
+# 知識ドキュメント全体を Gemini 呼び出しに添付するか
+#   off: 添付しない (関連セクションだけ Memvid 検索で注入) / detailed: 詳細回答のみ / always: 毎回
+KNOWLEDGE_FILE_ATTACH = os.environ.get('KNOWLEDGE_FILE_ATTACH', 'off').lower()
 
 
 # ==============================================================================
@@ -675,6 +1874,10 @@ class MochikoKnowledgeFile:
                 f.write(content)
             logger.info(f"✅ 知識ドキュメント生成完了: {len(content)}文字")
 
+            if KNOWLEDGE_FILE_ATTACH == 'off':
+                # 添付しない設定ならアップロードも不要 (セクションは Memvid 側で索引される)
+                return
+
             with self._lock:
                 # 古いファイルを削除
                 if self._file_obj:
@@ -696,8 +1899,145 @@ class MochikoKnowledgeFile:
         except Exception as e:
             logger.error(f"❌ 知識ドキュメント更新失敗: {e}")
 
+    # Memvid に 'mochiko_knowledge' として索引するグループ。
+    # ニュース・エピソード・ファン用語は Memvid の各ソースで索引済み、友達プロフィールは
+    # 本人との会話にだけ get_friend_context で注入、配信予定は毎回DBから注入するので対象外。
+    INDEXED_GROUPS = ('keywords', 'feelings')
+
+    @staticmethod
+    def section_id(key: str) -> int:
+        """セクションキー → MemvidEmbedding.source_id に入る安定した整数id"""
+        return zlib.crc32(key.encode('utf-8')) & 0x7fffffff
+
+    def build_sections(self, session, groups: Optional[Tuple[str, ...]] = None) -> List[Dict[str, str]]:
+        """
+        知識ドキュメントを構成するセクションを返す。
+        [{'key': 一意キー, 'group': グループ, 'heading': グループ見出し, 'title': 小見出し or '', 'body': 本文}]
+        groups を渡すとそのグループだけ組み立てる (不要なクエリを打たない)
+        """
+        sections: List[Dict[str, str]] = []
+
+        def want(group: str) -> bool:
+            return groups is None or group in groups
+
+        def add(key: str, group: str, heading: str, body: str, title: str = ''):
+            sections.append({'key': key, 'group': group, 'heading': heading, 'title': title, 'body': body})
+
+        # ① 友達プロフィール
+        if want('friends'):
+            for f in session.query(FriendProfile).all():
+                lines = [f"- {f.user_name}"]
+                if f.fav_holomem:
+                    lines.append(f"  好きなホロメン: {f.fav_holomem}")
+                if f.hobbies:
+                    lines.append(f"  趣味: {f.hobbies}")
+                if f.fav_games:
+                    lines.append(f"  好きなゲーム: {f.fav_games}")
+                if f.fav_anime:
+                    lines.append(f"  好きなアニメ: {f.fav_anime}")
+                if f.memo:
+                    lines.append(f"  メモ: {f.memo[:100]}")
+                add(f"friend:{f.user_uuid}", 'friends', '友達リスト', '\n'.join(lines))
+
+        # ② よく話題になるキーワード
+        if want('keywords'):
+            from sqlalchemy import func as sqlfunc
+            top_keywords = (
+                session.query(
+                    UserInterestLog.category,
+                    UserInterestLog.keyword,
+                    sqlfunc.sum(UserInterestLog.mention_count).label('total')
+                )
+                .filter(UserInterestLog.sentiment == 'positive')
+                .group_by(UserInterestLog.category, UserInterestLog.keyword)
+                .order_by(sqlfunc.sum(UserInterestLog.mention_count).desc())
+                .limit(30)
+                .all()
+            )
+            by_cat: Dict[str, List[str]] = {}
+            for cat, kw, total in top_keywords:
+                by_cat.setdefault(cat, []).append(f"{kw}({total}回)")
+            for cat, kws in by_cat.items():
+                add(f"keywords:{cat}", 'keywords', 'よく話題になるキーワード（人気順）', f"- {cat}: {', '.join(kws)}")
+
+        # ③ もちこのホロメン感想まとめ
+        if want('feelings'):
+            for feel in session.query(HolomemFeeling).limit(20).all():
+                if getattr(feel, 'summary_feeling', None):
+                    add(f"feeling:{feel.member_name}", 'feelings', 'もちこのホロメンへの感想',
+                        f"- {feel.member_name} (推し度{feel.love_level}/100): {feel.summary_feeling[:150]}")
+
+        # ④ 統計
+        if want('stats'):
+            user_count = session.query(UserMemory).count()
+            msg_count = session.query(ConversationHistory).count()
+            add('stats', 'stats', '活動統計', f"- 累計ユーザー数: {user_count}人\n- 累計会話数: {msg_count}件")
+
+        # ⑤ 最近のホロライブニュース（タイトル＋本文）
+        if want('news'):
+            recent_news = (
+                session.query(HololiveNews)
+                .order_by(HololiveNews.created_at.desc())
+                .limit(15)
+                .all()
+            )
+            for n in recent_news:
+                body = n.content[:300] if n.content and n.content != n.title else ''
+                add(f"news:{n.id}", 'news', '最近のホロライブニュース', body, title=n.title)
+
+        # ⑥ ★ 追加: ホロメン深掘りエピソード（Wikiから）
+        if want('episodes'):
+            members_with_episodes = (
+                session.query(HolomemWiki)
+                .filter(HolomemWiki.episodes.isnot(None))
+                .filter(HolomemWiki.status == '現役')
+                .limit(30)
+                .all()
+            )
+            for m in members_with_episodes:
+                ep_text = (m.episodes or '')[:500]
+                if ep_text:
+                    add(f"episode:{m.member_name}", 'episodes', 'ホロメンのエピソード・特徴', ep_text, title=m.member_name)
+
+        # ⑦ ★ 追加: ファン用語・呼称（hololive-dictionary由来）
+        if want('lingo'):
+            for lg in session.query(HolomemLingo).limit(80).all():
+                try:
+                    d = json.loads(lg.data or '{}')
+                except json.JSONDecodeError:
+                    continue
+                parts = []
+                if d.get('fannames'):
+                    parts.append(f"ファンネーム: {', '.join(d['fannames'][:3])}")
+                if d.get('hashtags'):
+                    parts.append(f"タグ: {', '.join(d['hashtags'][:3])}")
+                if d.get('aliases'):
+                    parts.append(f"呼び方: {', '.join(d['aliases'][:5])}")
+                if parts:
+                    add(f"lingo:{lg.member_name}", 'lingo', 'ホロメンのファン用語・呼び方',
+                        f"- {lg.member_name}: " + " / ".join(parts))
+
+        # ⑧ ★ 追加: 直近の配信スケジュール
+        if want('schedule'):
+            now_utc = datetime.utcnow()
+            upcoming = (
+                session.query(LiveSchedule)
+                .filter(LiveSchedule.scheduled_at >= now_utc - timedelta(hours=1))
+                .filter(LiveSchedule.scheduled_at <= now_utc + timedelta(hours=24))
+                .order_by(LiveSchedule.scheduled_at.asc())
+                .limit(20)
+                .all()
+            )
+            for s in upcoming:
+                jst = s.scheduled_at + timedelta(hours=9)
+                collab = f"(コラボ{s.collab_count}人)" if s.is_collab else ""
+                add(f"schedule:{s.id}", 'schedule', '直近24時間の配信予定（JST）',
+                    f"- {jst.strftime('%m/%d %H:%M')} {s.member_name} {collab}")
+
+        return sections
+
     def _build_document(self) -> str:
-        """DBから知識ドキュメントを組み立てる"""
+        """DBから知識ドキュメントを組み立てる (build_sections を見出しごとにまとめる)"""
         lines = []
         lines.append(f"# もちこ 知識ベース（自動生成）")
         lines.append(f"# 生成日時: {datetime.utcnow().strftime('%Y-%m-%d %H:%M UTC')}")
@@ -705,247 +2045,1169 @@ class MochikoKnowledgeFile:
 
         try:
             with get_db_session() as session:
-                # ① 友達プロフィール
-                friends = session.query(FriendProfile).all()
-                if friends:
-                    lines.append("## 友達リスト")
-                    for f in friends:
-                        lines.append(f"- {f.user_name}")
-                        if f.fav_holomem:
-                            lines.append(f"  好きなホロメン: {f.fav_holomem}")
-                        if f.hobbies:
-                            lines.append(f"  趣味: {f.hobbies}")
-                        if f.fav_games:
-                            lines.append(f"  好きなゲーム: {f.fav_games}")
-                        if f.fav_anime:
-                            lines.append(f"  好きなアニメ: {f.fav_anime}")
-                        if f.memo:
-                            lines.append(f"  メモ: {f.memo[:100]}")
-                    lines.append("")
+                sections = self.build_sections(session)
+        except Exception as e:
+            logger.error(f"❌ ドキュメント生成中にDBエラー: {e}")
+            sections = []
 
-                # ② よく話題になるキーワード
-                from sqlalchemy import func as sqlfunc
-                top_keywords = (
-                    session.query(
-                        UserInterestLog.category,
-                        UserInterestLog.keyword,
-                        sqlfunc.sum(UserInterestLog.mention_count).label('total')
-                    )
-                    .filter(UserInterestLog.sentiment == 'positive')
-                    .group_by(UserInterestLog.category, UserInterestLog.keyword)
-                    .order_by(sqlfunc.sum(UserInterestLog.mention_count).desc())
-                    .limit(30)
-                    .all()
-                )
-                if top_keywords:
-                    lines.append("## よく話題になるキーワード（人気順）")
-                    by_cat: Dict[str, List[str]] = {}
-                    for cat, kw, total in top_keywords:
-                        by_cat.setdefault(cat, []).append(f"{kw}({total}回)")
-                    for cat, kws in by_cat.items():
-                        lines.append(f"- {cat}: {', '.join(kws)}")
+        heading = None
+        for sec in sections:
+            if sec['heading'] != heading:
+                if heading is not None and lines[-1] != "":
                     lines.append("")
+                heading = sec['heading']
+                lines.append(f"## {heading}")
+            if sec['title']:
+                lines.append(f"### {sec['title']}")
+                if sec['body']:
+                    lines.append(sec['body'])
+                lines.append("")
+            else:
+                lines.append(sec['body'])
+        if heading is not None and lines[-1] != "":
+            lines.append("")
 
-                # ③ もちこのホロメン感想まとめ
-                feelings = session.query(HolomemFeeling).limit(20).all()
-                if feelings:
-                    lines.append("## もちこのホロメンへの感想")
-                    for feel in feelings:
-                        if hasattr(feel, 'summary_feeling') and feel.summary_feeling:
-                            lines.append(f"- {feel.member_name} (推し度{feel.love_level}/100): {feel.summary_feeling[:150]}")
-                    lines.append("")
+        return "\n".join(lines)
 
-                # ④ 統計
-                user_count = session.query(UserMemory).count()
-                msg_count = session.query(ConversationHistory).count()
-                lines.append("## 活動統計")
-                lines.append(f"- 累計ユーザー数: {user_count}人")
-                lines.append(f"- 累計会話数: {msg_count}件")
-                lines.append("")
 
-                # ⑤ 最近のホロライブニュース（タイトル＋本文）
-                recent_news = (
-                    session.query(HololiveNews)
-                    .order_by(HololiveNews.created_at.desc())
-                    .limit(15)
-                    .all()
-                )
-                if recent_news:
-                    lines.append("## 最近のホロライブニュース")
-                    for n in recent_news:
-                        lines.append(f"### {n.title}")
-                        if n.content and n.content != n.title:
-                            lines.append(n.content[:300])
-                        lines.append("")
-
-                # ⑥ ★ 追加: ホロメン深掘りエピソード（Wikiから）
-                members_with_episodes = (
-                    session.query(HolomemWiki)
-                    .filter(HolomemWiki.episodes.isnot(None))
-                    .filter(HolomemWiki.status == '現役')
-                    .limit(30)
-                    .all()
-                )
-                if members_with_episodes:
-                    lines.append("## ホロメンのエピソード・特徴")
-                    for m in members_with_episodes:
-                        ep_text = (m.episodes or '')[:500]
-                        if ep_text:
-                            lines.append(f"### {m.member_name}")
-                            lines.append(ep_text)
-                            lines.append("")
-
-                # ⑦ ★ 追加: ファン用語・呼称（hololive-dictionary由来）
-                all_lingo = session.query(HolomemLingo).limit(80).all()
-                if all_lingo:
-                    lines.append("## ホロメンのファン用語・呼び方")
-                    for lg in all_lingo:
-                        try:
-                            d = json.loads(lg.data or '{}')
-                        except json.JSONDecodeError:
-                            continue
-                        parts = []
-                        if d.get('fannames'):
-                            parts.append(f"ファンネーム: {', '.join(d['fannames'][:3])}")
-                        if d.get('hashtags'):
-                            parts.append(f"タグ: {', '.join(d['hashtags'][:3])}")
-                        if d.get('aliases'):
-                            parts.append(f"呼び方: {', '.join(d['aliases'][:5])}")
-                        if parts:
-                            lines.append(f"- {lg.member_name}: " + " / ".join(parts))
-                    lines.append("")
+mochiko_knowledge_file = MochikoKnowledgeFile()
 
-                # ⑧ ★ 追加: 直近の配信スケジュール
-                now_utc = datetime.utcnow()
-                upcoming = (
-                    session.query(LiveSchedule)
-                    .filter(LiveSchedule.scheduled_at >= now_utc - timedelta(hours=1))
-                    .filter(LiveSchedule.scheduled_at <= now_utc + timedelta(hours=24))
-                    .order_by(LiveSchedule.scheduled_at.asc())
-                    .limit(20)
-                    .all()
+# ==============================================================================
+# ★ 永続Embeddingキャッシュ (メモリLRU + /tmp SQLite)
+# ==============================================================================
+# 同じテキストのEmbeddingを二度と課金・待機しないためのキャッシュ。
+# - キー: sha256(モデル名 + task_type + 実際にAPIへ送る全文)。先頭200文字キーの衝突を解消
+# - メモリ: OrderedDict による本物のLRU (値は float32 の array)
+# - ディスクヒット時の last_used 更新はまとめて書く
+# - ディスク: /tmp の SQLite (Render再起動後もインスタンスが生きていれば残る)
+EMBEDDING_MODEL = 'models/text-embedding-004'
+EMBEDDING_MAX_CHARS = 2000
+EMBEDDING_BATCH_MAX = 100                # Gemini batch embed の1リクエスト上限
+EMBED_CACHE_PATH = '/tmp/mochiko_embed_cache.db'
+EMBED_CACHE_MEM_MAX = 1000
+EMBED_CACHE_DISK_MAX = 50000
+
+
+class EmbeddingCache:
+    """Embeddingベクトルの2段キャッシュ (メモリLRU → SQLite)"""
+
+    def __init__(self, path: str = EMBED_CACHE_PATH,
+                 mem_max: int = EMBED_CACHE_MEM_MAX, disk_max: int = EMBED_CACHE_DISK_MAX):
+        self._lock = RLock()
+        # メモリ側は float32 の array で持つ (Python float のリストだと1件あたり約6倍)
+        self._mem: "OrderedDict[str, _array.array]" = OrderedDict()
+        self._mem_max = mem_max
+        self._disk_max = disk_max
+        self._path = path
+        self._conn = None
+        self._puts_since_prune = 0
+        # ディスクヒットの last_used 更新は溜めてまとめて書く (ヒット毎の UPDATE + commit を避ける)
+        self._touched: Dict[str, float] = {}
+        self._touched_flushed_at = time.time()
+        self.hits_mem = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self._open()
+
+    def _open(self):
+        try:
+            self._conn = sqlite3.connect(self._path, check_same_thread=False, timeout=5)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embed_cache ("
+                " key TEXT PRIMARY KEY,"
+                " model TEXT NOT NULL,"
+                " dim INTEGER NOT NULL,"
+                " vec BLOB NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_embed_cache_last_used ON embed_cache (last_used)")
+            self._conn.commit()
+        except Exception as e:
+            logger.warning(f"⚠️ Embeddingキャッシュ(SQLite)無効 → メモリのみ: {e}")
+            self._conn = None
+
+    TOUCH_FLUSH_COUNT = 200       # last_used 更新をこの件数溜まったら書く
+    TOUCH_FLUSH_SECONDS = 60      # または前回からこの秒数経ったら書く
+
+    @staticmethod
+    def make_key(model: str, task_type: str, text: str) -> str:
+        # task_type 毎に別ベクトル (retrieval_query と retrieval_document を混同しない)
+        return hashlib.sha256(f"{model}\x00{task_type}\x00{text}".encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _pack(vec) -> bytes:
+        return _array.array('f', vec).tobytes()
+
+    @staticmethod
+    def _unpack(blob: bytes) -> _array.array:
+        arr = _array.array('f')
+        arr.frombytes(blob)
+        return arr
+
+    def _remember(self, key: str, arr: _array.array):
+        self._mem[key] = arr
+        self._mem.move_to_end(key)
+        while len(self._mem) > self._mem_max:
+            self._mem.popitem(last=False)
+
+    def _touch(self, key: str):
+        """ロック保持中に呼ぶ。last_used の更新を溜め、閾値を超えたらまとめて書く"""
+        self._touched[key] = time.time()
+        if (len(self._touched) >= self.TOUCH_FLUSH_COUNT
+                or time.time() - self._touched_flushed_at >= self.TOUCH_FLUSH_SECONDS):
+            self._flush_touched()
+
+    def _flush_touched(self):
+        if self._conn is None or not self._touched:
+            self._touched_flushed_at = time.time()
+            return
+        touched, self._touched = self._touched, {}
+        self._touched_flushed_at = time.time()
+        try:
+            self._conn.executemany(
+                "UPDATE embed_cache SET last_used = ? WHERE key = ?",
+                [(ts, key) for key, ts in touched.items()]
+            )
+            self._conn.commit()
+        except Exception as e:
+            logger.debug(f"Embeddingキャッシュ last_used 更新エラー: {e}")
+
+    def get(self, model: str, text: str, task_type: str = 'retrieval_document') -> Optional[List[float]]:
+        key = self.make_key(model, task_type, text)
+        with self._lock:
+            arr = self._mem.get(key)
+            if arr is not None:
+                self._mem.move_to_end(key)
+                self.hits_mem += 1
+                return arr.tolist()
+            if self._conn is not None:
+                try:
+                    row = self._conn.execute(
+                        "SELECT vec FROM embed_cache WHERE key = ?", (key,)
+                    ).fetchone()
+                    if row:
+                        arr = self._unpack(row[0])
+                        self._touch(key)
+                        self._remember(key, arr)
+                        self.hits_disk += 1
+                        return arr.tolist()
+                except Exception as e:
+                    logger.debug(f"Embeddingキャッシュ読込エラー: {e}")
+            self.misses += 1
+        return None
+
+    def put(self, model: str, text: str, vec: List[float], task_type: str = 'retrieval_document'):
+        if not vec:
+            return
+        key = self.make_key(model, task_type, text)
+        with self._lock:
+            self._remember(key, _array.array('f', vec))
+            if self._conn is None:
+                return
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO embed_cache (key, model, dim, vec, last_used) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, model, len(vec), self._pack(vec), time.time())
                 )
-                if upcoming:
-                    lines.append("## 直近24時間の配信予定（JST）")
-                    for s in upcoming:
-                        jst = s.scheduled_at + timedelta(hours=9)
-                        collab = f"(コラボ{s.collab_count}人)" if s.is_collab else ""
-                        lines.append(f"- {jst.strftime('%m/%d %H:%M')} {s.member_name} {collab}")
-                    lines.append("")
+                self._conn.commit()
+                self._puts_since_prune += 1
+                if self._puts_since_prune >= 500:
+                    self._puts_since_prune = 0
+                    self._prune()
+            except Exception as e:
+                logger.debug(f"Embeddingキャッシュ書込エラー: {e}")
 
-        except Exception as e:
-            logger.error(f"❌ ドキュメント生成中にDBエラー: {e}")
+    def _prune(self):
+        """ディスク側が上限を超えたら最終利用が古い順に削る"""
+        self._flush_touched()
+        count = self._conn.execute("SELECT COUNT(*) FROM embed_cache").fetchone()[0]
+        if count <= self._disk_max:
+            return
+        self._conn.execute(
+            "DELETE FROM embed_cache WHERE key IN ("
+            " SELECT key FROM embed_cache ORDER BY last_used ASC LIMIT ?)",
+            (count - self._disk_max,)
+        )
+        self._conn.commit()
+        logger.info(f"🗑️ Embeddingキャッシュ: {count - self._disk_max}件削除")
 
-        return "\n".join(lines)
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            disk_count = 0
+            if self._conn is not None:
+                try:
+                    disk_count = self._conn.execute("SELECT COUNT(*) FROM embed_cache").fetchone()[0]
+                except Exception:
+                    pass
+            return {
+                'memory_entries': len(self._mem),
+                'disk_entries': disk_count,
+                'hits_memory': self.hits_mem,
+                'hits_disk': self.hits_disk,
+                'misses': self.misses,
+            }
 
+embedding_cache = EmbeddingCache()
+
+
+@single_flight(normalize=False)
+def embed_text_cached(text: str, task_type: str = 'retrieval_document') -> Optional[List[float]]:
+    """
+    Gemini Embedding をキャッシュ経由で取得する。
+    キャッシュに無い場合だけAPIを呼び、結果をメモリ/ディスク両方に保存する。
+    失敗時は None。
+    """
+    if not text:
+        return None
+    content = text[:EMBEDDING_MAX_CHARS]
+    vec = embedding_cache.get(EMBEDDING_MODEL, content, task_type)
+    if vec is not None:
+        return vec
+    if not GEMINI_API_KEY:
+        return None
+    result = transport_embed_content(
+        model=EMBEDDING_MODEL,
+        content=content,
+        task_type=task_type
+    )
+    vec = result['embedding']
+    embedding_cache.put(EMBEDDING_MODEL, content, vec, task_type)
+    return vec
+
+
+def embed_texts_cached(texts: List[str], task_type: str = 'retrieval_document') -> List[Optional[List[float]]]:
+    """
+    embed_text_cached のバッチ版。キャッシュに無いものだけを
+    EMBEDDING_BATCH_MAX 件ずつまとめて1リクエストで埋め込む。
+    """
+    contents = [(t or '')[:EMBEDDING_MAX_CHARS] for t in texts]
+    out: List[Optional[List[float]]] = [None] * len(contents)
+    misses = []
+    for i, c in enumerate(contents):
+        if not c:
+            continue
+        vec = embedding_cache.get(EMBEDDING_MODEL, c, task_type)
+        if vec is not None:
+            out[i] = vec
+        else:
+            misses.append(i)
+    if not misses or not GEMINI_API_KEY:
+        return out
+    for start in range(0, len(misses), EMBEDDING_BATCH_MAX):
+        part = misses[start:start + EMBEDDING_BATCH_MAX]
+        result = transport_embed_content(
+            model=EMBEDDING_MODEL,
+            content=[contents[i] for i in part],
+            task_type=task_type
+        )
+        for i, vec in zip(part, result['embedding']):
+            embedding_cache.put(EMBEDDING_MODEL, contents[i], vec, task_type)
+            out[i] = vec
+    return out
 
-mochiko_knowledge_file = MochikoKnowledgeFile()
 
 # ==============================================================================
-# ★ Memvid風RAGシステム
+# ★ Embeddingバックエンド (Gemini / ローカル文字n-gram)
 # ==============================================================================
-class MemvidRAG:
+# GEMINI_API_KEY 未設定やEmbeddingのレート制限時に意味検索が全滅する問題への対策。
+# EMBEDDING_BACKEND:
+#   'gemini' - Gemini text-embedding-004 のみ
+#   'local'  - ローカル文字n-gram (CPUのみ・決定的・ネットワーク不要)
+#   'auto'   - Gemini優先、使えない時はローカルへ自動フォールバック (デフォルト)
+# ベクトルは必ずバックエンドのタグ付きで保存し、異なる空間のベクトルを混ぜない。
+# そのため 'auto' でGeminiが落ちている間のクエリはローカルのベクトルとしか照合できない。
+# maintain_local_embeddings (定期タスク) が Gemini で保存された行のローカル版を並べて保存しておき、
+# フォールバック中もコーパス全体を検索できるようにする ('gemini' 設定では作らない)。
+# ローカルのIDF学習も同じタスクで行い (リクエストスレッドでは学習しない)、指紋が変わったら
+# 旧指紋のベクトルを埋め込み直す。
+EMBEDDING_BACKEND = os.environ.get('EMBEDDING_BACKEND', 'auto').strip().lower()
+GEMINI_EMBED_COOLDOWN_SECONDS = 120
+LOCAL_EMBED_VERSION = 'local-ngram-v1'
+LOCAL_EMBED_DIM = 256
+LOCAL_EMBED_BUCKETS = 1 << 16            # 文字n-gramのハッシュ空間
+LOCAL_EMBED_NGRAMS = (1, 2, 3)
+LOCAL_EMBED_NNZ = 4                      # スパースランダム射影: 1特徴あたりの射影先次元数
+LOCAL_EMBED_SEED = 33
+LOCAL_IDF_MIN_DOCS = 50                  # これ未満のコーパスではIDFを学習しない
+LOCAL_MAINTAIN_BATCH = 256               # maintain_local_embeddings が1回に(再)埋め込みする行数 (テーブルごと)
+
+
+class EmbeddingBackend:
+    """Embeddingバックエンドの共通インターフェース"""
+    name = 'base'
+
+    def tag(self) -> str:
+        """保存ベクトルに付けるタグ (同じタグ同士でのみ類似度を計算する)"""
+        return self.name
+
+    def is_available(self) -> bool:
+        return True
+
+    def embed(self, text: str, task_type: str = 'retrieval_document') -> Optional[List[float]]:
+        raise NotImplementedError
+
+    def embed_batch(self, texts: List[str], task_type: str = 'retrieval_document') -> List[Optional[List[float]]]:
+        return [self.embed(t, task_type=task_type) for t in texts]
+
+
+class GeminiEmbeddingBackend(EmbeddingBackend):
+    """Gemini text-embedding-004 (永続キャッシュ経由)"""
+    name = 'gemini'
+
+    def __init__(self):
+        self._limited_until = 0.0
+
+    def tag(self) -> str:
+        # 既存データ (タグ無し) はすべてこのモデルで作られている
+        return EMBEDDING_MODEL
+
+    def is_available(self) -> bool:
+        return bool(GEMINI_API_KEY) and time.time() >= self._limited_until
+
+    def _note_error(self, e: Exception):
+        err = str(e).lower()
+        if '429' in err or 'quota' in err or 'rate' in err or 'exhausted' in err:
+            self._limited_until = time.time() + GEMINI_EMBED_COOLDOWN_SECONDS
+            logger.warning(f"⚠️ Gemini Embedding制限 → {GEMINI_EMBED_COOLDOWN_SECONDS}秒ローカルへ切替")
+
+    def embed(self, text: str, task_type: str = 'retrieval_document') -> Optional[List[float]]:
+        try:
+            return embed_text_cached(text, task_type=task_type)
+        except Exception as e:
+            self._note_error(e)
+            raise
+
+    def embed_batch(self, texts: List[str], task_type: str = 'retrieval_document') -> List[Optional[List[float]]]:
+        try:
+            return embed_texts_cached(texts, task_type=task_type)
+        except Exception as e:
+            self._note_error(e)
+            raise
+
+
+class LocalNgramEmbeddingBackend(EmbeddingBackend):
     """
-    Memvidの設計思想をPostgreSQL + Gemini Embeddingで再現するRAGシステム。
-    
-    Memvidとの対応:
-      MemvidEncoder.add_text()  →  add_chunks()
-      MemvidEncoder.build()     →  build_index() (PostgreSQLへの保存)
-      MemvidRetriever.search()  →  search()
-    
-    永続化: .mp4/.json の代わりに memvid_embeddings テーブルを使用。
-    Renderフリープランでも再起動後もデータが残る。
+    ハッシュ化文字n-gram + TF-IDF重み + スパースランダム射影 (NumPy)。
+    分かち書き不要なので日本語に向き、同じテキストからは常に同じベクトルが出る。
+    IDF は DB のコーパスから一度だけ学習して embedding_backend_state に保存し、
+    以後は固定する (タグに指紋を含めるので、学習し直しても古いベクトルと混ざらない)。
+    起動時は load_idf() で保存済みの値を読むだけで、学習は ensure_fitted() (定期タスク) が行う。
     """
-    
-    _instance = None
-    _lock = RLock()
-    
-    @classmethod
-    def get_instance(cls):
-        with cls._lock:
-            if cls._instance is None:
-                cls._instance = cls()
-            return cls._instance
-    
+    name = LOCAL_EMBED_VERSION
+
     def __init__(self):
-        self._embed_lock = RLock()
-        self._cache = {}  # {content_hash: embedding}
-        self._cache_max = 500
-    
-    def _get_embedding(self, text: str) -> Optional[List[float]]:
-        """Gemini Embedding APIでテキストをベクトル化 (768次元)"""
-        if not GEMINI_API_KEY or not HAS_NUMPY:
+        self._lock = RLock()
+        self._idf = np.ones(LOCAL_EMBED_BUCKETS, dtype=np.float32)
+        self._fingerprint = 'uniform'
+        self._idf_ready = False
+        rng = np.random.default_rng(LOCAL_EMBED_SEED)
+        self._proj_dims = rng.integers(
+            0, LOCAL_EMBED_DIM, size=(LOCAL_EMBED_BUCKETS, LOCAL_EMBED_NNZ), dtype=np.int32
+        )
+        self._proj_signs = rng.choice(
+            np.array([-1.0, 1.0], dtype=np.float32), size=(LOCAL_EMBED_BUCKETS, LOCAL_EMBED_NNZ)
+        )
+
+    def tag(self) -> str:
+        return f"{LOCAL_EMBED_VERSION}:{self._fingerprint}"
+
+    def is_available(self) -> bool:
+        return HAS_NUMPY
+
+    @staticmethod
+    def _normalize(text: str) -> str:
+        return re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', text or '')).strip().lower()
+
+    def _features(self, text: str):
+        """(ユニークなバケット番号配列, 出現回数配列) を返す"""
+        t = self._normalize(text)
+        buckets = []
+        mask = LOCAL_EMBED_BUCKETS - 1
+        for n in LOCAL_EMBED_NGRAMS:
+            for i in range(len(t) - n + 1):
+                gram = t[i:i + n]
+                if gram.isspace():
+                    continue
+                buckets.append(zlib.crc32(f"{n}:{gram}".encode('utf-8')) & mask)
+        if not buckets:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return np.unique(np.asarray(buckets, dtype=np.int64), return_counts=True)
+
+    def embed(self, text: str, task_type: str = 'retrieval_document') -> Optional[List[float]]:
+        if not HAS_NUMPY or not text:
             return None
-        
-        import hashlib
-        cache_key = hashlib.md5(text[:200].encode()).hexdigest()
-        with self._embed_lock:
-            if cache_key in self._cache:
-                return self._cache[cache_key]
-        
-        try:
-            result = genai.embed_content(
-                model='models/text-embedding-004',
-                content=text[:2000],
-                task_type='retrieval_document'
-            )
-            vec = result['embedding']
-            with self._embed_lock:
-                if len(self._cache) >= self._cache_max:
-                    # LRU簡易実装: 古いものを半分削除
-                    keys = list(self._cache.keys())
-                    for k in keys[:len(keys)//2]:
-                        del self._cache[k]
-                self._cache[cache_key] = vec
-            return vec
-        except Exception as e:
-            logger.debug(f"Memvid Embedding エラー: {e}")
+        idf = self._idf
+        idx, counts = self._features(text[:EMBEDDING_MAX_CHARS])
+        if idx.size == 0:
             return None
-    
-    def _cosine_similarity(self, a: List[float], b: List[float]) -> float:
-        """コサイン類似度 (numpy使用)"""
-        if not HAS_NUMPY:
-            return 0.0
-        va = np.array(a, dtype=np.float32)
-        vb = np.array(b, dtype=np.float32)
-        norm_a = np.linalg.norm(va)
-        norm_b = np.linalg.norm(vb)
-        if norm_a == 0 or norm_b == 0:
-            return 0.0
-        return float(np.dot(va, vb) / (norm_a * norm_b))
-    
-    def add_chunks(self, chunks: List[Dict], chunk_type: str, user_uuid: str = None):
-        """
-        チャンクをPostgreSQLに保存 (Memvid: MemvidEncoder.add_text相当)
-        chunks: [{'content': str, 'source_id': int}]
-        """
+        weights = (1.0 + np.log(counts)).astype(np.float32) * idf[idx]
+        vec = np.zeros(LOCAL_EMBED_DIM, dtype=np.float32)
+        np.add.at(
+            vec,
+            self._proj_dims[idx].ravel(),
+            (self._proj_signs[idx] * weights[:, None]).ravel()
+        )
+        norm = float(np.linalg.norm(vec))
+        if norm == 0.0:
+            return None
+        return (vec / norm).tolist()
+
+    # ----- IDF 学習 / 永続化 -----
+    def _apply_df(self, n_docs: int, df: Dict[int, int]):
+        idf = np.full(LOCAL_EMBED_BUCKETS, np.log((n_docs + 1) / 1.0) + 1.0, dtype=np.float32)
+        if df:
+            keys = np.fromiter(df.keys(), dtype=np.int64)
+            vals = np.fromiter(df.values(), dtype=np.float32)
+            idf[keys] = np.log((n_docs + 1) / (vals + 1.0)) + 1.0
+        self._idf = idf
+        digest = hashlib.sha1(json.dumps([n_docs, sorted(df.items())]).encode()).hexdigest()
+        self._fingerprint = digest[:8]
+        self._idf_ready = True
+
+    def load_idf(self) -> bool:
+        """保存済みのIDFを読み込む (起動時に呼ぶ。無ければ均一IDFのまま動き、学習はしない)"""
         if not Session:
-            return 0
-        
-        saved = 0
-        for chunk in chunks:
-            content = chunk.get('content', '').strip()
-            if not content or len(content) < 10:
-                continue
-            
-            vec = self._get_embedding(content)
-            vec_json = json.dumps(vec) if vec else None
-            
+            return False
+        try:
+            with get_db_session() as session:
+                state = session.query(EmbeddingBackendState).filter_by(
+                    backend=LOCAL_EMBED_VERSION
+                ).first()
+                if not state or not state.params_json:
+                    return False
+                params = json.loads(state.params_json)
+            with self._lock:
+                self._apply_df(params['n_docs'], {int(k): v for k, v in params['df'].items()})
+            logger.info(f"✅ ローカルEmbedding IDFロード: {params['n_docs']}文書 ({self._fingerprint})")
+            return True
+        except Exception as e:
+            logger.warning(f"⚠️ ローカルEmbedding IDFロード失敗: {e}")
+            return False
+
+    def ensure_fitted(self) -> bool:
+        """IDFが未学習ならDBから学習する (DB全体を読むので定期タスクからのみ呼ぶ)"""
+        if self._idf_ready:
+            return True
+        with self._lock:
+            if self._idf_ready or self.load_idf():
+                return True
             try:
-                with get_db_session() as session:
-                    entry = MemvidEmbedding(
-                        chunk_type=chunk_type,
-                        source_id=chunk.get('source_id'),
-                        user_uuid=user_uuid,
-                        content=content[:2000],
-                        embedding_json=vec_json,
-                        embedding_dim=len(vec) if vec else 768,
+                return self.fit_from_db()
+            except Exception as e:
+                logger.warning(f"⚠️ ローカルEmbedding IDF学習失敗: {e}")
+                return False
+
+    def fit_from_db(self) -> bool:
+        """DBのニュース・Wiki・会話からIDFを学習して保存する"""
+        texts: List[str] = []
+        with get_db_session() as session:
+            for n in session.query(HololiveNews).order_by(HololiveNews.created_at.desc()).limit(300).all():
+                texts.append(f"{n.title}\n{n.content or ''}")
+            for w in session.query(HolomemWiki).all():
+                texts.append(f"{w.member_name}\n{w.description or ''}\n{w.episodes or ''}")
+            for h in session.query(ConversationHistory.content).filter(
+                ConversationHistory.role == 'user'
+            ).order_by(ConversationHistory.timestamp.desc()).limit(1000).all():
+                texts.append(h.content or '')
+        texts = [t for t in texts if t and t.strip()]
+        if len(texts) < LOCAL_IDF_MIN_DOCS:
+            logger.info(f"ℹ️ ローカルEmbedding: コーパス不足({len(texts)}件) → IDFなしで動作")
+            return False
+
+        df: Dict[int, int] = defaultdict(int)
+        for t in texts:
+            idx, _ = self._features(t[:EMBEDDING_MAX_CHARS])
+            for b in idx.tolist():
+                df[b] += 1
+        df = dict(df)
+        self._apply_df(len(texts), df)
+        with get_db_session() as session:
+            state = session.query(EmbeddingBackendState).filter_by(backend=LOCAL_EMBED_VERSION).first()
+            if not state:
+                state = EmbeddingBackendState(backend=LOCAL_EMBED_VERSION)
+                session.add(state)
+            state.params_json = json.dumps({'n_docs': len(texts), 'df': df})
+            state.updated_at = datetime.utcnow()
+        logger.info(f"✅ ローカルEmbedding IDF学習: {len(texts)}文書 / {len(df)}特徴 ({self._fingerprint})")
+        return True
+
+
+gemini_embedding_backend = GeminiEmbeddingBackend()
+local_embedding_backend = LocalNgramEmbeddingBackend() if HAS_NUMPY else None
+
+
+def get_embedding_backends() -> List[EmbeddingBackend]:
+    """EMBEDDING_BACKEND 設定に従って試行順のバックエンド一覧を返す"""
+    if EMBEDDING_BACKEND == 'local':
+        candidates = [local_embedding_backend]
+    elif EMBEDDING_BACKEND == 'gemini':
+        candidates = [gemini_embedding_backend]
+    else:
+        candidates = [gemini_embedding_backend, local_embedding_backend]
+    return [b for b in candidates if b is not None]
+
+
+def embed_text(text: str, task_type: str = 'retrieval_document') -> Tuple[Optional[List[float]], Optional[str]]:
+    """
+    設定されたバックエンドでテキストをベクトル化する。
+    戻り値: (ベクトル, バックエンドタグ)。全滅時は (None, None)。
+    """
+    if not text:
+        return None, None
+    for backend in get_embedding_backends():
+        if not backend.is_available():
+            continue
+        try:
+            vec = backend.embed(text, task_type=task_type)
+        except Exception as e:
+            logger.debug(f"Embedding({backend.name}) エラー: {e}")
+            continue
+        if vec:
+            return vec, backend.tag()
+    return None, None
+
+
+def embed_texts(texts: List[str], task_type: str = 'retrieval_document') -> Tuple[List[Optional[List[float]]], Optional[str]]:
+    """
+    embed_text のバッチ版。1つのバッチは必ず同じバックエンドで埋め込む
+    (途中でフォールバックすると同じ文書のチャンクが別空間に分かれるため)。
+    戻り値: (ベクトルのリスト, バックエンドタグ)。全滅時は ([None...], None)。
+    """
+    if not texts:
+        return [], None
+    for backend in get_embedding_backends():
+        if not backend.is_available():
+            continue
+        try:
+            vecs = backend.embed_batch(texts, task_type=task_type)
+        except Exception as e:
+            logger.debug(f"Embedding({backend.name}) バッチエラー: {e}")
+            continue
+        if any(vecs):
+            return vecs, backend.tag()
+    return [None] * len(texts), None
+
+
+def embedding_backend_filter(column, backend_tag: str):
+    """保存ベクトルをクエリと同じバックエンドのものに絞るSQL条件 (タグ無しの旧データはGemini扱い)"""
+    if backend_tag == EMBEDDING_MODEL:
+        return or_(column == backend_tag, column.is_(None))
+    return column == backend_tag
+
+
+# ==============================================================================
+# ★ 文単位チャンカー (長文を重なり付きの窓に分割)
+# ==============================================================================
+# 長いWiki・ニュース本文・教わったURLを先頭2000文字で切るのではなく、
+# 文境界 (。！？ / 改行) で区切った窓ごとに埋め込み、関連する段落そのものを返せるようにする。
+MEMVID_CHUNK_TOKENS = 200          # 1チャンクの目安トークン数
+MEMVID_CHUNK_OVERLAP_TOKENS = 40   # 前チャンク末尾から持ち越す量
+MEMVID_CHUNK_MAX_PER_DOC = 24      # 1文書あたりの上限 (巨大文書でEmbeddingを食い潰さない)
+MEMVID_EMBED_BATCH = 32            # add_chunks が一度に埋め込むチャンク数
+
+_SENTENCE_RE = re.compile(r'[^。！？!?\n]+(?:[。！？!?]+[」』）)\]]*)?|[。！？!?]+')
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の概算 (日本語は1文字≒1トークン、ASCIIは4文字≒1トークン)"""
+    if not text:
+        return 0
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+def _iter_sentences(text: str, max_tokens: int) -> Iterator[Tuple[str, int]]:
+    """(文, 推定トークン数) を順に返す。max_tokens を超える文は文字数で強制分割する"""
+    for m in _SENTENCE_RE.finditer(text or ''):
+        sent = m.group(0).strip()
+        if not sent:
+            continue
+        tokens = estimate_tokens(sent)
+        if tokens <= max_tokens:
+            yield sent, tokens
+            continue
+        step = max(1, len(sent) * max_tokens // tokens)
+        for i in range(0, len(sent), step):
+            piece = sent[i:i + step]
+            yield piece, estimate_tokens(piece)
+
+
+def _join_sentences(sentences: List[str]) -> str:
+    out = ''
+    for sent in sentences:
+        if out and out[-1].isascii() and out[-1].isalnum() and sent[0].isascii():
+            out += ' '
+        out += sent
+    return out
+
+
+def iter_sentence_chunks(text: str, target_tokens: int = MEMVID_CHUNK_TOKENS,
+                         overlap_tokens: int = MEMVID_CHUNK_OVERLAP_TOKENS,
+                         max_chunks: int = MEMVID_CHUNK_MAX_PER_DOC) -> Iterator[str]:
+    """
+    文境界で区切った重なり付きの窓を遅延生成する。
+    窓が target_tokens を超えそうになったら出力し、末尾から overlap_tokens 分の文を次の窓へ持ち越す。
+    """
+    window: List[Tuple[str, int]] = []
+    window_tokens = 0
+    fresh = 0       # 前回出力以降に追加した文の数 (持ち越し分だけの窓は出さない)
+    emitted = 0
+    for sent, tokens in _iter_sentences(text, target_tokens):
+        if window and window_tokens + tokens > target_tokens:
+            yield _join_sentences([s for s, _ in window])
+            emitted += 1
+            if emitted >= max_chunks:
+                return
+            tail: List[Tuple[str, int]] = []
+            tail_tokens = 0
+            for s, t in reversed(window):
+                if tail_tokens + t > overlap_tokens:
+                    break
+                tail.insert(0, (s, t))
+                tail_tokens += t
+            window, window_tokens, fresh = tail, tail_tokens, 0
+        window.append((sent, tokens))
+        window_tokens += tokens
+        fresh += 1
+    if window and fresh:
+        yield _join_sentences([s for s, _ in window])
+
+
+# ==============================================================================
+# ★ Memvid ベクトル索引 (メモリ常駐の検索行列、int8量子化オプション)
+# ==============================================================================
+# 毎回DBから直近500件を読んでJSONを解析する代わりに、全チャンクのベクトルを
+# バックエンドタグごとの行列としてメモリに持ち、行列積で一括スコアリングする。
+# MEMVID_VECTOR_QUANT:
+#   'int8'    - 1行ごとのスケール付きint8 (float32の約1/4のメモリ) で候補を絞り、
+#               上位 top_k*MEMVID_RESCORE_FACTOR 件だけDBのfloat32ベクトルで再スコア (デフォルト)
+#   'float32' - そのまま保持して厳密スコア
+# 索引は id の透かしで差分取り込みし、件数がずれた時だけ削除行を落とす。
+MEMVID_VECTOR_QUANT = os.environ.get('MEMVID_VECTOR_QUANT', 'int8').lower()
+MEMVID_INDEX_REFRESH_SECONDS = 30
+MEMVID_RESCORE_FACTOR = 4
+MEMVID_SCORE_BLOCK_ROWS = 4096     # int8→float32 変換を一度に行う行数 (一時メモリの上限)
+MEMVID_LOAD_BLOCK_ROWS = 1000      # DBから取り込む時に一度に配列化する行数 (初回全件ロード時のピークメモリ)
+# 再起動 (Renderのスリープ復帰) 時にJSONを全件解析し直さないためのスナップショット。
+# 行列は保持形式 (int8 / float32) のまま .npy で書き、起動時は np.load(mmap_mode='r') で
+# 読むだけなので即座に検索でき、透かしより新しい行だけをDBから追加で取り込む。
+MEMVID_SNAPSHOT_DIR = os.environ.get('MEMVID_SNAPSHOT_DIR', '/tmp/mochiko_memvid_snapshot')
+MEMVID_SNAPSHOT_VERSION = 1
+
+
+def quantize_int8(mat: 'np.ndarray') -> Tuple['np.ndarray', 'np.ndarray']:
+    """行ごとに max|v| を127に合わせて int8 化する。戻り値: (codes, scales)"""
+    scales = np.abs(mat).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(mat / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def int8_scores(codes: 'np.ndarray', scales: 'np.ndarray', q: 'np.ndarray') -> 'np.ndarray':
+    """int8行列とクエリの内積 (ブロックごとにfloat32へ戻すので一時メモリは一定)"""
+    out = np.empty(codes.shape[0], dtype=np.float32)
+    for start in range(0, codes.shape[0], MEMVID_SCORE_BLOCK_ROWS):
+        block = codes[start:start + MEMVID_SCORE_BLOCK_ROWS]
+        out[start:start + block.shape[0]] = block.astype(np.float32) @ q
+    return out * scales
+
+
+class MemvidVectorIndex:
+    """memvid_embeddings の検索用行列 (バックエンドタグごと)"""
+
+    SHARD_KEYS = ('ids', 'types', 'users', 'mat', 'scales')
+
+    def __init__(self, quant: str = MEMVID_VECTOR_QUANT):
+        self.quant = 'int8' if quant == 'int8' else 'float32'
+        self._lock = RLock()
+        self._refresh_lock = Lock()
+        self._shards: Dict[str, Dict[str, Any]] = {}
+        self._type_codes: Dict[str, int] = {}
+        self._user_codes: Dict[str, int] = {}
+        self._watermark = 0
+        self._skipped = 0           # 透かし以下で取り込めなかった行 (次元不一致・JSON破損)
+        self._checked_at = 0.0
+        self._version = 0           # 索引が変わるたびに増える (スナップショット要否の判定)
+        self._saved_version = -1
+
+    def mark_dirty(self):
+        """追加・削除直後の検索で索引を取り込み直させる"""
+        self._checked_at = 0.0
+
+    def _code(self, table: Dict[str, int], key: Optional[str]) -> int:
+        if key is None:
+            return -1
+        if key not in table:
+            table[key] = len(table)
+        return table[key]
+
+    def _append(self, tag: str, ids, types, users, vecs):
+        mat = np.asarray(vecs, dtype=np.float32)
+        norms = np.linalg.norm(mat, axis=1)
+        norms[norms == 0] = 1.0
+        mat /= norms[:, None]
+        part = {
+            'ids': np.asarray(ids, dtype=np.int64),
+            'types': np.asarray([self._code(self._type_codes, t) for t in types], dtype=np.int16),
+            'users': np.asarray([self._code(self._user_codes, u) for u in users], dtype=np.int32),
+        }
+        if self.quant == 'int8':
+            part['mat'], part['scales'] = quantize_int8(mat)
+        else:
+            part['mat'] = mat
+        self._version += 1
+        shard = self._shards.get(tag)
+        if shard is None:
+            self._shards[tag] = part
+            return
+        # スナップショット由来の memmap もここで通常の配列になる
+        for key, arr in part.items():
+            shard[key] = np.concatenate([shard[key], arr])
+
+    def _drop_deleted(self, live_ids: 'np.ndarray'):
+        for tag, shard in list(self._shards.items()):
+            keep = np.isin(shard['ids'], live_ids)
+            if keep.all():
+                continue
+            self._version += 1
+            for key in list(shard):
+                shard[key] = shard[key][keep]
+            if shard['ids'].size == 0:
+                del self._shards[tag]
+
+    def size(self) -> int:
+        return sum(int(sh['ids'].size) for sh in self._shards.values())
+
+    def refresh(self, force: bool = False):
+        """
+        透かしより新しい行を取り込み、削除された行を落とす。
+        DB読み込み中も検索は既存の行列で続けられるよう、ロックは反映時だけ取る。
+        MEMVID_LOAD_BLOCK_ROWS 行ごとに float32 配列にして反映するので、
+        スナップショットなしの初回起動でも全件を Python の float リストで抱えない。
+        """
+        if not Session or not HAS_NUMPY:
+            return
+        if not force and time.time() - self._checked_at < MEMVID_INDEX_REFRESH_SECONDS:
+            return
+        if not self._refresh_lock.acquire(blocking=False):
+            return  # 他スレッドが取り込み中 → 今ある索引で検索する
+        try:
+            self._checked_at = time.time()
+            watermark = self._watermark
+            dims = {tag: sh['mat'].shape[1] for tag, sh in self._shards.items()}
+            pending: Dict[str, Tuple[list, list, list, list]] = defaultdict(lambda: ([], [], [], []))
+            skipped = 0
+            read = 0
+            added = 0
+
+            def flush():
+                # 1ブロック分を反映し、透かしも同時に進める (途中で失敗しても二重取り込みしない)
+                nonlocal skipped, added
+                with self._lock:
+                    for tag, (ids, types, users, vecs) in pending.items():
+                        if ids:
+                            self._append(tag, ids, types, users, np.stack(vecs))
+                            added += len(ids)
+                    self._watermark = watermark
+                    self._skipped += skipped
+                pending.clear()
+                skipped = 0
+
+            with get_db_session() as session:
+                rows = session.query(
+                    MemvidEmbedding.id, MemvidEmbedding.chunk_type, MemvidEmbedding.user_uuid,
+                    MemvidEmbedding.embedding_backend, MemvidEmbedding.embedding_json
+                ).filter(
+                    MemvidEmbedding.id > watermark,
+                    MemvidEmbedding.embedding_json.isnot(None)
+                ).order_by(MemvidEmbedding.id).yield_per(MEMVID_LOAD_BLOCK_ROWS)
+                for r in rows:
+                    if read and read % MEMVID_LOAD_BLOCK_ROWS == 0:
+                        flush()
+                    read += 1
+                    watermark = max(watermark, r.id)
+                    try:
+                        vec = np.asarray(json.loads(r.embedding_json), dtype=np.float32)
+                        if vec.ndim != 1:
+                            raise ValueError('not a vector')
+                    except Exception:
+                        skipped += 1
+                        continue
+                    tag = r.embedding_backend or EMBEDDING_MODEL
+                    dim = dims.setdefault(tag, len(vec))
+                    if len(vec) != dim:
+                        skipped += 1
+                        continue
+                    ids, types, users, vecs = pending[tag]
+                    ids.append(r.id)
+                    types.append(r.chunk_type)
+                    users.append(r.user_uuid)
+                    vecs.append(vec)
+
+                flush()
+                with self._lock:
+                    expected = self.size() + self._skipped
+
+                # 削除検出: 透かし以下の件数が索引と合わない時だけ id 一覧を照合する
+                db_count = session.query(MemvidEmbedding.id).filter(
+                    MemvidEmbedding.id <= watermark,
+                    MemvidEmbedding.embedding_json.isnot(None)
+                ).count()
+                if db_count != expected:
+                    live_ids = np.fromiter(
+                        (r.id for r in session.query(MemvidEmbedding.id).filter(
+                            MemvidEmbedding.id <= watermark,
+                            MemvidEmbedding.embedding_json.isnot(None)
+                        )),
+                        dtype=np.int64
                     )
-                    session.add(entry)
-                saved += 1
+                    with self._lock:
+                        self._drop_deleted(live_ids)
+                        self._skipped = max(0, db_count - self.size())
+            if added > 100:
+                logger.info(f"📦 Memvid索引: +{added}件 (計{self.size()}件, {self.quant})")
+        except Exception as e:
+            logger.warning(f"⚠️ Memvid索引の更新失敗: {e}")
+        finally:
+            self._refresh_lock.release()
+
+    # ----- スナップショット -----
+    def save_snapshot(self, directory: str = MEMVID_SNAPSHOT_DIR, refresh: bool = True) -> bool:
+        """
+        DBの最新分を取り込んだ上で、前回保存から変化があれば行列とメタデータを書き出す。
+        世代番号付きのファイルを書いてから manifest.json を置き換えるので、
+        書き込み途中で落ちても前の世代がそのまま読める。
+        """
+        if not HAS_NUMPY:
+            return False
+        if refresh:
+            self.refresh(force=True)
+        with self._lock:
+            if self._version == self._saved_version or not self._shards:
+                return False
+            # 配列はその場で書き換えない (追加・削除は新しい配列を作る) ので参照だけ持ち出せばよい
+            shards = {tag: dict(sh) for tag, sh in self._shards.items()}
+            version = self._version
+            manifest = {
+                'format': MEMVID_SNAPSHOT_VERSION,
+                'quant': self.quant,
+                'watermark': self._watermark,
+                'skipped': self._skipped,
+                'type_codes': dict(self._type_codes),
+                'user_codes': dict(self._user_codes),
+                'shards': [],
+            }
+        try:
+            os.makedirs(directory, exist_ok=True)
+            generation = str(int(time.time() * 1000))
+            manifest['generation'] = generation
+            for i, (tag, sh) in enumerate(shards.items()):
+                files = {}
+                for key, arr in sh.items():
+                    fname = f"{generation}_{i}_{key}.npy"
+                    np.save(os.path.join(directory, fname), np.ascontiguousarray(arr))
+                    files[key] = fname
+                manifest['shards'].append({'tag': tag, 'files': files})
+            tmp_path = os.path.join(directory, 'manifest.json.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False)
+            os.replace(tmp_path, os.path.join(directory, 'manifest.json'))
+            for fname in os.listdir(directory):
+                if fname.endswith('.npy') and not fname.startswith(f"{generation}_"):
+                    try:
+                        os.remove(os.path.join(directory, fname))
+                    except OSError:
+                        pass
+            self._saved_version = version
+            logger.info(f"💾 Memvid索引スナップショット保存: {sum(int(sh['ids'].size) for sh in shards.values())}件 (透かし{manifest['watermark']})")
+            return True
+        except Exception as e:
+            logger.warning(f"⚠️ Memvid索引スナップショット保存失敗: {e}")
+            return False
+
+    def load_snapshot(self, directory: str = MEMVID_SNAPSHOT_DIR) -> bool:
+        """スナップショットを memmap で読み込む。以後の refresh() は透かしより新しい行だけを取り込む"""
+        if not HAS_NUMPY:
+            return False
+        path = os.path.join(directory, 'manifest.json')
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path, encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get('format') != MEMVID_SNAPSHOT_VERSION or manifest.get('quant') != self.quant:
+                logger.info(f"ℹ️ Memvid索引スナップショットの形式が異なるため破棄 ({manifest.get('quant')})")
+                return False
+            shards = {}
+            for entry in manifest['shards']:
+                sh = {
+                    key: np.load(os.path.join(directory, fname), mmap_mode='r')
+                    for key, fname in entry['files'].items()
+                }
+                n = sh['ids'].shape[0]
+                if any(arr.shape[0] != n for arr in sh.values()):
+                    raise ValueError(f"行数不一致: {entry['tag']}")
+                shards[entry['tag']] = sh
+        except Exception as e:
+            logger.warning(f"⚠️ Memvid索引スナップショット読込失敗: {e}")
+            return False
+        with self._lock:
+            self._shards = shards
+            self._type_codes = manifest['type_codes']
+            self._user_codes = manifest['user_codes']
+            self._watermark = manifest['watermark']
+            self._skipped = manifest.get('skipped', 0)
+            self._version += 1
+            self._saved_version = self._version
+            # 直後の検索はスナップショットだけで答え、差分は refresh(force=True) で取り込む
+            self._checked_at = time.time()
+        logger.info(f"⚡ Memvid索引スナップショット読込: {self.size()}件 (透かし{self._watermark})")
+        return True
+
+    def candidates(self, query_vec: List[float], backend_tag: str, limit: int,
+                   chunk_types: Optional[List[str]] = None,
+                   exclude_chunk_types: Optional[List[str]] = None,
+                   user_uuid: Optional[str] = None) -> List[Tuple[int, float]]:
+        """スコア上位 limit 件の (memvid_embeddings.id, 近似スコア) を返す"""
+        self.refresh()
+        with self._lock:
+            shard = self._shards.get(backend_tag)
+            if shard is None:
+                return []
+            q = np.asarray(query_vec, dtype=np.float32)
+            if q.shape[0] != shard['mat'].shape[1]:
+                return []
+            norm = float(np.linalg.norm(q))
+            if norm == 0.0:
+                return []
+            q /= norm
+
+            mask = np.ones(shard['ids'].size, dtype=bool)
+            if chunk_types:
+                codes = [self._type_codes[t] for t in chunk_types if t in self._type_codes]
+                mask &= np.isin(shard['types'], codes)
+            if exclude_chunk_types:
+                codes = [self._type_codes[t] for t in exclude_chunk_types if t in self._type_codes]
+                mask &= ~np.isin(shard['types'], codes)
+            if user_uuid:
+                mask &= shard['users'] == self._user_codes.get(user_uuid, -2)
+            rows = np.nonzero(mask)[0]
+            if rows.size == 0:
+                return []
+
+            if self.quant == 'int8':
+                scores = int8_scores(shard['mat'][rows], shard['scales'][rows], q)
+            else:
+                scores = shard['mat'][rows] @ q
+            if rows.size > limit:
+                top = np.argpartition(-scores, limit - 1)[:limit]
+            else:
+                top = np.arange(rows.size)
+            top = top[np.argsort(-scores[top])]
+            return [(int(shard['ids'][rows[i]]), float(scores[i])) for i in top]
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            shards = {}
+            for tag, sh in self._shards.items():
+                n, dim = sh['mat'].shape
+                shards[tag] = {
+                    'rows': int(n),
+                    'dim': int(dim),
+                    'bytes': int(sum(arr.nbytes for arr in sh.values())),
+                    'float32_bytes': int(n * dim * 4),
+                }
+            # skipped: 透かし以下で取り込めなかった行 (削除検出の件数照合でこの分を差し引く)
+            return {'quant': self.quant, 'rows': self.size(), 'skipped': self._skipped, 'shards': shards}
+
+
+memvid_vector_index = MemvidVectorIndex()
+
+MEMVID_BENCHMARK_MAX_ROWS = 5000   # ベンチマーク行列の上限 (768次元で約15MB)
+MEMVID_BENCHMARK_MAX_TOP_K = 50
+
+
+def benchmark_vector_quantization(n: int = MEMVID_BENCHMARK_MAX_ROWS, dim: int = 768, n_queries: int = 50,
+                                  top_k: int = 5, source: str = 'synthetic', seed: int = 0) -> Dict[str, Any]:
+    """
+    float32 厳密検索を正解として、int8のみ / int8+float32再スコア の recall@k と
+    行列メモリ・1クエリあたりの時間を比べる。
+    source='db' なら memvid_embeddings の実ベクトル (最新 n 件) を使う。
+    n は MEMVID_BENCHMARK_MAX_ROWS まで。
+    """
+    n = max(1, min(n, MEMVID_BENCHMARK_MAX_ROWS))
+    top_k = max(1, min(top_k, MEMVID_BENCHMARK_MAX_TOP_K))
+    rng = np.random.default_rng(seed)
+    if source == 'db' and Session:
+        # JSONを1行ずつ解析して確保済みの行列へ詰める (全行のリストを作らない)
+        mat = None
+        filled = 0
+        with get_db_session() as session:
+            rows = session.query(MemvidEmbedding.embedding_json).filter(
+                MemvidEmbedding.embedding_json.isnot(None)
+            ).order_by(MemvidEmbedding.id.desc()).limit(n).yield_per(500)
+            for r in rows:
+                try:
+                    vec = json.loads(r.embedding_json)
+                except Exception:
+                    continue
+                if mat is None:
+                    dim = len(vec)
+                    mat = np.empty((n, dim), dtype=np.float32)
+                if len(vec) != dim:
+                    continue
+                mat[filled] = vec
+                filled += 1
+        mat = mat[:filled] if mat is not None else np.empty((0, dim), dtype=np.float32)
+    else:
+        # 話題ごとにまとまった分布 (実データ同様、似たベクトルの塊がある)
+        centers = rng.standard_normal((max(n // 200, 8), dim), dtype=np.float32)
+        mat = centers[rng.integers(0, len(centers), n)]
+        mat += 0.6 * rng.standard_normal((n, dim), dtype=np.float32)
+    if mat.shape[0] < top_k * MEMVID_RESCORE_FACTOR:
+        return {'error': f'ベクトルが少なすぎます ({mat.shape[0]}件)'}
+    mat /= np.linalg.norm(mat, axis=1, keepdims=True)
+    queries = mat[rng.integers(0, mat.shape[0], n_queries)] + 0.3 * rng.standard_normal((n_queries, dim), dtype=np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    codes, scales = quantize_int8(mat)
+
+    def topk(scores, k):
+        idx = np.argpartition(-scores, k - 1)[:k]
+        return idx[np.argsort(-scores[idx])]
+
+    recall_raw = recall_rescored = 0.0
+    t_exact = t_int8 = 0.0
+    for q in queries:
+        t0 = time.perf_counter()
+        exact = set(topk(mat @ q, top_k).tolist())
+        t1 = time.perf_counter()
+        approx = int8_scores(codes, scales, q)
+        cand = topk(approx, top_k * MEMVID_RESCORE_FACTOR)
+        rescored = cand[topk(mat[cand] @ q, top_k)]
+        t2 = time.perf_counter()
+        recall_raw += len(exact & set(topk(approx, top_k).tolist())) / top_k
+        recall_rescored += len(exact & set(rescored.tolist())) / top_k
+        t_exact += t1 - t0
+        t_int8 += t2 - t1
+
+    return {
+        'source': source,
+        'rows': int(mat.shape[0]),
+        'dim': int(dim),
+        'top_k': top_k,
+        'rescore_factor': MEMVID_RESCORE_FACTOR,
+        'float32_mb': round(mat.nbytes / 1048576, 2),
+        'int8_mb': round((codes.nbytes + scales.nbytes) / 1048576, 2),
+        'recall_int8': round(recall_raw / n_queries, 4),
+        'recall_int8_rescored': round(recall_rescored / n_queries, 4),
+        'ms_per_query_float32': round(t_exact / n_queries * 1000, 3),
+        'ms_per_query_int8_rescored': round(t_int8 / n_queries * 1000, 3),
+    }
+
+
+# ==============================================================================
+# ★ Memvid風RAGシステム
+# ==============================================================================
+class MemvidRAG:
+    """
+    Memvidの設計思想をPostgreSQL + Gemini Embeddingで再現するRAGシステム。
+    
+    Memvidとの対応:
+      MemvidEncoder.add_text()  →  add_chunks()
+      MemvidEncoder.build()     →  build_index() (PostgreSQLへの保存)
+      MemvidRetriever.search()  →  search()
+    
+    永続化: .mp4/.json の代わりに memvid_embeddings テーブルを使用。
+    Renderフリープランでも再起動後もデータが残る。
+    """
+    
+    _instance = None
+    _lock = RLock()
+    
+    @classmethod
+    def get_instance(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+    
+    def __init__(self):
+        self._embed_lock = RLock()
+    
+    def _get_embedding(self, text: str) -> Tuple[Optional[List[float]], Optional[str]]:
+        """設定中のEmbeddingバックエンドでベクトル化。戻り値は (ベクトル, バックエンドタグ)"""
+        if not HAS_NUMPY:
+            return None, None
+        return embed_text(text, task_type='retrieval_document')
+    
+    def _cosine_similarity(self, a: List[float], b: List[float]) -> float:
+        """コサイン類似度 (numpy使用)"""
+        if not HAS_NUMPY:
+            return 0.0
+        va = np.array(a, dtype=np.float32)
+        vb = np.array(b, dtype=np.float32)
+        norm_a = np.linalg.norm(va)
+        norm_b = np.linalg.norm(vb)
+        if norm_a == 0 or norm_b == 0:
+            return 0.0
+        return float(np.dot(va, vb) / (norm_a * norm_b))
+    
+    @staticmethod
+    def _iter_chunk_pieces(chunks: List[Dict]) -> Iterator[Tuple[Dict, str]]:
+        """文書ごとに文単位チャンクへ分割し (元チャンク, 本文) を遅延生成する"""
+        for chunk in chunks:
+            body = (chunk.get('content') or '').strip()
+            if not body:
+                continue
+            header = (chunk.get('header') or '').strip()
+            for piece in iter_sentence_chunks(body):
+                content = f"{header}\n{piece}" if header and not piece.startswith(header) else piece
+                if len(content) >= 10:
+                    yield chunk, content
+    
+    def add_chunks(self, chunks: List[Dict], chunk_type: str, user_uuid: str = None):
+        """
+        チャンクをPostgreSQLに保存 (Memvid: MemvidEncoder.add_text相当)
+        chunks: [{'content': str, 'source_id': int, 'header'?: str, 'content_hash'?: str}]
+        長文は文単位の重なり付き窓に分割し、MEMVID_EMBED_BATCH 件ずつまとめて埋め込む。
+        header (タイトル等) は各窓の先頭に付けて、途中の段落でも何の文書か分かるようにする。
+        """
+        if not Session or not HAS_NUMPY:
+            return 0
+        
+        saved = 0
+        pieces = self._iter_chunk_pieces(chunks)
+        while True:
+            batch = list(islice(pieces, MEMVID_EMBED_BATCH))
+            if not batch:
+                break
+            vecs, backend_tag = embed_texts([content for _, content in batch], task_type='retrieval_document')
+            entries = [
+                MemvidEmbedding(
+                    chunk_type=chunk_type,
+                    source_id=chunk.get('source_id'),
+                    user_uuid=user_uuid,
+                    content=content[:2000],
+                    embedding_json=json.dumps(vec) if vec else None,
+                    embedding_dim=len(vec) if vec else 768,
+                    embedding_backend=backend_tag if vec else None,
+                    content_hash=chunk.get('content_hash'),
+                )
+                for (chunk, content), vec in zip(batch, vecs)
+            ]
+            try:
+                with get_db_session() as session:
+                    session.add_all(entries)
+                saved += len(entries)
             except Exception as e:
                 logger.debug(f"Memvid chunk保存エラー: {e}")
         
+        if saved:
+            memvid_vector_index.mark_dirty()
+        
         logger.info(f"📦 Memvid: {saved}チャンク保存 (type={chunk_type})")
         return saved
     
@@ -958,99 +3220,277 @@ class MemvidRAG:
         if not Session or not HAS_NUMPY:
             return []
         
-        query_vec = self._get_embedding(query)
+        query_vec, backend_tag = self._get_embedding(query)
         if not query_vec:
             return []
+        return self.search_by_vector(
+            query_vec, backend_tag,
+            chunk_types=[chunk_type] if chunk_type else None,
+            user_uuid=user_uuid, top_k=top_k, min_similarity=min_similarity
+        )
+    
+    def search_by_vector(self, query_vec: List[float], backend_tag: str,
+                         chunk_types: Optional[List[str]] = None, user_uuid: str = None,
+                         top_k: int = 5, min_similarity: float = 0.6,
+                         exclude_chunk_types: Optional[List[str]] = None) -> List[Dict]:
+        """
+        ベクトル化済みクエリで検索する (同じクエリで複数回検索する時にEmbeddingを使い回す)
+        メモリ常駐の memvid_vector_index で候補を絞り、int8 の場合は
+        候補の float32 ベクトルをDBから読んで再スコアする。
+        戻り値: search() と同じ形式
+        """
+        if not Session or not HAS_NUMPY or not query_vec:
+            return []
         
         try:
+            exact = memvid_vector_index.quant != 'int8'
+            cands = memvid_vector_index.candidates(
+                query_vec, backend_tag,
+                limit=top_k if exact else top_k * MEMVID_RESCORE_FACTOR,
+                chunk_types=chunk_types, exclude_chunk_types=exclude_chunk_types, user_uuid=user_uuid
+            )
+            if not cands:
+                return []
+            approx = dict(cands)
+            
             with get_db_session() as session:
-                q = session.query(MemvidEmbedding).filter(
-                    MemvidEmbedding.embedding_json.isnot(None)
-                )
-                if chunk_type:
-                    q = q.filter(MemvidEmbedding.chunk_type == chunk_type)
-                if user_uuid:
-                    q = q.filter(MemvidEmbedding.user_uuid == user_uuid)
-                
-                # 直近500件を対象に類似度計算 (大量になっても高速)
-                candidates = q.order_by(
-                    MemvidEmbedding.created_at.desc()
-                ).limit(500).all()
-                
-                scored = []
-                for c in candidates:
-                    try:
-                        vec = json.loads(c.embedding_json)
-                        sim = self._cosine_similarity(query_vec, vec)
-                        if sim >= min_similarity:
-                            scored.append({
-                                'content': c.content,
-                                'similarity': sim,
-                                'chunk_type': c.chunk_type,
-                                'source_id': c.source_id,
-                            })
-                    except Exception:
-                        continue
-                
-                scored.sort(key=lambda x: x['similarity'], reverse=True)
-                return scored[:top_k]
+                cols = [MemvidEmbedding.id, MemvidEmbedding.content,
+                        MemvidEmbedding.chunk_type, MemvidEmbedding.source_id]
+                if not exact:
+                    cols.append(MemvidEmbedding.embedding_json)
+                rows = session.query(*cols).filter(MemvidEmbedding.id.in_(list(approx))).all()
+            
+            scored = []
+            for r in rows:
+                sim = approx[r.id] if exact else self._cosine_similarity(query_vec, json.loads(r.embedding_json))
+                if sim >= min_similarity:
+                    scored.append({
+                        'content': r.content,
+                        'similarity': sim,
+                        'chunk_type': r.chunk_type,
+                        'source_id': r.source_id,
+                    })
+            
+            scored.sort(key=lambda x: x['similarity'], reverse=True)
+            return scored[:top_k]
         
         except Exception as e:
             logger.error(f"Memvid search エラー: {e}")
             return []
     
+    # ----- 差分インデックス -----
+    # chunk_type -> ソース行を (source_id, 見出し, 本文) で列挙する関数名
+    KNOWLEDGE_SOURCES = {
+        'hololive_news':    '_source_hololive_news',
+        'holomem_wiki':     '_source_holomem_wiki',
+        'holomem_lingo':    '_source_holomem_lingo',
+        'specialized_news': '_source_specialized_news',
+        'secondlife_news':  '_source_secondlife_news',
+        'anime_info':       '_source_anime_info',
+        'taught_knowledge': '_source_taught_knowledge',
+        'mochiko_knowledge': '_source_mochiko_knowledge',
+    }
+    INDEX_EMBED_BUDGET = 1000  # 1回の構築でEmbeddingする最大チャンク数 (1文書は最大 MEMVID_CHUNK_MAX_PER_DOC チャンク。残りは次回)
+    CHUNK_LABELS = {
+        'hololive_news':    '📰ニュース',
+        'holomem_wiki':     '📖Wiki',
+        'holomem_lingo':    '🗣️ファン用語',
+        'specialized_news': '🔧専門情報',
+        'secondlife_news':  '🌐SLニュース',
+        'anime_info':       '📺アニメ',
+        'taught_knowledge': '🧠教わった知識',
+        'mochiko_knowledge': '📝もちこの知識',
+        'conversation':     '💬過去の会話',
+    }
+    
+    @staticmethod
+    def _source_hololive_news(session) -> List[Tuple[int, str, str]]:
+        rows = session.query(HololiveNews.id, HololiveNews.title, HololiveNews.content).all()
+        return [(r.id, r.title, r.content or '') for r in rows]
+    
+    @staticmethod
+    def _source_holomem_wiki(session) -> List[Tuple[int, str, str]]:
+        rows = session.query(
+            HolomemWiki.id, HolomemWiki.member_name, HolomemWiki.description, HolomemWiki.episodes
+        ).filter(
+            (HolomemWiki.episodes.isnot(None)) | (HolomemWiki.description.isnot(None))
+        ).all()
+        return [(r.id, r.member_name, f"{r.description or ''}\n{r.episodes or ''}") for r in rows]
+    
+    @staticmethod
+    def _source_holomem_lingo(session) -> List[Tuple[int, str, str]]:
+        out = []
+        for r in session.query(HolomemLingo.id, HolomemLingo.member_name, HolomemLingo.data).all():
+            try:
+                d = json.loads(r.data or '{}')
+            except json.JSONDecodeError:
+                continue
+            parts = []
+            if d.get('aliases'):
+                parts.append(f"呼び方: {', '.join(d['aliases'])}")
+            if d.get('fannames'):
+                parts.append(f"ファンネーム: {', '.join(d['fannames'])}")
+            if d.get('hashtags'):
+                parts.append(f"タグ: {', '.join(d['hashtags'])}")
+            if d.get('oshi_marks'):
+                parts.append(f"推しマーク: {''.join(d['oshi_marks'])}")
+            if parts:
+                out.append((r.id, r.member_name, '\n'.join(parts)))
+        return out
+    
+    @staticmethod
+    def _source_specialized_news(session) -> List[Tuple[int, str, str]]:
+        rows = session.query(
+            SpecializedNews.id, SpecializedNews.site_name, SpecializedNews.title, SpecializedNews.content
+        ).all()
+        return [(r.id, f"【{r.site_name}】{r.title}", r.content or '') for r in rows]
+    
+    @staticmethod
+    def _source_secondlife_news(session) -> List[Tuple[int, str, str]]:
+        rows = session.query(SecondLifeNews.id, SecondLifeNews.title, SecondLifeNews.content).all()
+        return [(r.id, r.title, r.content or '') for r in rows]
+    
+    @staticmethod
+    def _source_anime_info(session) -> List[Tuple[int, str, str]]:
+        rows = session.query(
+            AnimeInfoCache.id, AnimeInfoCache.title, AnimeInfoCache.synopsis,
+            AnimeInfoCache.genre, AnimeInfoCache.status, AnimeInfoCache.season
+        ).all()
+        return [
+            (r.id, r.title,
+             f"{' '.join(x for x in (r.genre, r.status, r.season) if x)}\n{r.synopsis or ''}")
+            for r in rows
+        ]
+    
+    @staticmethod
+    def _source_taught_knowledge(session) -> List[Tuple[int, str, str]]:
+        rows = session.query(
+            UserTaughtKnowledge.id, UserTaughtKnowledge.title, UserTaughtKnowledge.content
+        ).all()
+        return [(r.id, r.title or '', r.content or '') for r in rows]
+    
+    @staticmethod
+    def _source_mochiko_knowledge(session) -> List[Tuple[int, str, str]]:
+        # 知識ドキュメントのセクション (ファイル添付の代わりに関連する分だけ検索で注入する)
+        return [
+            (MochikoKnowledgeFile.section_id(sec['key']),
+             f"{sec['heading']} {sec['title']}".strip(), sec['body'])
+            for sec in mochiko_knowledge_file.build_sections(session, MochikoKnowledgeFile.INDEXED_GROUPS)
+        ]
+    
+    @staticmethod
+    def _content_hash(header: str, body: str) -> str:
+        return hashlib.sha1(f"{header}\n{body}".encode('utf-8')).hexdigest()
+    
+    def _sync_source(self, chunk_type: str, budget: int) -> Tuple[int, int, int, int]:
+        """
+        1ソーステーブルの差分を取って反映する。
+        ソース全件とインデックス済み (source_id, content_hash) をそれぞれ1クエリで取得し、
+        新規・変更・削除を集合演算で求める。Embeddingに失敗したチャンク (ベクトルNULL) が
+        残っている文書も変更扱いにして埋め込み直す。
+        budget はチャンク数。戻り値: (追加文書数, 変更文書数, 削除文書数, 保存チャンク数)
+        """
+        loader = getattr(self, self.KNOWLEDGE_SOURCES[chunk_type])
+        with get_db_session() as session:
+            current = {
+                sid: (header, body, self._content_hash(header, body))
+                for sid, header, body in loader(session) if body.strip()
+            }
+            indexed: Dict[int, set] = defaultdict(set)
+            unembedded = set()
+            for sid, h, missing in session.query(
+                MemvidEmbedding.source_id, MemvidEmbedding.content_hash, MemvidEmbedding.embedding_json.is_(None)
+            ).filter(
+                MemvidEmbedding.chunk_type == chunk_type,
+                MemvidEmbedding.source_id.isnot(None)
+            ).all():
+                indexed[sid].add(h)
+                if missing:
+                    unembedded.add(sid)
+            
+            # ハッシュ導入前の行 (NULL) は内容不変とみなしてハッシュだけ付与する
+            legacy = [sid for sid, hs in indexed.items() if hs == {None} and sid in current]
+            for sid in legacy:
+                session.query(MemvidEmbedding).filter(
+                    MemvidEmbedding.chunk_type == chunk_type,
+                    MemvidEmbedding.source_id == sid
+                ).update({MemvidEmbedding.content_hash: current[sid][2]}, synchronize_session=False)
+                indexed[sid] = {current[sid][2]}
+            
+            deleted = set(indexed) - set(current)
+            new = [sid for sid in current if sid not in indexed]
+            changed = [sid for sid in current if sid in indexed
+                       and (indexed[sid] != {current[sid][2]} or sid in unembedded)]
+            
+            if deleted:
+                session.query(MemvidEmbedding).filter(
+                    MemvidEmbedding.chunk_type == chunk_type,
+                    MemvidEmbedding.source_id.in_(list(deleted))
+                ).delete(synchronize_session=False)
+                memvid_vector_index.mark_dirty()
+        
+        # 新しい行から優先して、チャンク数が予算に収まる文書までEmbedding (残りは次回)
+        todo: List[int] = []
+        cost = 0
+        for sid in sorted(changed + new, reverse=True):
+            n = sum(1 for _ in self._iter_chunk_pieces([{'header': current[sid][0], 'content': current[sid][1]}]))
+            if todo and cost + n > budget:
+                break
+            todo.append(sid)
+            cost += n
+        saved = 0
+        if todo:
+            # 変更文書の旧チャンクは埋め直す分だけ消す (予算外の文書は次回まで旧ベクトルで検索に残す)
+            todo_set = set(todo)
+            stale = [sid for sid in changed if sid in todo_set]
+            if stale:
+                with get_db_session() as session:
+                    session.query(MemvidEmbedding).filter(
+                        MemvidEmbedding.chunk_type == chunk_type,
+                        MemvidEmbedding.source_id.in_(stale)
+                    ).delete(synchronize_session=False)
+                memvid_vector_index.mark_dirty()
+            saved = self.add_chunks(
+                [
+                    {'header': current[sid][0], 'content': current[sid][1],
+                     'source_id': sid, 'content_hash': current[sid][2]}
+                    for sid in todo
+                ],
+                chunk_type
+            )
+        todo_set = set(todo)
+        return (
+            sum(1 for sid in new if sid in todo_set),
+            sum(1 for sid in changed if sid in todo_set),
+            len(deleted),
+            saved,
+        )
+    
     def build_knowledge_index(self):
         """
-        既存DBから知識チャンクを生成してインデックス構築
-        (Memvid: build() 相当)
-        対象: HololiveNews, HolomemWiki, HolomemLingo
+        既存DBから知識チャンクを差分でインデックス化する (Memvid: build() 相当)
+        対象: KNOWLEDGE_SOURCES の全テーブル。変更された行だけ再Embeddingし、
+        元行が消えたチャンクは削除する。予算 INDEX_EMBED_BUDGET はチャンク数で数える。
         """
-        logger.info("🏗️ Memvid知識インデックス構築開始...")
+        logger.info("🏗️ Memvid知識インデックス差分構築開始...")
         total = 0
+        budget = self.INDEX_EMBED_BUDGET
         
-        try:
-            with get_db_session() as session:
-                # ホロライブニュース (タイトル+本文)
-                news_list = session.query(HololiveNews).order_by(
-                    HololiveNews.created_at.desc()
-                ).limit(50).all()
-                
-                news_chunks = []
-                for n in news_list:
-                    text = f"{n.title}\n{n.content or ''}"[:1000]
-                    # 既にインデックス済みかチェック
-                    existing = session.query(MemvidEmbedding).filter_by(
-                        chunk_type='hololive_news',
-                        source_id=n.id
-                    ).first()
-                    if not existing:
-                        news_chunks.append({'content': text, 'source_id': n.id})
-                
-                if news_chunks:
-                    total += self.add_chunks(news_chunks, 'hololive_news')
-                
-                # ホロメンWiki (エピソード情報)
-                wiki_list = session.query(HolomemWiki).filter(
-                    HolomemWiki.episodes.isnot(None)
-                ).limit(30).all()
-                
-                wiki_chunks = []
-                for w in wiki_list:
-                    text = f"{w.member_name}\n{w.description or ''}\n{w.episodes or ''}"[:1000]
-                    existing = session.query(MemvidEmbedding).filter_by(
-                        chunk_type='holomem_wiki',
-                        source_id=w.id
-                    ).first()
-                    if not existing:
-                        wiki_chunks.append({'content': text, 'source_id': w.id})
-                
-                if wiki_chunks:
-                    total += self.add_chunks(wiki_chunks, 'holomem_wiki')
-        
-        except Exception as e:
-            logger.error(f"Memvid知識インデックス構築エラー: {e}")
+        for chunk_type in self.KNOWLEDGE_SOURCES:
+            try:
+                added, changed, deleted, saved = self._sync_source(chunk_type, budget)
+            except Exception as e:
+                logger.error(f"Memvid知識インデックス構築エラー ({chunk_type}): {e}")
+                continue
+            budget -= saved
+            total += added + changed
+            if added or changed or deleted:
+                logger.info(f"  📦 {chunk_type}: 新規{added} / 変更{changed} / 削除{deleted}")
+            if budget <= 0:
+                logger.info("  ⏸️ Embedding予算到達 → 残りは次回")
+                break
         
-        logger.info(f"✅ Memvid知識インデックス構築完了: {total}チャンク追加")
+        logger.info(f"✅ Memvid知識インデックス構築完了: {total}文書を(再)Embedding")
         return total
     
     def index_conversation(self, user_uuid: str, content: str, source_id: int = None):
@@ -1066,49 +3506,6 @@ class MemvidRAG:
             user_uuid=user_uuid
         )
     
-    def get_context_for_query(self, query: str, user_uuid: str = None) -> str:
-        """
-        クエリに関連する過去の会話・知識を取得してコンテキスト文字列で返す。
-        generate_ai_response() に注入して使う。
-        """
-        results = []
-        
-        # 知識DB検索 (ニュース・Wiki)
-        knowledge_hits = self.search(
-            query,
-            chunk_type=None,
-            top_k=3,
-            min_similarity=0.65
-        )
-        # 会話履歴検索 (このユーザーの過去発言)
-        if user_uuid:
-            conv_hits = self.search(
-                query,
-                chunk_type='conversation',
-                user_uuid=user_uuid,
-                top_k=2,
-                min_similarity=0.7
-            )
-        else:
-            conv_hits = []
-        
-        results = knowledge_hits + conv_hits
-        if not results:
-            return ''
-        
-        lines = []
-        for r in results:
-            label = {
-                'hololive_news': '📰ニュース',
-                'holomem_wiki':  '📖Wiki',
-                'holomem_lingo': '🗣️ファン用語',
-                'conversation':  '💬過去の会話',
-            }.get(r['chunk_type'], '📌')
-            sim_pct = int(r['similarity'] * 100)
-            lines.append(f"{label}(類似度{sim_pct}%): {r['content'][:200]}")
-        
-        return "\n\n【Memvid RAG検索結果】\n" + "\n".join(lines)
-    
     def cleanup_old_embeddings(self, days: int = 30):
         """古い会話埋め込みを削除 (知識DBは残す)"""
         try:
@@ -1119,71 +3516,472 @@ class MemvidRAG:
                     MemvidEmbedding.created_at < cutoff
                 ).delete()
                 if deleted:
+                    memvid_vector_index.mark_dirty()
                     logger.info(f"🗑️ Memvid: 古い会話埋め込み{deleted}件削除")
         except Exception as e:
             logger.error(f"Memvid cleanup エラー: {e}")
 
-memvid_rag = MemvidRAG.get_instance()
+memvid_rag = MemvidRAG.get_instance()
+
+
+def generate_mochiko_knowledge():
+    """TASK_SCHEDULEから呼ばれる定期更新関数"""
+    mochiko_knowledge_file.refresh()
+
+app = Flask(__name__)
+application = app
+app.config['JSON_AS_ASCII'] = False
+CORS(app)
+
+@app.after_request
+def after_request(response):
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type, Authorization')
+    response.headers.add('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+    return response
+
+Base = declarative_base()
+
+# ==============================================================================
+# 秘密情報/環境変数
+# ==============================================================================
+def get_secret(name: str) -> Optional[str]:
+    env_value = os.environ.get(name)
+    if env_value and env_value.strip(): return env_value.strip()
+    try:
+        secret_file_path = f"/etc/secrets/{name}"
+        if os.path.exists(secret_file_path):
+            with open(secret_file_path, 'r') as f:
+                val = f.read().strip()
+                if val: return val
+    except: pass
+    return None
+
+DATABASE_URL = get_secret('DATABASE_URL') or 'sqlite:///./mochiko_ultimate.db'
+GROQ_API_KEY = get_secret('GROQ_API_KEY')
+GEMINI_API_KEY = get_secret('GEMINI_API_KEY')
+VOICEVOX_URL_FROM_ENV = get_secret('VOICEVOX_URL')
+
+# su-shiki VOICEVOX APIキー
+SUSHIKI_API_KEY = get_secret('VOICEVOX_API_KEY') or "D_78935397H9612"
+
+# ユーザーごとの音声キュー: { user_uuid: deque([(url1, duration1), (url2, duration2), ...]) }
+# v33.17: 値を url 単体から (url, duration) タプルに変更
+_voice_queues: Dict[str, Any] = {}
+_voice_queues_lock = Lock()
+# v33.17: 直近の chat_lsl 応答に対する最初のフレーズの duration（chat_lslのレスポンスで使う）
+_last_voice_duration: Dict[str, float] = {}
+# v33.22: 最初のフレーズの表示テキスト（絵文字付き）→ chat_lsl の res_text に使う
+_last_voice_text: Dict[str, str] = {}
+
+
+# GitHub Actions から /wake を叩く際の認証キー
+# Render の Environment Variables と GitHub の Secrets に同じ値を設定する
+WAKE_API_KEY = get_secret('WAKE_API_KEY')
+
+# Holodex API キー（無料・https://holodex.net で取得）
+# ホロライブ配信スケジュール＆過去配信履歴の取得に使用
+HOLODEX_API_KEY = get_secret('HOLODEX_API_KEY')
+
+# ==============================================================================
+# ★ 記録/再生トランスポート (オフライン負荷試験用)
+# ==============================================================================
+# 外部呼び出し (Gemini生成 / Groq / Gemini Embedding / スクレイパー・Holodex・JMA・su-shiki の HTTP) を
+# 1か所に通し、モードで振る舞いを切り替える。
+#   live:   そのまま送る (既定)
+#   record: 実際に送って応答とレイテンシをカセット (JSONL) に追記する
+#   replay: ネットワークに出ず、カセットの応答を返す。レイテンシは分布から決めて sleep する
+# TRANSPORT_REPLAY_LATENCY: recorded (記録値) / none / fixed:秒 / uniform:最小,最大 / lognormal:中央値,sigma
+# TRANSPORT_REPLAY_LATENCY_BY_KIND='{"gemini": "lognormal:1.5,0.4", "http": "fixed:0.2"}' で種類別に上書き
+# TRANSPORT_REPLAY_MISS: nearest (同じ種類・宛先の記録を順に使い回す) / error
+TRANSPORT_MODE = os.environ.get('TRANSPORT_MODE', 'live').lower()
+TRANSPORT_CASSETTE = os.environ.get('TRANSPORT_CASSETTE', '/tmp/mochiko_cassette.jsonl')
+TRANSPORT_REPLAY_LATENCY = os.environ.get('TRANSPORT_REPLAY_LATENCY', 'recorded')
+TRANSPORT_REPLAY_MISS = os.environ.get('TRANSPORT_REPLAY_MISS', 'nearest').lower()
+TRANSPORT_REPLAY_SEED = int(os.environ.get('TRANSPORT_REPLAY_SEED', '0') or 0)
+
+
+class TransportReplayMiss(Exception):
+    """replay モードでカセットに該当する記録が無い"""
+
+
+class RecordReplayTransport:
+    """外部呼び出しの記録/再生。kind は 'gemini' / 'groq' / 'embed' / 'http'、sub はモデル名やホスト"""
+
+    def __init__(self, mode: str, path: str):
+        self.mode = mode if mode in ('live', 'record', 'replay') else 'live'
+        self.path = path
+        self._lock = Lock()
+        self._entries: Dict[str, List[Dict]] = defaultdict(list)     # key -> 記録
+        self._pools: Dict[Tuple[str, str], List[Dict]] = defaultdict(list)
+        self._cursors: Counter = Counter()
+        self._stats: Counter = Counter()
+        self._rng = random.Random(TRANSPORT_REPLAY_SEED)
+        self._latency_specs: Dict[str, str] = {}
+        try:
+            self._latency_specs = json.loads(os.environ.get('TRANSPORT_REPLAY_LATENCY_BY_KIND', '') or '{}')
+        except Exception as e:
+            logger.warning(f"⚠️ TRANSPORT_REPLAY_LATENCY_BY_KIND の解析に失敗: {e}")
+        if self.mode == 'replay':
+            self._load()
+        if self.mode != 'live':
+            logger.info(f"📼 トランスポート: {self.mode} ({self.path})")
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == 'replay'
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    self._entries[entry['key']].append(entry)
+                    self._pools[(entry['kind'], entry.get('sub') or '')].append(entry)
+                    if entry.get('sub'):
+                        self._pools[(entry['kind'], '')].append(entry)
+        except FileNotFoundError:
+            logger.warning(f"⚠️ カセットがありません: {self.path}")
+        logger.info(f"📼 カセット読込: {sum(len(v) for v in self._entries.values())}件")
+
+    @staticmethod
+    def make_key(kind: str, material: Any) -> str:
+        raw = json.dumps(material, ensure_ascii=False, sort_keys=True, default=str)
+        return f"{kind}:{hashlib.sha1(raw.encode('utf-8')).hexdigest()}"
+
+    def _next(self, bucket: str, entries: List[Dict]) -> Dict:
+        with self._lock:
+            i = self._cursors[bucket]
+            self._cursors[bucket] += 1
+        return entries[i % len(entries)]
+
+    def _lookup(self, kind: str, key: str, sub: str) -> Optional[Dict]:
+        if self._entries.get(key):
+            self._stats['replay_hits'] += 1
+            return self._next(key, self._entries[key])
+        self._stats['replay_misses'] += 1
+        if TRANSPORT_REPLAY_MISS != 'nearest':
+            return None
+        for pool_key in ((kind, sub), (kind, '')):
+            if self._pools.get(pool_key):
+                return self._next(f"{pool_key[0]}|{pool_key[1]}", self._pools[pool_key])
+        return None
+
+    def _sample_latency(self, kind: str, recorded: float) -> float:
+        spec = self._latency_specs.get(kind, TRANSPORT_REPLAY_LATENCY)
+        name, _, args = spec.partition(':')
+        try:
+            vals = [float(x) for x in args.split(',') if x]
+            if name == 'none':
+                return 0.0
+            if name == 'fixed':
+                return vals[0]
+            if name == 'uniform':
+                return self._rng.uniform(vals[0], vals[1])
+            if name == 'lognormal':
+                return vals[0] * math.exp(self._rng.gauss(0.0, vals[1]))
+        except (IndexError, ValueError):
+            logger.warning(f"⚠️ レイテンシ指定が不正: {spec} → 記録値を使用")
+        return recorded
+
+    def _append(self, entry: Dict):
+        line = json.dumps(entry, ensure_ascii=False, default=str)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + "\n")
+            self._stats['recorded'] += 1
+
+    def call(self, kind: str, sub: str, material: Any, live_fn, encode, decode):
+        """live_fn() を実際の呼び出しとして、モードに応じて送る / 記録する / 再生する"""
+        if self.mode == 'live':
+            return live_fn()
+        key = self.make_key(kind, material)
+        if self.mode == 'replay':
+            entry = self._lookup(kind, key, sub or '')
+            if entry is None:
+                raise TransportReplayMiss(f"カセットに記録なし: {kind} {sub}")
+            delay = self._sample_latency(kind, entry.get('latency', 0.0))
+            if delay > 0:
+                time.sleep(delay)
+            if entry.get('error'):
+                raise RuntimeError(entry['error'])
+            return decode(entry['response'])
+        started = time.monotonic()
+        base = {'kind': kind, 'sub': sub or '', 'key': key}
+        try:
+            result = live_fn()
+        except Exception as e:
+            self._append({**base, 'latency': round(time.monotonic() - started, 4), 'error': str(e)[:500]})
+            raise
+        self._append({**base, 'latency': round(time.monotonic() - started, 4), 'response': encode(result)})
+        return result
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'mode': self.mode,
+                'cassette': self.path if self.mode != 'live' else None,
+                'loaded': sum(len(v) for v in self._entries.values()),
+                **dict(self._stats),
+            }
+
+
+transport = RecordReplayTransport(TRANSPORT_MODE, TRANSPORT_CASSETTE)
+
+if transport.replaying:
+    # 再生中は外に出ないので、キー有無で機能を落とさないようダミーを入れる
+    GROQ_API_KEY = GROQ_API_KEY or 'replay'
+    GEMINI_API_KEY = GEMINI_API_KEY or 'replay'
+    HOLODEX_API_KEY = HOLODEX_API_KEY or 'replay'
+if TRANSPORT_MODE != 'live' and HAS_SCRAPLING:
+    # Scrapling は独自の通信路なので、記録/再生中は requests 版にフォールバックさせる
+    HAS_SCRAPLING = False
+    logger.info("📼 記録/再生中のため Scrapling を無効化")
+
+
+def _encode_http_response(res) -> Dict[str, Any]:
+    return {
+        'status': res.status_code,
+        'url': res.url,
+        'headers': dict(res.headers),
+        'encoding': res.encoding,
+        'body_b64': base64.b64encode(res.content or b'').decode('ascii'),
+    }
+
+
+def _decode_http_response(data: Dict[str, Any]):
+    res = requests.models.Response()
+    res.status_code = data['status']
+    res.url = data.get('url') or ''
+    res.headers = requests.structures.CaseInsensitiveDict(data.get('headers') or {})
+    res.encoding = data.get('encoding')
+    res._content = base64.b64decode(data.get('body_b64') or '')
+    return res
+
+
+# ==============================================================================
+# ★ HTTPクライアント (ホスト別の接続プール + 再試行)
+# ==============================================================================
+# requests.get / post は呼ぶたびに Session を作り捨てるので、su-shiki の音声フレーズや
+# 検索エンジンへの問い合わせのたびに TCP + TLS ハンドシェイクが走っていた。
+# ホスト (scheme://netloc) ごとに keep-alive の Session を使い回し、
+# タイムアウト未指定の呼び出しには既定値を入れ、接続エラーと一時的なステータスは
+# 冪等なメソッドだけバックオフ付きで再試行する (読み取りタイムアウトは再試行しない)。
+# fetch_and_remember_url は任意のホストを読むので、Session は最近使った HTTP_MAX_HOSTS 件だけ残し
+# 溢れたものは閉じる。クッキーはリクエスト単位: 1回のリクエストのリダイレクト中は引き継ぎ、
+# Session には残さない (以前の requests.get と同じく、別のリクエストへは持ち越さない)。
+# HTTP/2 は呼び出し側が requests.Response の API に依存しているため見送り (HTTP/1.1 keep-alive)。
+HTTP_DEFAULT_TIMEOUT = (5, 20)            # (接続, 読み取り) 秒
+HTTP_POOL_MAXSIZE = 10                    # ホストごとに保持する接続数 (音声フレーズの並列数以上)
+HTTP_RETRY_MAX = 2                        # 再試行回数 (初回を除く)
+HTTP_RETRY_BACKOFF_SECONDS = 0.5          # 0.5s, 1s ... (+ジッター)
+HTTP_RETRY_AFTER_MAX_SECONDS = 10         # Retry-After はこれ以上待たない
+HTTP_RETRY_STATUS = {429, 502, 503, 504}
+HTTP_IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+HTTP_MAX_HOSTS = 32                       # Session を保持するホスト数 (LRU)
+
+
+class _RequestScopedCookieJar(requests.cookies.RequestsCookieJar):
+    """
+    Session 側には何も保存しない jar。requests はリクエストごとに Session の jar と
+    引数の cookies を新しい jar へ合成し、リダイレクトで受けたクッキーはそちらに溜めるので、
+    同じリクエストのリダイレクト間では引き継がれ、次のリクエストには残らない。
+    """
+
+    def set_cookie(self, cookie, *args, **kwargs):
+        return None
+
+    def extract_cookies(self, response, request):
+        return None
+
+
+class HttpClientRegistry:
+    """ホストごとに keep-alive な requests.Session を持つ (Session はスレッド間で共有、最近使った HTTP_MAX_HOSTS 件)"""
+
+    def __init__(self, max_hosts: int = HTTP_MAX_HOSTS):
+        self._lock = Lock()
+        self._max_hosts = max_hosts
+        self._sessions: "OrderedDict[str, requests.Session]" = OrderedDict()
+        self._stats: Dict[str, Counter] = defaultdict(Counter)
+        self._evicted: Counter = Counter()   # 追い出したホストの累計 (統計を無制限に増やさない)
+
+    def session_for(self, url: str) -> requests.Session:
+        parsed = urlparse(url)
+        origin = f"{parsed.scheme}://{parsed.netloc}"
+        evicted = []
+        with self._lock:
+            session = self._sessions.get(origin)
+            if session is not None:
+                self._sessions.move_to_end(origin)
+                return session
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_MAXSIZE)
+            session.mount(origin, adapter)
+            session.cookies = _RequestScopedCookieJar()
+            self._sessions[origin] = session
+            while len(self._sessions) > self._max_hosts:
+                old_origin, old_session = self._sessions.popitem(last=False)
+                self._evicted.update(self._stats.pop(urlparse(old_origin).netloc, {}))
+                self._evicted['hosts'] += 1
+                evicted.append(old_session)
+        # 使用中の接続は返却時に閉じられるので、ロックの外で閉じればよい
+        for old_session in evicted:
+            try:
+                old_session.close()
+            except Exception:
+                pass
+        return session
+
+    def _count(self, host: str, name: str):
+        with self._lock:
+            self._stats[host][name] += 1
+
+    def _retry_delay(self, attempt: int, res=None) -> float:
+        delay = HTTP_RETRY_BACKOFF_SECONDS * (2 ** attempt) + random.uniform(0, 0.25)
+        retry_after = res.headers.get('Retry-After') if res is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        return min(delay, HTTP_RETRY_AFTER_MAX_SECONDS)
+
+    def request(self, method: str, url: str, **kwargs):
+        host = urlparse(url).netloc
+        kwargs.setdefault('timeout', HTTP_DEFAULT_TIMEOUT)
+        session = self.session_for(url)
+        retries = HTTP_RETRY_MAX if method.upper() in HTTP_IDEMPOTENT_METHODS else 0
+        attempt = 0
+        while True:
+            self._count(host, 'requests')
+            res = None
+            try:
+                res = session.request(method, url, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                # 切れた keep-alive 接続の再利用失敗もここに来る (ReadTimeout は対象外)
+                if attempt >= retries:
+                    self._count(host, 'errors')
+                    raise
+                error = e
+                delay = self._retry_delay(attempt)
+            else:
+                if res.status_code not in HTTP_RETRY_STATUS or attempt >= retries:
+                    return res
+                delay = self._retry_delay(attempt, res)
+            # 生成中は期限内に収まる場合だけ再試行する
+            token = current_cancel_token()
+            if token is not None and token.remaining() <= delay + 1.0:
+                if res is not None:
+                    return res
+                self._count(host, 'errors')
+                raise error
+            self._count(host, 'retries')
+            time.sleep(delay)
+            attempt += 1
+            cancel_checkpoint(f"http_retry:{host}")
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                'hosts': len(self._sessions),
+                'max_hosts': self._max_hosts,
+                'per_host': {host: dict(c) for host, c in self._stats.items()},
+                'evicted': dict(self._evicted),
+            }
+
 
+http_clients = HttpClientRegistry()
 
-def generate_mochiko_knowledge():
-    """TASK_SCHEDULEから呼ばれる定期更新関数"""
-    mochiko_knowledge_file.refresh()
 
-app = Flask(__name__)
-application = app
-app.config['JSON_AS_ASCII'] = False
-CORS(app)
+def _http_request(method: str, url: str, **kwargs):
+    # 生成中の呼び出しは期限を過ぎていれば送らず、タイムアウトも残り時間までに縮める
+    cancel_checkpoint(f"http:{urlparse(url).netloc}")
+    if current_cancel_token() is not None:
+        kwargs['timeout'] = deadline_timeout(kwargs.get('timeout') or 30)
+    material = [method, url, kwargs.get('params'), kwargs.get('data'), kwargs.get('json')]
+    return transport.call(
+        'http', urlparse(url).netloc, material,
+        lambda: http_clients.request(method, url, **kwargs),
+        _encode_http_response, _decode_http_response,
+    )
 
-@app.after_request
-def after_request(response):
-    response.headers.add('Access-Control-Allow-Origin', '*')
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type, Authorization')
-    response.headers.add('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-    return response
 
-Base = declarative_base()
+def http_get(url: str, **kwargs):
+    """requests.get 相当 (接続プール + 記録/再生トランスポート経由)"""
+    return _http_request('GET', url, **kwargs)
 
-# ==============================================================================
-# 秘密情報/環境変数
-# ==============================================================================
-def get_secret(name: str) -> Optional[str]:
-    env_value = os.environ.get(name)
-    if env_value and env_value.strip(): return env_value.strip()
-    try:
-        secret_file_path = f"/etc/secrets/{name}"
-        if os.path.exists(secret_file_path):
-            with open(secret_file_path, 'r') as f:
-                val = f.read().strip()
-                if val: return val
-    except: pass
-    return None
 
-DATABASE_URL = get_secret('DATABASE_URL') or 'sqlite:///./mochiko_ultimate.db'
-GROQ_API_KEY = get_secret('GROQ_API_KEY')
-GEMINI_API_KEY = get_secret('GEMINI_API_KEY')
-VOICEVOX_URL_FROM_ENV = get_secret('VOICEVOX_URL')
+def http_post(url: str, **kwargs):
+    """requests.post 相当 (接続プール + 記録/再生トランスポート経由)"""
+    return _http_request('POST', url, **kwargs)
 
-# su-shiki VOICEVOX APIキー
-SUSHIKI_API_KEY = get_secret('VOICEVOX_API_KEY') or "D_78935397H9612"
 
-# ユーザーごとの音声キュー: { user_uuid: deque([(url1, duration1), (url2, duration2), ...]) }
-# v33.17: 値を url 単体から (url, duration) タプルに変更
-_voice_queues: Dict[str, Any] = {}
-_voice_queues_lock = Lock()
-# v33.17: 直近の chat_lsl 応答に対する最初のフレーズの duration（chat_lslのレスポンスで使う）
-_last_voice_duration: Dict[str, float] = {}
-# v33.22: 最初のフレーズの表示テキスト（絵文字付き）→ chat_lsl の res_text に使う
-_last_voice_text: Dict[str, str] = {}
+def _contents_material(contents) -> Any:
+    """generate_content の contents を記録キー用に正規化 (ファイルは名前だけ)"""
+    if isinstance(contents, str):
+        return contents
+    if isinstance(contents, dict):
+        return {k: _contents_material(v) for k, v in contents.items()}
+    if isinstance(contents, (list, tuple)):
+        return [_contents_material(c) for c in contents]
+    return getattr(contents, 'name', None) or getattr(contents, 'text', None) or type(contents).__name__
 
 
-# GitHub Actions から /wake を叩く際の認証キー
-# Render の Environment Variables と GitHub の Secrets に同じ値を設定する
-WAKE_API_KEY = get_secret('WAKE_API_KEY')
+def _encode_gemini_response(resp) -> Dict[str, Any]:
+    cand = (getattr(resp, 'candidates', None) or [None])[0]
+    parts = getattr(getattr(cand, 'content', None), 'parts', None) or []
+    fr = getattr(cand, 'finish_reason', None)
+    usage = getattr(resp, 'usage_metadata', None)
+    return {
+        'text': "".join(getattr(p, 'text', '') or '' for p in parts),
+        'has_candidate': cand is not None,
+        'finish_reason': getattr(fr, 'value', fr) if not isinstance(fr, (int, str, type(None))) else fr,
+        'usage': {
+            k: getattr(usage, k, None)
+            for k in ('prompt_token_count', 'candidates_token_count', 'total_token_count', 'cached_content_token_count')
+        } if usage is not None else None,
+    }
 
-# Holodex API キー（無料・https://holodex.net で取得）
-# ホロライブ配信スケジュール＆過去配信履歴の取得に使用
-HOLODEX_API_KEY = get_secret('HOLODEX_API_KEY')
+
+def _decode_gemini_response(data: Dict[str, Any]):
+    part = SimpleNamespace(text=data.get('text') or '')
+    cands = [SimpleNamespace(finish_reason=data.get('finish_reason'), content=SimpleNamespace(parts=[part]))] \
+        if data.get('has_candidate', True) else []
+    usage = SimpleNamespace(**data['usage']) if data.get('usage') else None
+    return SimpleNamespace(text=part.text, candidates=cands, usage_metadata=usage, prompt_feedback=None)
+
+
+def _encode_groq_response(resp) -> Dict[str, Any]:
+    choice = resp.choices[0]
+    usage = getattr(resp, 'usage', None)
+    return {
+        'content': choice.message.content,
+        'finish_reason': getattr(choice, 'finish_reason', None),
+        'usage': {
+            'prompt_tokens': getattr(usage, 'prompt_tokens', None),
+            'completion_tokens': getattr(usage, 'completion_tokens', None),
+            'total_tokens': getattr(usage, 'total_tokens', None),
+        } if usage is not None else None,
+    }
+
+
+def _decode_groq_response(data: Dict[str, Any]):
+    message = SimpleNamespace(role='assistant', content=data.get('content'))
+    usage = SimpleNamespace(prompt_tokens_details=None, **data['usage']) if data.get('usage') else None
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=message, finish_reason=data.get('finish_reason'))], usage=usage
+    )
+
+
+def transport_embed_content(**kwargs):
+    """genai.embed_content 相当 (記録/再生トランスポート経由)"""
+    cancel_checkpoint('embed')
+    if current_cancel_token() is not None:
+        kwargs['request_options'] = {'timeout': deadline_timeout(30)}
+    return transport.call(
+        'embed', kwargs.get('model'), [kwargs.get('model'), kwargs.get('task_type'), kwargs.get('content')],
+        lambda: genai.embed_content(**kwargs),
+        lambda r: {'embedding': r['embedding']}, lambda d: d,
+    )
 
 # ==============================================================================
 # データベースモデル
@@ -1242,11 +4040,14 @@ class ConversationEmbedding(Base):
     role = Column(String(10), nullable=False)
     content_snippet = Column(String(500), nullable=False)
     embedding = Column(Text, nullable=True)
+    embedding_backend = Column(String(80), nullable=True)  # NULL = 旧データ(Gemini)
+    embed_attempts = Column(Integer, default=1)            # 埋め込みを試みた回数 (embedding NULL の行の再試行用)
+    attempted_at = Column(DateTime, nullable=True)         # 最後に埋め込みを試みた時刻
     created_at = Column(DateTime, default=datetime.utcnow, index=True)
 
 
 class ConversationSummary(Base):
-    """ユーザーごとの会話要約 (20往復ごとに自動生成)。"""
+    """ユーザーごとの階層会話要約 (level: recent / weekly / all をユーザー毎に1行ずつ更新)。"""
     __tablename__ = 'conversation_summaries'
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_uuid = Column(String(255), nullable=False, index=True)
@@ -1254,6 +4055,9 @@ class ConversationSummary(Base):
     covered_until = Column(DateTime, nullable=False)
     message_count = Column(Integer, default=0)
     created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    level = Column(String(20), default='recent')
+    covered_until_id = Column(Integer, nullable=True)  # ウォーターマーク (要約済みの最大 conversation_history.id)
+    updated_at = Column(DateTime, default=datetime.utcnow)
 
 
 
@@ -1526,6 +4330,7 @@ class MemvidEmbedding(Base):
       'hololive_news' - ホロライブニュース本文
       'holomem_wiki'  - ホロメンWiki情報
       'holomem_lingo' - ファン用語・呼称
+      'specialized_news' / 'secondlife_news' / 'anime_info' - 各キャッシュテーブル
     """
     __tablename__ = 'memvid_embeddings'
     id = Column(Integer, primary_key=True)
@@ -1535,6 +4340,8 @@ class MemvidEmbedding(Base):
     content = Column(Text, nullable=False)               # チャンクテキスト
     embedding_json = Column(Text, nullable=True)         # JSON形式の埋め込みベクトル
     embedding_dim = Column(Integer, default=768)
+    embedding_backend = Column(String(80), nullable=True, index=True)  # NULL = 旧データ(Gemini)
+    content_hash = Column(String(64), nullable=True)    # 元行の内容ハッシュ (差分インデックス用)
     created_at = Column(DateTime, default=datetime.utcnow, index=True)
     last_accessed = Column(DateTime, default=datetime.utcnow)
 
@@ -1556,6 +4363,52 @@ class SpecializedNews(Base):
     created_at = Column(DateTime, default=datetime.utcnow, index=True)
 
 
+class EmbeddingBackendState(Base):
+    """ローカルEmbeddingバックエンドの学習済みパラメータ (IDF等) を保存する。"""
+    __tablename__ = 'embedding_backend_state'
+    id = Column(Integer, primary_key=True)
+    backend = Column(String(80), unique=True, nullable=False)
+    params_json = Column(Text, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+class DeferredTask(Base):
+    """アイドル時に処理する遅延タスクの永続キュー (DeferredTaskQueue が raw SQL で操作)"""
+    __tablename__ = 'deferred_tasks'
+    id = Column(Integer, primary_key=True)
+    task_key = Column(String(255), unique=True, nullable=False)  # task_type:user_uuid[:extra] (upsert の重複判定)
+    task_type = Column(String(50), nullable=False)
+    user_uuid = Column(String(100), index=True)
+    user_name = Column(String(255))
+    extra_json = Column(Text, nullable=True)
+    priority = Column(Integer, default=50, nullable=False)
+    not_before = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+    lease_until = Column(DateTime, nullable=True)
+    attempts = Column(Integer, default=0, nullable=False)
+    revision = Column(Integer, default=1, nullable=False)  # upsert毎に+1 (処理中の再登録を検出)
+    queued_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+class LLMUsageRollup(Base):
+    """LLM 使用量の1時間ロールアップ (機能 × user_uuid × モデル)。LLMUsageAccounting が raw SQL で加算する"""
+    __tablename__ = 'llm_usage_rollups'
+    id = Column(Integer, primary_key=True)
+    rollup_key = Column(String(255), unique=True, nullable=False)  # bucket|feature|user|provider|model
+    bucket_start = Column(DateTime, nullable=False, index=True)
+    feature = Column(String(80), nullable=False, index=True)
+    user_uuid = Column(String(255), default='', index=True)
+    provider = Column(String(20), nullable=False)
+    model = Column(String(100), nullable=False)
+    calls = Column(Integer, default=0)
+    errors = Column(Integer, default=0)
+    input_tokens = Column(Integer, default=0)
+    output_tokens = Column(Integer, default=0)
+    cached_tokens = Column(Integer, default=0)
+    latency_ms_sum = Column(Integer, default=0)
+    latency_ms_max = Column(Integer, default=0)
+
+
 class UserTaughtKnowledge(Base):
     """ユーザーがURLを貼って『覚えて』と教えた知識を恒久保存するテーブル。
     SpecializedNews と異なり自動削除しない（教わった記憶は保持する）。"""
@@ -1589,6 +4442,11 @@ class RateLimiter:
             for uid in list(self.requests.keys()):
                 self.requests[uid] = [t for t in self.requests[uid] if t > cutoff]
                 if not self.requests[uid]: del self.requests[uid]
+    def forget(self, user_prefix: str):
+        """user_prefix で始まるユーザーの記録を消す (負荷試験ユーザーの後片付け)"""
+        with self._lock:
+            for uid in [u for u in self.requests if u.startswith(user_prefix)]:
+                del self.requests[uid]
 
 chat_rate_limiter = RateLimiter(max_requests=10, time_window=timedelta(minutes=1))
 
@@ -1732,6 +4590,7 @@ def strip_emoji_for_tts(text: str) -> str:
     return re.sub(r'  +', ' ', ''.join(result)).strip()
 
 
+@single_flight()
 def get_weather_forecast(location: str = "東京") -> str:
     """
     天気予報取得 (v33.15-stable: JMA 公式 API に切替)
@@ -1748,7 +4607,7 @@ def get_weather_forecast(location: str = "東京") -> str:
         location_code = LOCATION_CODES.get(location, LOCATION_CODES["東京"])
         url = f"https://www.jma.go.jp/bosai/forecast/data/forecast/{location_code}.json"
         headers = {'User-Agent': random.choice(USER_AGENTS)}
-        res = requests.get(url, headers=headers, timeout=8)
+        res = http_get(url, headers=headers, timeout=8)
         if res.status_code != 200:
             logger.warning(f"⚠️ JMA API失敗: HTTP {res.status_code}")
             return f"{location}の天気情報が取得できなかったよ…"
@@ -1788,280 +4647,1092 @@ _MEMORY_TRIGGER_WORDS = [
 ]
 
 
-def detect_memory_trigger(message: str) -> bool:
-    """「前に話したこと覚えてる？」系の発言を検出する"""
-    return any(kw in message for kw in _MEMORY_TRIGGER_WORDS)
+def detect_memory_trigger(message: str) -> bool:
+    """「前に話したこと覚えてる？」系の発言を検出する"""
+    return any(kw in message for kw in _MEMORY_TRIGGER_WORDS)
+
+
+# ------------------------------------------------------------------------------
+# ★ 会話履歴の転置インデックス (キーワード検索用)
+# ------------------------------------------------------------------------------
+# 旧実装は ILIKE '%word%' を単語ごとに実行しており、user_uuid インデックスを
+# 使えても本文は全件走査になり、常連ユーザーの履歴が数千件になると線形に遅くなった。
+#   - PostgreSQL: pg_trgm の GIN インデックス (3文字以上の語)
+#   - SQLite:     文字bigram → (user_uuid, history_id) のサイドテーブル
+# どちらも使えない場合は直近 CONV_SEARCH_SCAN_WINDOW 件だけを走査する。
+# 注意: pg_trgm は2文字の語からtrigramを取れずインデックスが効かないため、PostgreSQLでも
+# 「配信」「新曲」のような2文字の語 (日本語では漢字・カタカナ2文字語が多い) は直近
+# CONV_SEARCH_SCAN_WINDOW 件の走査になり、それより古い発言は2文字語では見つからない。
+CONV_SEARCH_SCAN_WINDOW = 2000
+CONV_SEARCH_PER_WORD = 30
+CONV_SEARCH_MAX_WORDS = 3
+_CONV_SEARCH_STOP_WORDS = {
+    'は', 'が', 'を', 'に', 'で', 'と', 'も', 'の', 'か',
+    'て', 'し', 'た', 'だ', 'な', 'よ', 'ね', 'よね',
+    'じゃん', 'って', 'けど', 'から', 'まじ', 'やばい',
+}
+_conv_search_mode = 'scan'   # 'trgm' / 'bigram_table' / 'scan' (setup_conversation_search_index で確定)
+
+
+def setup_conversation_search_index():
+    """会話履歴キーワード検索用のインデックスを用意する (起動時に1回)"""
+    global _conv_search_mode
+    try:
+        with engine.connect() as conn:
+            with conn.begin():
+                conn.execute(text(
+                    "CREATE INDEX IF NOT EXISTS ix_conversation_history_user_id "
+                    "ON conversation_history (user_uuid, id)"
+                ))
+    except Exception as e:
+        logger.warning(f"⚠️ conversation_history (user_uuid, id) インデックス作成スキップ: {e}")
+
+    if 'sqlite' in str(DATABASE_URL):
+        try:
+            with engine.connect() as conn:
+                with conn.begin():
+                    conn.execute(text(
+                        "CREATE TABLE IF NOT EXISTS conversation_bigrams ("
+                        " gram TEXT NOT NULL,"
+                        " user_uuid TEXT NOT NULL,"
+                        " history_id INTEGER NOT NULL,"
+                        " PRIMARY KEY (user_uuid, gram, history_id)) WITHOUT ROWID"
+                    ))
+                    indexed_max = conn.execute(text(
+                        "SELECT COALESCE(MAX(history_id), 0) FROM conversation_bigrams"
+                    )).scalar()
+                    rows = conn.execute(text(
+                        "SELECT id, user_uuid, content FROM conversation_history WHERE id > :m"
+                    ), {"m": indexed_max}).fetchall()
+                    for row in rows:
+                        _index_history_bigrams(conn, row[0], row[1], row[2])
+            _conv_search_mode = 'bigram_table'
+            logger.info(f"✅ 会話検索: bigramサイドテーブル (バックフィル{len(rows)}件)")
+        except Exception as e:
+            logger.warning(f"⚠️ 会話検索: bigramテーブル作成失敗 → 直近{CONV_SEARCH_SCAN_WINDOW}件走査: {e}")
+        return
+
+    try:
+        with engine.connect() as conn:
+            with conn.begin():
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            with conn.begin():
+                conn.execute(text(
+                    "CREATE INDEX IF NOT EXISTS ix_conversation_history_content_trgm "
+                    "ON conversation_history USING gin (content gin_trgm_ops)"
+                ))
+        _conv_search_mode = 'trgm'
+        logger.info("✅ 会話検索: pg_trgm GINインデックス OK")
+    except Exception as e:
+        logger.warning(f"⚠️ 会話検索: pg_trgm 利用不可 → 直近{CONV_SEARCH_SCAN_WINDOW}件走査: {e}")
+
+
+def _index_history_bigrams(conn, history_id: int, user_uuid: str, content: str):
+    """SQLite: 1発言分の bigram をサイドテーブルに登録する"""
+    grams = set(char_bigrams(content or ''))
+    if not grams:
+        return
+    conn.execute(text(
+        "INSERT OR IGNORE INTO conversation_bigrams (gram, user_uuid, history_id) "
+        "VALUES (:g, :u, :h)"
+    ), [{"g": g, "u": user_uuid, "h": history_id} for g in grams])
+
+
+def save_conversation_message(user_uuid: str, role: str, content: str) -> Optional[int]:
+    """
+    conversation_history に1発言を保存し、キーワード検索インデックスも更新する。
+    (Postgres の pg_trgm はDB側で自動更新、SQLite はサイドテーブルへ追記)
+    戻り値: 採番された id (失敗時 None)
+    """
+    try:
+        with engine.connect() as conn:
+            with conn.begin():
+                result = conn.execute(text(
+                    "INSERT INTO conversation_history (user_uuid, role, content, timestamp) "
+                    "VALUES (:uuid, :role, :content, :ts) RETURNING id"
+                ), {"uuid": user_uuid, "role": role, "content": content, "ts": datetime.utcnow()})
+                history_id = result.scalar()
+                if _conv_search_mode == 'bigram_table' and history_id:
+                    _index_history_bigrams(conn, history_id, user_uuid, content)
+        return history_id
+    except Exception as e:
+        logger.warning(f"conversation_history {role} INSERT失敗: {str(e)[:80]}")
+        return None
+
+
+def extract_search_words(message: str) -> List[str]:
+    """
+    キーワード検索に使う語を抽出する。
+    文字種の切れ目で区切り (「ぺこらのマイクラ配信」→ ぺこらの / マイクラ / 配信)、
+    カタカナ・漢字・英数字の語を優先し、ひらがなは3文字以上の語だけ使う。
+    """
+    words = [
+        w for w in re.findall(r'[ァ-ヶー]{2,}|[一-龥]{2,}|[a-zA-Z0-9]{2,}|[ぁ-ん]{3,}', message or '')
+        if w not in _CONV_SEARCH_STOP_WORDS
+    ]
+    words.sort(key=lambda w: 1 if re.fullmatch(r'[ぁ-ん]+', w) else 0)
+    return list(dict.fromkeys(words))[:CONV_SEARCH_MAX_WORDS]
+
+
+def find_history_ids_by_keyword(session, user_uuid: str, word: str, limit: int = CONV_SEARCH_PER_WORD) -> List[int]:
+    """1語を含む発言の id を新しい順に最大 limit 件返す (インデックス経由)"""
+    if _conv_search_mode == 'bigram_table':
+        grams = sorted(set(char_bigrams(word)))
+        if not grams:
+            return []
+        # bigram ポスティングの積集合: 全bigramを含む発言だけが残る
+        params = {"u": user_uuid, "n": len(grams), "lim": limit * 2}
+        placeholders = []
+        for i, g in enumerate(grams):
+            params[f"g{i}"] = g
+            placeholders.append(f":g{i}")
+        candidate_ids = [r[0] for r in session.execute(text(
+            "SELECT history_id FROM conversation_bigrams "
+            "WHERE user_uuid = :u AND gram IN (" + ", ".join(placeholders) + ") "
+            "GROUP BY history_id HAVING COUNT(*) = :n "
+            "ORDER BY history_id DESC LIMIT :lim"
+        ), params).fetchall()]
+        if not candidate_ids:
+            return []
+        # bigram 一致は必要条件なので、本文で連続一致を確認する
+        needle = unicodedata.normalize('NFKC', word).lower()
+        rows = session.query(ConversationHistory.id, ConversationHistory.content).filter(
+            ConversationHistory.id.in_(candidate_ids)
+        ).all()
+        ok = {r.id for r in rows if needle in unicodedata.normalize('NFKC', r.content or '').lower()}
+        return [i for i in candidate_ids if i in ok][:limit]
+
+    q = session.query(ConversationHistory.id).filter(
+        ConversationHistory.user_uuid == user_uuid,
+        ConversationHistory.content.ilike('%' + word + '%'),
+    )
+    if _conv_search_mode != 'trgm' or len(word) < 3:
+        # trigram が取れない短い語 / インデックス無しの場合は直近ウィンドウに限定
+        floor_id = session.query(ConversationHistory.id).filter(
+            ConversationHistory.user_uuid == user_uuid
+        ).order_by(ConversationHistory.id.desc()).offset(CONV_SEARCH_SCAN_WINDOW).limit(1).scalar()
+        if floor_id:
+            q = q.filter(ConversationHistory.id > floor_id)
+    return [r.id for r in q.order_by(ConversationHistory.id.desc()).limit(limit).all()]
+
+
+def recent_history_ids(session, user_uuid: str, limit: int) -> Set[int]:
+    """ユーザーの直近 limit 件の発言 id (履歴としてプロンプトに渡す分を検索結果から除くのに使う)"""
+    return {
+        row.id for row in
+        session.query(ConversationHistory.id)
+        .filter_by(user_uuid=user_uuid)
+        .order_by(ConversationHistory.id.desc())
+        .limit(limit).all()
+    }
+
+
+def find_history_by_keywords(session, user_uuid: str, message: str,
+                             per_word: int = CONV_SEARCH_PER_WORD,
+                             exclude_recent: int = 10,
+                             exclude_ids: Optional[Set[int]] = None) -> List[Any]:
+    """
+    メッセージ中の語を含む過去発言を返す (直近 exclude_recent 件は除外、新しい順)。
+    呼び出し側で直近 id を取得済みなら exclude_ids に渡す。
+    """
+    words = extract_search_words(message)
+    if not words:
+        return []
+    if exclude_ids is None:
+        exclude_ids = recent_history_ids(session, user_uuid, exclude_recent)
+    ids = set()
+    for word in words:
+        ids.update(find_history_ids_by_keyword(session, user_uuid, word, limit=per_word))
+    ids -= exclude_ids
+    if not ids:
+        return []
+    return (
+        session.query(ConversationHistory)
+        .filter(ConversationHistory.id.in_(ids))
+        .order_by(ConversationHistory.timestamp.desc())
+        .all()
+    )
+
+
+def _cosine_sim(a: list, b: list) -> float:
+    """2つのベクターのコサイン類似度を返す。"""
+    if not a or not b or len(a) != len(b):
+        return 0.0
+    dot = sum(x * y for x, y in zip(a, b))
+    na = sum(x * x for x in a) ** 0.5
+    nb = sum(x * x for x in b) ** 0.5
+    return dot / (na * nb) if na and nb else 0.0
+
+
+def score_conversation_embeddings(session, user_uuid: str, query_vec: list, backend_tag: str,
+                                  limit: int = 4, min_score: float = 0.6) -> List[Tuple[float, Any]]:
+    """クエリベクターと同じバックエンドの会話Embedding(直近300件)を類似度順に返す。"""
+    rows = (
+        session.query(ConversationEmbedding)
+        .filter_by(user_uuid=user_uuid)
+        .filter(embedding_backend_filter(ConversationEmbedding.embedding_backend, backend_tag))
+        .order_by(ConversationEmbedding.created_at.desc())
+        .limit(300)
+        .all()
+    )
+    scored = []
+    for row in rows:
+        if not row.embedding:
+            continue
+        try:
+            vec = json.loads(row.embedding)
+            scored.append((_cosine_sim(query_vec, vec), row))
+        except (json.JSONDecodeError, TypeError):
+            continue
+    scored.sort(key=lambda x: x[0], reverse=True)
+    return [(sc, r) for sc, r in scored[:limit] if sc >= min_score]
+
+
+# ==============================================================================
+# ★ 階層会話要約 (ウォーターマーク駆動)
+# ==============================================================================
+# 全履歴を読み直さず、要約済みの最大 history id (ウォーターマーク) より後ろだけを
+# LIMIT 付きで読んで、3段の要約に畳み込む:
+#   recent - 直近ウィンドウ (新しい会話チャンクの要約で置き換え)
+#   weekly - 今週分 (置き換える前の recent を畳み込む)
+#   all    - これまで全部 (1週間分を超えた weekly を畳み込む)
+# 各段は文字数上限付きなので、履歴がどれだけ長くてもプロンプトコストは一定。
+# 期間は要約した発言の時刻で測る (created_at = その段が覆う最初の発言の時刻)。
+# 要約の無い既存ユーザー・旧形式の要約・長く止まっていて未要約が溜まった場合は、
+# 古い履歴を順に再生せず直近ウィンドウから始める (それより前は要約しない)。
+SUMMARY_LEVELS = ('all', 'weekly', 'recent')
+SUMMARY_RECENT_EXCLUDE = 10     # 直近の会話は履歴として渡しているので要約しない
+SUMMARY_MIN_NEW_MESSAGES = 20   # これ未満なら要約しない
+SUMMARY_WINDOW_MESSAGES = 60    # 1回の要約で読む最大件数
+SUMMARY_CATCHUP_WINDOWS = 5     # 未要約がこのウィンドウ数を超えたら古い分は飛ばす
+SUMMARY_WEEKLY_PERIOD_DAYS = 7
+SUMMARY_MAX_CHARS = {'recent': 1000, 'weekly': 600, 'all': 800}
+SUMMARY_HEADERS = {
+    'all': '【これまでの付き合いまとめ】',
+    'weekly': '【最近1週間の会話まとめ】',
+    'recent': '【過去の会話まとめ（{date}まで）】',
+}
+
+
+def _latest_summaries(session, user_uuid: str) -> Dict[str, Any]:
+    """level ごとの最新要約行 (旧形式の level 無し行は recent 扱い)"""
+    result = {}
+    for level in SUMMARY_LEVELS:
+        q = session.query(ConversationSummary).filter_by(user_uuid=user_uuid)
+        if level == 'recent':
+            q = q.filter(or_(ConversationSummary.level == 'recent', ConversationSummary.level.is_(None)))
+        else:
+            q = q.filter(ConversationSummary.level == level)
+        row = q.order_by(ConversationSummary.id.desc()).first()
+        if row:
+            result[level] = row
+    return result
+
+
+def get_conversation_summary_ctx(session, user_uuid: str) -> str:
+    """階層会話要約 (これまで → 今週 → 直近) をDBから取得してプロンプト注入用テキストで返す。"""
+    try:
+        summaries = _latest_summaries(session, user_uuid)
+        parts = []
+        for level in SUMMARY_LEVELS:
+            row = summaries.get(level)
+            if not row or not row.summary:
+                continue
+            date_str = (row.covered_until + timedelta(hours=9)).strftime('%m/%d')
+            parts.append(SUMMARY_HEADERS[level].format(date=date_str) + '\n' + row.summary)
+        if parts:
+            return '\n' + '\n'.join(parts) + '\n'
+    except Exception as e:
+        logger.error('会話要約取得エラー: ' + str(e))
+    return ''
+
+
+def _generate_memory_summary(prompt: str, max_tokens: int = 400) -> Optional[str]:
+    """要約用の LLM 呼び出し (Gemini → Groq フォールバック、deferred 優先度)"""
+    model = gemini_model_manager.get_current_model()
+    if model:
+        try:
+            resp = model.generate_content(
+                prompt,
+                generation_config={"temperature": 0.3, "max_output_tokens": max_tokens},
+                priority='deferred'
+            )
+            if hasattr(resp, 'candidates') and resp.candidates:
+                return resp.candidates[0].content.parts[0].text.strip()
+        except Exception as e:
+            logger.warning('要約Geminiエラー: ' + str(e))
+    if groq_client:
+        return call_groq(prompt, '', [], max_tokens, task_type='analysis', priority='deferred')
+    return None
+
+
+def _fold_summaries(user_name: str, older: str, newer: str, max_chars: int) -> Optional[str]:
+    """2つの要約を1つにまとめ直す (古い方の重要事項は残し、新しい方で上書き)"""
+    prompt = (
+        '以下は「' + user_name + '」さんともちこの会話の要約2つです（上が古く、下が新しい）。\n'
+        '重複をまとめ、食い違う点は新しい方を優先して、' + str(max_chars // 2) +
+        '文字以内の箇条書き（・）1つに統合してください。好み・出来事・約束は残してください。\n\n'
+        '【古い要約】\n' + older + '\n\n【新しい要約】\n' + newer + '\n\n'
+        '【出力形式】\n・（重要情報1）\n・（重要情報2）\n（前置き不要）'
+    )
+    return _generate_memory_summary(prompt)
+
+
+def _save_summary_level(session, user_uuid: str, summaries: Dict[str, Any], level: str,
+                        text_: str, covered_until: datetime, covered_until_id: Optional[int],
+                        message_count: int, period_start: Optional[datetime] = None):
+    """
+    level の要約行を更新 (無ければ作成)。
+    period_start (その段が覆う最初の発言の時刻) を渡すと created_at を期間の起点として付け直す。
+    """
+    now = datetime.utcnow()
+    row = summaries.get(level)
+    if row is None:
+        row = ConversationSummary(user_uuid=user_uuid, level=level, created_at=period_start or now)
+        session.add(row)
+        summaries[level] = row
+    elif period_start is not None:
+        row.created_at = period_start
+    row.level = level
+    row.summary = text_[:SUMMARY_MAX_CHARS[level]]
+    row.covered_until = covered_until
+    row.covered_until_id = covered_until_id
+    row.message_count = message_count
+    row.updated_at = now
+
+
+def build_conversation_summary_bg(session, user_uuid: str, user_name: str):
+    """
+    ウォーターマーク以降の会話（20件以上）を要約し、階層要約 (recent/weekly/all) に畳み込む。アイドル時実行。
+    読むのは未要約ウィンドウの最大 SUMMARY_WINDOW_MESSAGES 件だけなので、履歴の長さに依存しない。
+    """
+    try:
+        summaries = _latest_summaries(session, user_uuid)
+        recent = summaries.get('recent')
+
+        # 直近 SUMMARY_RECENT_EXCLUDE 件より前だけを対象にする (境界 = 11件目の id)
+        boundary_id = (
+            session.query(ConversationHistory.id)
+            .filter_by(user_uuid=user_uuid)
+            .order_by(ConversationHistory.id.desc())
+            .offset(SUMMARY_RECENT_EXCLUDE)
+            .limit(1)
+            .scalar()
+        )
+        if boundary_id is None:
+            return
+
+        q = session.query(ConversationHistory).filter(
+            ConversationHistory.user_uuid == user_uuid,
+            ConversationHistory.id <= boundary_id,
+        )
+        watermark_id = recent.covered_until_id if recent is not None else None
+        # これより古いウォーターマークからは追いつかない (SUMMARY_CATCHUP_WINDOWS 分より前)
+        catchup_floor = (
+            session.query(ConversationHistory.id)
+            .filter(ConversationHistory.user_uuid == user_uuid, ConversationHistory.id <= boundary_id)
+            .order_by(ConversationHistory.id.desc())
+            .offset(SUMMARY_WINDOW_MESSAGES * SUMMARY_CATCHUP_WINDOWS)
+            .limit(1)
+            .scalar()
+        )
+        if watermark_id is not None and (catchup_floor is None or watermark_id >= catchup_floor):
+            target = (q.filter(ConversationHistory.id > watermark_id)
+                      .order_by(ConversationHistory.id.asc()).limit(SUMMARY_WINDOW_MESSAGES).all())
+        else:
+            # 初回 / 旧形式 / 大きく遅れた場合: 直近ウィンドウだけを要約して、そこをウォーターマークにする
+            if watermark_id is not None:
+                q = q.filter(ConversationHistory.id > watermark_id)
+            elif recent is not None:
+                q = q.filter(ConversationHistory.timestamp > recent.covered_until)
+            target = q.order_by(ConversationHistory.id.desc()).limit(SUMMARY_WINDOW_MESSAGES).all()[::-1]
+        if len(target) < SUMMARY_MIN_NEW_MESSAGES:
+            return
+
+        convo_lines = []
+        for h in target:
+            label = 'あなた' if h.role == 'user' else 'もちこ'
+            convo_lines.append(label + ': ' + h.content[:150])
+        convo_text = '\n'.join(convo_lines)
+        covered_until = target[-1].timestamp
+        covered_until_id = target[-1].id
+
+        prompt = (
+            '以下は「' + user_name + '」さんともちこの過去の会話です。\n'
+            '重要な情報・話題・エピソードを200文字以内で箇条書き（・）にまとめてください。\n'
+            '「' + user_name + 'さんは〜が好き」「〜という話題で盛り上がった」など。\n\n'
+            '【会話】\n' + convo_text + '\n\n'
+            '【出力形式】\n・（重要情報1）\n・（重要情報2）\n（前置き不要）'
+        )
+        summary_text = _generate_memory_summary(prompt)
+        if not summary_text:
+            return
+
+        # 置き換える前の recent を weekly へ畳み込む (畳み込むと1週間分を超える weekly は all へ)
+        if recent is not None and recent.summary:
+            weekly = summaries.get('weekly')
+            period_over = weekly is not None and weekly.created_at and recent.covered_until and (
+                recent.covered_until - weekly.created_at > timedelta(days=SUMMARY_WEEKLY_PERIOD_DAYS))
+            if period_over:
+                all_time = summaries.get('all')
+                folded_all = (_fold_summaries(user_name, all_time.summary, weekly.summary, SUMMARY_MAX_CHARS['all'])
+                              if all_time is not None else weekly.summary)
+                if not folded_all:
+                    return  # 畳み込み失敗時はウォーターマークを進めず次回やり直す
+                _save_summary_level(session, user_uuid, summaries, 'all', folded_all,
+                                    weekly.covered_until, weekly.covered_until_id,
+                                    (all_time.message_count if all_time else 0) + (weekly.message_count or 0),
+                                    period_start=all_time.created_at if all_time else weekly.created_at)
+                _save_summary_level(session, user_uuid, summaries, 'weekly', recent.summary,
+                                    recent.covered_until, recent.covered_until_id,
+                                    recent.message_count or 0, period_start=recent.created_at)
+            elif weekly is None:
+                _save_summary_level(session, user_uuid, summaries, 'weekly', recent.summary,
+                                    recent.covered_until, recent.covered_until_id, recent.message_count or 0,
+                                    period_start=recent.created_at)
+            else:
+                folded_weekly = _fold_summaries(user_name, weekly.summary, recent.summary, SUMMARY_MAX_CHARS['weekly'])
+                if not folded_weekly:
+                    return
+                _save_summary_level(session, user_uuid, summaries, 'weekly', folded_weekly,
+                                    recent.covered_until, recent.covered_until_id,
+                                    (weekly.message_count or 0) + (recent.message_count or 0))
+
+        _save_summary_level(session, user_uuid, summaries, 'recent', summary_text,
+                            covered_until, covered_until_id, len(target), period_start=target[0].timestamp)
+        logger.info(
+            '✅ 会話要約生成: ' + user_name +
+            ' (' + str(len(target)) + '件 → ' + str(len(summary_text)) + '文字, ~id ' + str(covered_until_id) + ')'
+        )
+
+    except Exception as e:
+        logger.error('会話要約エラー: ' + str(e))
+
+
+# 会話Embeddingのバックログ処理
+# 「Embedding行が無い user 発言」を anti-join + LIMIT で新しい順に拾うので、
+# 既存の埋め込み済み id を Python に読み込まずに済む (全ユーザー共通)。
+# 直近の発言も埋め込む (旧実装はユーザーごとに直近10件を飛ばしていた): どの発言もいずれ1回は
+# 埋め込むので呼び出し回数は変わらず、検索側 (HybridRetriever) が直近 HYBRID_RECENT_EXCLUDE 件を
+# 結果から除くので注入内容も変わらない。全ユーザー横断の anti-join にユーザーごとの除外を足すと
+# 窓関数が要り、バックログ取得が重くなるため入れていない。
+# 埋め込みに失敗した発言は embedding=NULL の行で印を付け、EMBED_BACKLOG_RETRY_SECONDS 後に
+# 最大 EMBED_BACKLOG_MAX_ATTEMPTS 回までやり直す。
+EMBED_BACKLOG_BATCH = 32          # 1回の埋め込みリクエストにまとめる件数
+EMBED_BACKLOG_MAX_BATCHES = 10    # 1回の実行で処理する最大バッチ数
+EMBED_BACKLOG_RETRY_SECONDS = 3600
+EMBED_BACKLOG_MAX_ATTEMPTS = 5
+
+
+def embed_history_backlog(max_batches: int = EMBED_BACKLOG_MAX_BATCHES,
+                          batch_size: int = EMBED_BACKLOG_BATCH) -> int:
+    """
+    アイドル時に、まだEmbedding化されていない会話履歴 (全ユーザーの user 発言) を
+    バッチ単位で埋め込んでDB保存する。未処理が無くなったら、前回失敗した行を再試行する。
+    会話が始まったらバッチの切れ目で止める。
+    戻り値: 保存 (再試行で埋まった分を含む) した件数
+    """
+    saved = retried = 0
+    try:
+        for _ in range(max_batches):
+            if not conversation_activity.is_idle():
+                break
+            now = datetime.utcnow()
+            with get_db_session() as session:
+                backlog = (
+                    session.query(ConversationHistory)
+                    .outerjoin(ConversationEmbedding, ConversationEmbedding.history_id == ConversationHistory.id)
+                    .filter(ConversationEmbedding.id.is_(None), ConversationHistory.role == 'user')
+                    .order_by(ConversationHistory.id.desc())
+                    .limit(batch_size)
+                    .all()
+                )
+                if backlog:
+                    vecs, backend_tag = embed_texts([h.content[:500] for h in backlog], task_type='retrieval_document')
+                    if not backend_tag:
+                        logger.warning('Embedding生成エラー: 利用可能なバックエンドなし')
+                        break
+                    # 埋め込めなかった発言も embedding=NULL で行を作る (次回また先頭に来て詰まらないように)
+                    session.add_all([
+                        ConversationEmbedding(
+                            history_id=h.id,
+                            user_uuid=h.user_uuid,
+                            role=h.role,
+                            content_snippet=h.content[:500],
+                            embedding=json.dumps(vec) if vec else None,
+                            embedding_backend=backend_tag,
+                            embed_attempts=1,
+                            attempted_at=now,
+                            created_at=h.timestamp,
+                        )
+                        for h, vec in zip(backlog, vecs)
+                    ])
+                    saved += sum(1 for vec in vecs if vec)
+                    continue
+
+                # 未処理が無ければ、失敗から時間の経った行を再試行する
+                failed = (
+                    session.query(ConversationEmbedding)
+                    .filter(
+                        ConversationEmbedding.embedding.is_(None),
+                        or_(ConversationEmbedding.embed_attempts.is_(None),
+                            ConversationEmbedding.embed_attempts < EMBED_BACKLOG_MAX_ATTEMPTS),
+                        or_(ConversationEmbedding.attempted_at.is_(None),
+                            ConversationEmbedding.attempted_at < now - timedelta(seconds=EMBED_BACKLOG_RETRY_SECONDS)),
+                    )
+                    .order_by(ConversationEmbedding.id.desc())
+                    .limit(batch_size)
+                    .all()
+                )
+                if not failed:
+                    break
+                vecs, backend_tag = embed_texts([r.content_snippet for r in failed], task_type='retrieval_document')
+                if not backend_tag:
+                    break
+                for r, vec in zip(failed, vecs):
+                    r.embed_attempts = (r.embed_attempts or 1) + 1
+                    r.attempted_at = now
+                    if vec:
+                        r.embedding = json.dumps(vec)
+                        r.embedding_backend = backend_tag
+                        retried += 1
+        if saved or retried:
+            logger.info(f'✅ 会話Embeddingバックログ: {saved}件 (再試行で{retried}件)')
+    except Exception as e:
+        logger.error('embed_history_backlog エラー: ' + str(e))
+    return saved + retried
+
+
+def _local_embed_rows(rows, text_attr: str) -> List[Optional[List[float]]]:
+    return [local_embedding_backend.embed(getattr(r, text_attr) or '') for r in rows]
+
+
+def maintain_local_embeddings(limit: int = LOCAL_MAINTAIN_BATCH) -> Dict[str, int]:
+    """
+    ローカルEmbeddingの保守 (定期タスク)。
+      1) IDFが未学習なら学習する
+      2) 旧指紋 ('uniform' 等) のローカルベクトルを現在の指紋で埋め込み直す
+      3) EMBEDDING_BACKEND が 'gemini' 以外なら、Geminiで保存された行にローカル版を並べて保存する
+    Memvid の行は索引が id の透かしで取り込むため、書き換えずに新しい行を足して旧行を消す。
+    戻り値: {'reembedded': 件数, 'mirrored': 件数}
+    """
+    stats = {'reembedded': 0, 'mirrored': 0}
+    if local_embedding_backend is None or not Session:
+        return stats
+    local_embedding_backend.ensure_fitted()
+    tag = local_embedding_backend.tag()
 
+    def stale_filter(col):
+        return and_(col.like(f"{LOCAL_EMBED_VERSION}:%"), col != tag)
 
-def search_history_by_keyword(session, user_uuid: str, message: str, limit: int = 5) -> str:
-    """Step2: LIKE検索で過去の関連発言を取得する。毎回実行・ロスほぼ0。"""
     try:
-        stop_words = {
-            'は', 'が', 'を', 'に', 'で', 'と', 'も', 'の', 'か',
-            'て', 'し', 'た', 'だ', 'な', 'よ', 'ね', 'よね',
-            'じゃん', 'って', 'けど', 'から', 'まじ', 'やばい',
-        }
-        words = [
-            w for w in re.findall(r'[ぁ-んァ-ヶーa-zA-Z0-9一-龥]{2,}', message)
-            if w not in stop_words
-        ]
-        if not words:
-            return ''
+        with get_db_session() as session:
+            rows = session.query(MemvidEmbedding).filter(
+                stale_filter(MemvidEmbedding.embedding_backend)
+            ).order_by(MemvidEmbedding.id.desc()).limit(limit).all()
+            for r, vec in zip(rows, _local_embed_rows(rows, 'content')):
+                if vec:
+                    session.add(MemvidEmbedding(
+                        chunk_type=r.chunk_type, source_id=r.source_id, user_uuid=r.user_uuid,
+                        content=r.content, embedding_json=json.dumps(vec), embedding_dim=len(vec),
+                        embedding_backend=tag, content_hash=r.content_hash, created_at=r.created_at,
+                    ))
+                session.delete(r)
+            stats['reembedded'] += len(rows)
+
+            rows = session.query(ConversationEmbedding).filter(
+                stale_filter(ConversationEmbedding.embedding_backend)
+            ).order_by(ConversationEmbedding.id.desc()).limit(limit).all()
+            for r, vec in zip(rows, _local_embed_rows(rows, 'content_snippet')):
+                r.embedding = json.dumps(vec) if vec else None
+                r.embedding_backend = tag
+            stats['reembedded'] += len(rows)
+
+        if EMBEDDING_BACKEND != 'gemini' and conversation_activity.is_idle():
+            with get_db_session() as session:
+                local = aliased(MemvidEmbedding)
+                rows = session.query(MemvidEmbedding).outerjoin(local, and_(
+                    local.chunk_type == MemvidEmbedding.chunk_type,
+                    local.source_id.is_not_distinct_from(MemvidEmbedding.source_id),
+                    local.user_uuid.is_not_distinct_from(MemvidEmbedding.user_uuid),
+                    local.content == MemvidEmbedding.content,
+                    local.embedding_backend.like(f"{LOCAL_EMBED_VERSION}:%"),
+                )).filter(
+                    local.id.is_(None),
+                    MemvidEmbedding.embedding_json.isnot(None),
+                    embedding_backend_filter(MemvidEmbedding.embedding_backend, EMBEDDING_MODEL),
+                ).order_by(MemvidEmbedding.id.desc()).limit(limit).all()
+                session.add_all([
+                    MemvidEmbedding(
+                        chunk_type=r.chunk_type, source_id=r.source_id, user_uuid=r.user_uuid,
+                        content=r.content, embedding_json=json.dumps(vec), embedding_dim=len(vec),
+                        embedding_backend=tag, content_hash=r.content_hash, created_at=r.created_at,
+                    )
+                    for r, vec in zip(rows, _local_embed_rows(rows, 'content')) if vec
+                ])
+                stats['mirrored'] += len(rows)
+
+                local = aliased(ConversationEmbedding)
+                rows = session.query(ConversationEmbedding).outerjoin(local, and_(
+                    local.history_id == ConversationEmbedding.history_id,
+                    local.embedding_backend.like(f"{LOCAL_EMBED_VERSION}:%"),
+                )).filter(
+                    local.id.is_(None),
+                    ConversationEmbedding.embedding.isnot(None),
+                    embedding_backend_filter(ConversationEmbedding.embedding_backend, EMBEDDING_MODEL),
+                ).order_by(ConversationEmbedding.id.desc()).limit(limit).all()
+                session.add_all([
+                    ConversationEmbedding(
+                        history_id=r.history_id, user_uuid=r.user_uuid, role=r.role,
+                        content_snippet=r.content_snippet, embedding=json.dumps(vec),
+                        embedding_backend=tag, created_at=r.created_at,
+                    )
+                    for r, vec in zip(rows, _local_embed_rows(rows, 'content_snippet')) if vec
+                ])
+                stats['mirrored'] += len(rows)
+    except Exception as e:
+        logger.error(f"maintain_local_embeddings エラー: {e}")
+    if stats['reembedded'] or stats['mirrored']:
+        memvid_vector_index.mark_dirty()
+        logger.info(f"🧮 ローカルEmbedding保守: 再埋め込み{stats['reembedded']}件 / ローカル版追加{stats['mirrored']}件")
+    return stats
 
-        search_words = words[:3]
-        recent_ids = [
-            row.id for row in
-            session.query(ConversationHistory.id)
-            .filter_by(user_uuid=user_uuid)
-            .order_by(ConversationHistory.timestamp.desc())
-            .limit(10).all()
-        ]
 
-        results = []
-        for word in search_words:
-            hits = (
-                session.query(ConversationHistory)
-                .filter(
-                    ConversationHistory.user_uuid == user_uuid,
-                    ConversationHistory.content.ilike('%' + word + '%'),
-                )
-                .order_by(ConversationHistory.timestamp.desc())
-                .limit(limit)
-                .all()
-            )
-            results.extend([h for h in hits if h.id not in recent_ids])
+# ==============================================================================
+# ★ ハイブリッド検索 (文字bigram BM25 + ベクトル検索 → RRF統合)
+# ==============================================================================
+# 旧方式は LIKE検索・Embedding検索・Memvid検索をそれぞれ実行して
+# 結果を単純連結していたため、同じ発言が重複したり、どれが重要か分からなかった。
+# 語彙一致 (BM25) と意味一致 (ベクトル) の順位を Reciprocal Rank Fusion で
+# 1本のランキングにまとめ、共通の top-k 枠だけをプロンプトに注入する。
+HYBRID_TOP_K = 6
+HYBRID_RRF_K = 60
+HYBRID_LANE_DEPTH = 20                 # 各レーンから取る候補数
+HYBRID_KNOWLEDGE_REFRESH_SECONDS = 60  # 知識インデックスの差分取り込み間隔
+HYBRID_RECENT_EXCLUDE = 10             # 直近の会話は履歴として渡しているので除外
+BM25_K1 = 1.2
+BM25_B = 0.75
 
-        if not results:
-            return ''
 
-        seen = set()
-        unique = []
-        for r in sorted(results, key=lambda x: x.timestamp, reverse=True):
-            if r.id not in seen:
-                seen.add(r.id)
-                unique.append(r)
+def char_bigrams(text: str) -> List[str]:
+    """NFKC正規化・小文字化した文字bigram列 (空白を含むものは除く)"""
+    t = unicodedata.normalize('NFKC', text or '').lower()
+    return [t[i:i + 2] for i in range(len(t) - 1) if not (t[i].isspace() or t[i + 1].isspace())]
 
-        out_lines = []
-        for r in unique[:limit]:
-            jst = (r.timestamp + timedelta(hours=9)).strftime('%m/%d %H:%M')
-            role_label = 'あなた' if r.role == 'user' else 'もちこ'
-            out_lines.append('  [' + jst + '] ' + role_label + ': ' + r.content[:120])
 
-        return '【過去の関連会話（キーワード検索）】\n' + '\n'.join(out_lines)
+class CharBigramBM25Index:
+    """文字bigramの転置インデックス + BM25スコアリング (日本語の分かち書き不要)"""
 
-    except Exception as e:
-        logger.error('LIKE検索エラー: ' + str(e))
-        return ''
+    def __init__(self):
+        self._lock = RLock()
+        self._postings: Dict[str, Dict[Any, int]] = defaultdict(dict)  # bigram -> {doc_id: tf}
+        self._doc_grams: Dict[Any, List[str]] = {}
+        self._doc_len: Dict[Any, int] = {}
+        self._total_len = 0
 
+    def __len__(self) -> int:
+        return len(self._doc_len)
 
-def _embed_text_simple(text: str) -> list:
-    """Gemini text-embedding-004 でテキストをベクター化する。失敗時は空リスト。"""
-    try:
-        result = genai.embed_content(
-            model='models/text-embedding-004',
-            content=text[:2000],
-            task_type='RETRIEVAL_DOCUMENT',
-        )
-        return result['embedding']
-    except Exception as e:
-        logger.warning('Embedding生成エラー: ' + str(e))
-        return []
+    def __contains__(self, doc_id) -> bool:
+        return doc_id in self._doc_len
 
+    def add(self, doc_id, text: str):
+        grams = char_bigrams(text)
+        counts = Counter(grams)
+        with self._lock:
+            self.remove(doc_id)
+            for g, tf in counts.items():
+                self._postings[g][doc_id] = tf
+            self._doc_grams[doc_id] = list(counts.keys())
+            self._doc_len[doc_id] = len(grams)
+            self._total_len += len(grams)
+
+    def remove(self, doc_id):
+        with self._lock:
+            grams = self._doc_grams.pop(doc_id, None)
+            if grams is None:
+                return
+            for g in grams:
+                plist = self._postings.get(g)
+                if plist is not None:
+                    plist.pop(doc_id, None)
+                    if not plist:
+                        del self._postings[g]
+            self._total_len -= self._doc_len.pop(doc_id, 0)
+
+    def search(self, query: str, top_k: int = 10, exclude: Optional[set] = None) -> List[Tuple[Any, float]]:
+        """BM25スコア上位 top_k 件を [(doc_id, score)] で返す"""
+        qgrams = set(char_bigrams(query))
+        with self._lock:
+            n_docs = len(self._doc_len)
+            if not qgrams or n_docs == 0:
+                return []
+            avgdl = (self._total_len / n_docs) or 1.0
+            scores: Dict[Any, float] = defaultdict(float)
+            for g in qgrams:
+                plist = self._postings.get(g)
+                if not plist:
+                    continue
+                df = len(plist)
+                idf = math.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+                for doc_id, tf in plist.items():
+                    dl = self._doc_len[doc_id]
+                    scores[doc_id] += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * dl / avgdl))
+        if exclude:
+            for doc_id in exclude:
+                scores.pop(doc_id, None)
+        return heapq.nlargest(top_k, scores.items(), key=lambda x: x[1])
+
+
+def reciprocal_rank_fusion(rankings: List[List[Any]], k: int = HYBRID_RRF_K) -> List[Tuple[Any, float]]:
+    """複数の順位リスト (doc_id の列) を RRF スコア降順の [(doc_id, score)] に統合する"""
+    fused: Dict[Any, float] = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            fused[doc_id] += 1.0 / (k + rank + 1)
+    return sorted(fused.items(), key=lambda x: x[1], reverse=True)
 
-def _cosine_sim(a: list, b: list) -> float:
-    """2つのベクターのコサイン類似度を返す。"""
-    if not a or not b or len(a) != len(b):
-        return 0.0
-    dot = sum(x * y for x, y in zip(a, b))
-    na = sum(x * x for x in a) ** 0.5
-    nb = sum(x * x for x in b) ** 0.5
-    return dot / (na * nb) if na and nb else 0.0
 
+# ==============================================================================
+# ★ MMR 多様性リランキング + 重複まとめ
+# ==============================================================================
+# 同じニュースが複数ソースから当たる等、ほぼ同じ内容をプロンプトに何度も入れると
+# トークンを無駄にしてレイテンシ・クォータを圧迫する。注入前に
+#   1) 類似度が閾値以上の候補は関連度の高い1件にまとめ
+#   2) 残りを Maximal Marginal Relevance で選ぶ
+# 候補間の類似度はローカル文字n-gramベクトル (ネットワーク不要・決定的) の行列積で求める。
+# ローカルバックエンドは保存済みIDFを使うだけなので、リクエストスレッドでDBを読むことはない
+# (IDF学習は maintain_local_embeddings の定期タスク)。
+# 適用するのは HybridRetriever.retrieve() の最終段だけ (他の注入経路はそれぞれの上限で切る)。
+# chunk_type ごとに lambda (関連度の重み) / dup (重複とみなす類似度) / max (最大件数) を設定できる。
+# RAG_RERANK_OVERRIDES='{"hololive_news": {"max": 1}}' のように環境変数で上書き可能。
+MMR_POOL_FACTOR = 3    # top_k の何倍の候補から選ぶか
+RERANK_TYPE_CONFIG: Dict[str, Dict[str, Any]] = {
+    'default':          {'lambda': 0.7, 'dup': 0.90, 'max': None},
+    'hololive_news':    {'lambda': 0.6, 'dup': 0.85, 'max': 3},
+    'specialized_news': {'lambda': 0.6, 'dup': 0.85, 'max': 3},
+    'secondlife_news':  {'lambda': 0.6, 'dup': 0.85, 'max': 2},
+    'holomem_wiki':     {'lambda': 0.7, 'dup': 0.90, 'max': 2},
+    'taught_knowledge': {'lambda': 0.7, 'dup': 0.90, 'max': 2},
+    'conversation':     {'lambda': 0.8, 'dup': 0.95, 'max': None},
+}
+try:
+    for _rt, _rc in json.loads(os.environ.get('RAG_RERANK_OVERRIDES', '') or '{}').items():
+        RERANK_TYPE_CONFIG[_rt] = {**RERANK_TYPE_CONFIG.get(_rt, RERANK_TYPE_CONFIG['default']), **_rc}
+except Exception as _e:
+    logger.warning(f"⚠️ RAG_RERANK_OVERRIDES の解析に失敗: {_e}")
+
+# HybridRetriever の kind を chunk_type に揃える
+_RERANK_KIND_ALIASES = {
+    'news': 'hololive_news', 'wiki': 'holomem_wiki', 'taught': 'taught_knowledge', 'conv': 'conversation',
+}
 
-def search_history_by_embedding(session, user_uuid: str, message: str, limit: int = 4) -> str:
-    """Step3: Embeddingベクター類似検索。トリガーワード検出時のみ呼ばれる。"""
-    try:
-        query_vec = _embed_text_simple(message)
-        if not query_vec:
-            return ''
 
-        rows = (
-            session.query(ConversationEmbedding)
-            .filter_by(user_uuid=user_uuid)
-            .order_by(ConversationEmbedding.created_at.desc())
-            .limit(300)
-            .all()
-        )
-        if not rows:
-            return ''
+def rerank_type(item: Dict) -> str:
+    kind = item.get('chunk_type') or item.get('kind') or 'default'
+    return _RERANK_KIND_ALIASES.get(kind, kind)
 
-        scored = []
-        for row in rows:
-            if not row.embedding:
-                continue
-            try:
-                vec = json.loads(row.embedding)
-                score = _cosine_sim(query_vec, vec)
-                scored.append((score, row))
-            except (json.JSONDecodeError, TypeError):
-                continue
 
-        scored.sort(key=lambda x: x[0], reverse=True)
-        top = [(s, r) for s, r in scored[:limit] if s >= 0.6]
-        if not top:
-            return ''
+def mmr_rerank(items: List[Dict], top_k: int, relevance: Optional[List[float]] = None,
+               text_key: str = 'text') -> List[Dict]:
+    """
+    重複まとめ + MMR で items から最大 top_k 件を選ぶ。
+    relevance 省略時は items の並び順を関連度とみなす。NumPyが無い時は先頭 top_k 件を返す。
+    """
+    n = len(items)
+    if n <= 1 or not HAS_NUMPY or local_embedding_backend is None:
+        return items[:top_k]
 
-        out_lines = []
-        for score, row in top:
-            jst = (row.created_at + timedelta(hours=9)).strftime('%m/%d %H:%M')
-            role_label = 'あなた' if row.role == 'user' else 'もちこ'
-            out_lines.append(
-                '  [' + jst + '] ' + role_label +
-                '(類似度' + str(round(score, 2)) + '): ' + row.content_snippet[:120]
-            )
+    rel = np.asarray(relevance if relevance is not None else range(n, 0, -1), dtype=np.float32)
+    span = float(rel.max() - rel.min())
+    rel = (rel - rel.min()) / span if span > 0 else np.ones(n, dtype=np.float32)
 
-        return '【過去の類似会話（意味検索）】\n' + '\n'.join(out_lines)
+    types = [rerank_type(it) for it in items]
+    configs = [RERANK_TYPE_CONFIG.get(t, RERANK_TYPE_CONFIG['default']) for t in types]
+    lam = np.array([c['lambda'] for c in configs], dtype=np.float32)
+    dup = np.array([c['dup'] for c in configs], dtype=np.float32)
 
-    except Exception as e:
-        logger.error('Embedding検索エラー: ' + str(e))
-        return ''
+    vecs = np.zeros((n, LOCAL_EMBED_DIM), dtype=np.float32)
+    for i, it in enumerate(items):
+        v = local_embedding_backend.embed(it.get(text_key) or '')
+        if v:
+            vecs[i] = v
+    sim = vecs @ vecs.T
 
+    # 1) 重複まとめ: 関連度順に見て、採用済みのどれかと閾値以上に似ていれば捨てる
+    alive = np.zeros(n, dtype=bool)
+    for i in np.argsort(-rel, kind='stable'):
+        if alive.any() and bool((sim[i, alive] >= dup[i]).any()):
+            continue
+        alive[i] = True
+    collapsed = n - int(alive.sum())
+
+    # 2) MMR: lambda*関連度 - (1-lambda)*選択済みとの最大類似度
+    selected: List[int] = []
+    max_sim = np.zeros(n, dtype=np.float32)
+    per_type: Counter = Counter()
+    while alive.any() and len(selected) < top_k:
+        score = lam * rel - (1.0 - lam) * max_sim
+        score[~alive] = -np.inf
+        j = int(np.argmax(score))
+        alive[j] = False
+        cap = configs[j]['max']
+        if cap is not None and per_type[types[j]] >= cap:
+            continue
+        per_type[types[j]] += 1
+        selected.append(j)
+        np.maximum(max_sim, sim[:, j], out=max_sim)
 
-def get_conversation_summary_ctx(session, user_uuid: str) -> str:
-    """最新の会話要約をDBから取得してプロンプト注入用テキストで返す。"""
-    try:
-        summary = (
-            session.query(ConversationSummary)
-            .filter_by(user_uuid=user_uuid)
-            .order_by(ConversationSummary.created_at.desc())
-            .first()
-        )
-        if summary:
-            date_str = (summary.covered_until + timedelta(hours=9)).strftime('%m/%d')
-            header = '【過去の会話まとめ（' + date_str + 'まで）】'
-            return '\n' + header + '\n' + summary.summary + '\n'
-    except Exception as e:
-        logger.error('会話要約取得エラー: ' + str(e))
-    return ''
+    if collapsed:
+        logger.debug(f"🔎 MMR: 重複{collapsed}件をまとめ {n}→{len(selected)}件")
+    return [items[j] for j in selected]
 
 
-def build_conversation_summary_bg(session, user_uuid: str, user_name: str):
-    """過去の会話履歴（20往復以上）をGemini/Groqで要約してDB保存。アイドル時実行。"""
-    try:
-        all_hist = (
-            session.query(ConversationHistory)
-            .filter_by(user_uuid=user_uuid)
-            .order_by(ConversationHistory.timestamp.desc())
-            .all()
-        )
-        target = all_hist[10:]
-        if len(target) < 20:
-            return
+class HybridRetriever:
+    """
+    会話・ニュース・Wiki・教わった知識を対象にしたハイブリッド検索。
 
-        latest_summary = (
-            session.query(ConversationSummary)
-            .filter_by(user_uuid=user_uuid)
-            .order_by(ConversationSummary.created_at.desc())
-            .first()
-        )
-        if latest_summary:
-            target = [h for h in target if h.timestamp > latest_summary.covered_until]
-            if len(target) < 20:
-                return
+    レーン:
+      - BM25(知識):  ニュース / Wiki (差分取り込みのメモリ内インデックス)
+      - 関連度:      教わった知識 (taught_knowledge_index)
+      - BM25(会話):  DBの転置インデックスで候補を絞ったユーザーの会話履歴
+      - ベクトル:    Memvid (知識 + そのユーザーの会話チャンク)
+                     + 思い出しトリガー時は conversation_embeddings
+    doc_id は ('conv', history_id) / ('news', id) / ('wiki', id) / ('taught', id) 等で
+    レーン間で共通なので、同じ文書が複数レーンで当たると RRF で上位に来る。
+    """
 
-        target_sorted = sorted(target, key=lambda x: x.timestamp)[-60:]
-        convo_lines = []
-        for h in target_sorted:
-            label = 'あなた' if h.role == 'user' else 'もちこ'
-            convo_lines.append(label + ': ' + h.content[:150])
-        convo_text = '\n'.join(convo_lines)
-        covered_until = target_sorted[-1].timestamp
+    KNOWLEDGE_LABELS = {
+        'news': '📰ニュース',
+        'wiki': '📖Wiki',
+        'taught': '🧠教わった知識',
+        'memvid': '📌',
+    }
 
-        prompt = (
-            '以下は「' + user_name + '」さんともちこの過去の会話です。\n'
-            '重要な情報・話題・エピソードを200文字以内で箇条書き（・）にまとめてください。\n'
-            '「' + user_name + 'さんは〜が好き」「〜という話題で盛り上がった」など。\n\n'
-            '【会話】\n' + convo_text + '\n\n'
-            '【出力形式】\n・（重要情報1）\n・（重要情報2）\n（前置き不要）'
-        )
+    def __init__(self):
+        self._lock = RLock()
+        self._knowledge = CharBigramBM25Index()
+        self._knowledge_docs: Dict[Tuple[str, Any], Dict] = {}
+        self._knowledge_marks: Dict[str, Optional[datetime]] = {'news': None, 'wiki': None}
+        self._knowledge_checked_at = 0.0
+        self._refresh_lock = Lock()
+
+    # ----- 知識インデックス -----
+    def _put_knowledge(self, kind: str, row_id: int, text_body: str, display: str):
+        doc_id = (kind, row_id)
+        self._knowledge.add(doc_id, text_body)
+        self._knowledge_docs[doc_id] = {'kind': kind, 'text': display}
+
+    def refresh_knowledge(self, force: bool = False):
+        """
+        前回以降に追加・更新された知識行を取り込み、元テーブルから消えた行を落とす。
+        初回は全件読むので起動時にバックグラウンドで呼び、検索側は maybe_refresh_knowledge() で
+        待たずに今あるインデックスを使う。
+        """
+        if not Session:
+            return
+        if not force and time.time() - self._knowledge_checked_at < HYBRID_KNOWLEDGE_REFRESH_SECONDS:
+            return
+        if not self._refresh_lock.acquire(blocking=False):
+            return  # 他スレッドが取り込み中
+        try:
+            self._knowledge_checked_at = time.time()
+            added = removed = 0
+            with get_db_session() as session:
+                marks = self._knowledge_marks
+
+                q = session.query(HololiveNews)
+                if marks['news']:
+                    q = q.filter(HololiveNews.created_at >= marks['news'])
+                for n in q.all():
+                    body = n.content if n.content and n.content != n.title else ''
+                    self._put_knowledge('news', n.id, f"{n.title}\n{body}",
+                                        f"【{n.title}】{body[:200]}")
+                    if n.created_at and (marks['news'] is None or n.created_at > marks['news']):
+                        marks['news'] = n.created_at
+                    added += 1
+
+                q = session.query(HolomemWiki)
+                if marks['wiki']:
+                    q = q.filter(HolomemWiki.last_updated >= marks['wiki'])
+                for w in q.all():
+                    body = f"{w.description or ''}\n{w.episodes or ''}"
+                    self._put_knowledge('wiki', w.id, f"{w.member_name}\n{body}",
+                                        f"{w.member_name}: {body.strip()[:200]}")
+                    if w.last_updated and (marks['wiki'] is None or w.last_updated > marks['wiki']):
+                        marks['wiki'] = w.last_updated
+                    added += 1
+
+                # 削除の反映: id だけ読んで、インデックスにあって元テーブルに無い行を落とす
+                live = {('news', r.id) for r in session.query(HololiveNews.id)}
+                live.update(('wiki', r.id) for r in session.query(HolomemWiki.id))
+            with self._lock:
+                for doc_id in [d for d in self._knowledge_docs if d not in live]:
+                    self._knowledge.remove(doc_id)
+                    self._knowledge_docs.pop(doc_id, None)
+                    removed += 1
+            if force or added > 50 or removed:
+                logger.info(f"🔎 ハイブリッド検索: 知識インデックス {len(self._knowledge)}件 (+{added} / -{removed})")
+        except Exception as e:
+            logger.warning(f"⚠️ ハイブリッド検索: 知識インデックス更新失敗: {e}")
+        finally:
+            self._refresh_lock.release()
 
-        summary_text = None
-        model = gemini_model_manager.get_current_model()
-        if model:
-            try:
-                resp = model.generate_content(
-                    prompt,
-                    generation_config={"temperature": 0.3, "max_output_tokens": 400}
-                )
-                if hasattr(resp, 'candidates') and resp.candidates:
-                    summary_text = resp.candidates[0].content.parts[0].text.strip()
-            except Exception as e:
-                logger.warning('要約Geminiエラー: ' + str(e))
+    def maybe_refresh_knowledge(self):
+        """取り込み時期ならバックグラウンドで refresh_knowledge() を走らせる (呼び出し側は待たない)"""
+        if Session and time.time() - self._knowledge_checked_at >= HYBRID_KNOWLEDGE_REFRESH_SECONDS:
+            background_executor.submit(self.refresh_knowledge)
 
-        if not summary_text and groq_client:
-            summary_text = call_groq(prompt, '', [], 400, task_type='analysis')
+    # ----- 会話 (DBの転置インデックスで候補を絞ってから BM25) -----
+    def _conversation_hits(self, user_uuid: str, query: str) -> Tuple[List[Tuple[Any, float]], Dict, set]:
+        """(BM25順位, doc辞書, 直近除外id集合) を返す"""
+        with get_db_session() as session:
+            recent_ids = recent_history_ids(session, user_uuid, HYBRID_RECENT_EXCLUDE)
+            rows = find_history_by_keywords(session, user_uuid, query, exclude_ids=recent_ids)
+            docs = {
+                ('conv', r.id): {'kind': 'conv', 'role': r.role, 'timestamp': r.timestamp, 'text': r.content}
+                for r in rows if r.content
+            }
+        recent = {('conv', i) for i in recent_ids}
+        index = CharBigramBM25Index()
+        for doc_id, d in docs.items():
+            index.add(doc_id, d['text'])
+        return index.search(query, top_k=HYBRID_LANE_DEPTH), docs, recent
+
+    # ----- 検索本体 -----
+    def retrieve(self, user_uuid: Optional[str], query: str, top_k: int = HYBRID_TOP_K,
+                 use_conversation_embeddings: bool = False) -> List[Dict]:
+        """
+        全レーンを検索して RRF で統合した上位 top_k 件を返す。
+        戻り値: [{'kind', 'text', 'score', 'role'?, 'timestamp'?}]
+        """
+        if not query or not Session:
+            return []
+        rankings: List[List[Any]] = []
+        docs: Dict[Any, Dict] = {}
 
-        if summary_text:
-            session.add(ConversationSummary(
-                user_uuid=user_uuid,
-                summary=summary_text[:1000],
-                covered_until=covered_until,
-                message_count=len(target_sorted),
-            ))
-            logger.info(
-                '✅ 会話要約生成: ' + user_name +
-                ' (' + str(len(target_sorted)) + '件 → ' + str(len(summary_text)) + '文字)'
-            )
+        # BM25: 知識
+        try:
+            self.maybe_refresh_knowledge()
+            # 取り込みと並行して削除された行は飛ばす
+            hits = [(doc_id, self._knowledge_docs.get(doc_id))
+                    for doc_id, _ in self._knowledge.search(query, top_k=HYBRID_LANE_DEPTH)]
+            hits = [(doc_id, d) for doc_id, d in hits if d is not None]
+            rankings.append([doc_id for doc_id, _ in hits])
+            for doc_id, d in hits:
+                docs[doc_id] = d
+        except Exception as e:
+            logger.debug(f"BM25(知識)検索エラー: {e}")
 
-    except Exception as e:
-        logger.error('会話要約エラー: ' + str(e))
+        # bigram関連度: 教わった知識 (書き込み時に更新される関連度インデックス)
+        try:
+            hits = taught_knowledge_index.search(query, limit=HYBRID_LANE_DEPTH, min_hits=2)
+            rankings.append([('taught', doc_id) for doc_id, _ in hits])
+            for doc_id, it in hits:
+                docs[('taught', doc_id)] = {'kind': 'taught', 'text': f"【{it['title']}】{(it['content'] or '')[:300]}"}
+        except Exception as e:
+            logger.debug(f"教わった知識検索エラー: {e}")
 
+        # BM25: 会話
+        recent = set()
+        if user_uuid:
+            try:
+                hits, conv_docs, recent = self._conversation_hits(user_uuid, query)
+                rankings.append([doc_id for doc_id, _ in hits])
+                for doc_id, _ in hits:
+                    docs[doc_id] = conv_docs[doc_id]
+            except Exception as e:
+                logger.debug(f"BM25(会話)検索エラー: {e}")
 
-def embed_new_history_bg(user_uuid: str):
-    """アイドル時に新しい会話履歴をEmbedding化してDB保存。1回最大20件。"""
-    try:
-        with get_db_session() as session:
-            embedded_ids = {
-                row.history_id
-                for row in session.query(ConversationEmbedding.history_id)
-                .filter_by(user_uuid=user_uuid).all()
-            }
-            all_hist = (
-                session.query(ConversationHistory)
-                .filter(
-                    ConversationHistory.user_uuid == user_uuid,
-                    ConversationHistory.role == 'user',
+        # ベクトル: Memvid (知識 + このユーザーの会話チャンク) / 会話Embedding
+        query_vec, backend_tag = embed_text(query, task_type='retrieval_document')
+        if query_vec:
+            try:
+                vec_ranking = []
+                vec_hits = memvid_rag.search_by_vector(
+                    query_vec, backend_tag, top_k=HYBRID_LANE_DEPTH, min_similarity=0.6,
+                    exclude_chunk_types=['conversation']
                 )
-                .order_by(ConversationHistory.timestamp.desc())
-                .all()
-            )
-            new_hist = [h for h in all_hist[10:] if h.id not in embedded_ids][:20]
-
-            if not new_hist:
-                return
+                if user_uuid:
+                    vec_hits += memvid_rag.search_by_vector(
+                        query_vec, backend_tag, chunk_types=['conversation'], user_uuid=user_uuid,
+                        top_k=HYBRID_LANE_DEPTH // 2, min_similarity=0.7
+                    )
+                vec_hits.sort(key=lambda x: x['similarity'], reverse=True)
+                seen = set()
+                for hit in vec_hits:
+                    kind = {
+                        'hololive_news': 'news', 'holomem_wiki': 'wiki', 'taught_knowledge': 'taught',
+                    }.get(hit['chunk_type'])
+                    if kind and hit.get('source_id') is not None:
+                        doc_id = (kind, hit['source_id'])
+                        if doc_id in seen:
+                            continue
+                        # 文書の先頭ではなく、最も近かった段落 (チャンク) を見せる
+                        docs[doc_id] = {'kind': kind, 'text': re.sub(r'\s*\n\s*', ' ', hit['content'])[:300]}
+                    else:
+                        doc_id = ('memvid', hashlib.md5(hit['content'].encode('utf-8')).hexdigest())
+                        docs.setdefault(doc_id, {
+                            'kind': 'memvid',
+                            'chunk_type': hit['chunk_type'],
+                            'text': hit['content'][:200],
+                            'label': MemvidRAG.CHUNK_LABELS.get(hit['chunk_type'], '📌'),
+                        })
+                        if doc_id in seen:
+                            continue
+                    seen.add(doc_id)
+                    vec_ranking.append(doc_id)
+                rankings.append(vec_ranking)
+            except Exception as e:
+                logger.debug(f"ベクトル(Memvid)検索エラー: {e}")
 
-            logger.info('🔢 Embedding化開始: ' + user_uuid[:8] + ' ' + str(len(new_hist)) + '件')
-            for hist in new_hist:
-                if not conversation_activity.is_idle():
-                    break
-                vec = _embed_text_simple(hist.content[:500])
-                if not vec:
-                    continue
-                session.add(ConversationEmbedding(
-                    history_id=hist.id,
-                    user_uuid=user_uuid,
-                    role=hist.role,
-                    content_snippet=hist.content[:500],
-                    embedding=json.dumps(vec),
-                    created_at=hist.timestamp,
-                ))
-                time.sleep(0.1)
+            if user_uuid and use_conversation_embeddings:
+                try:
+                    with get_db_session() as session:
+                        emb_hits = score_conversation_embeddings(
+                            session, user_uuid, query_vec, backend_tag, limit=HYBRID_LANE_DEPTH
+                        )
+                        emb_ranking = []
+                        for score, row in emb_hits:
+                            doc_id = ('conv', row.history_id)
+                            if doc_id in recent:
+                                continue
+                            docs.setdefault(doc_id, {
+                                'kind': 'conv', 'role': row.role,
+                                'timestamp': row.created_at, 'text': row.content_snippet,
+                            })
+                            emb_ranking.append(doc_id)
+                    rankings.append(emb_ranking)
+                except Exception as e:
+                    logger.debug(f"ベクトル(会話)検索エラー: {e}")
 
-            logger.info('✅ Embedding化完了: ' + user_uuid[:8])
+        results = []
+        for doc_id, score in reciprocal_rank_fusion(rankings)[:top_k * MMR_POOL_FACTOR]:
+            item = dict(docs[doc_id])
+            item['score'] = score
+            results.append(item)
+        return mmr_rerank(results, top_k, relevance=[r['score'] for r in results])
+
+    def get_context(self, user_uuid: Optional[str], query: str, top_k: int = HYBRID_TOP_K,
+                    use_conversation_embeddings: bool = False) -> str:
+        """retrieve() の結果をプロンプト注入用テキストにする"""
+        results = self.retrieve(user_uuid, query, top_k=top_k,
+                                use_conversation_embeddings=use_conversation_embeddings)
+        if not results:
+            return ''
+        lines = []
+        for r in results:
+            if r['kind'] == 'conv':
+                jst = (r['timestamp'] + timedelta(hours=9)).strftime('%m/%d %H:%M') if r.get('timestamp') else '--/-- --:--'
+                role_label = 'あなた' if r.get('role') == 'user' else 'もちこ'
+                lines.append('  [' + jst + '] ' + role_label + ': ' + r['text'][:120])
+            else:
+                label = r.get('label') or self.KNOWLEDGE_LABELS.get(r['kind'], '📌')
+                lines.append(f"  {label}: {r['text']}")
+        return "\n\n【関連する過去の会話・知識（ハイブリッド検索）】\n" + "\n".join(lines)
 
-    except Exception as e:
-        logger.error('embed_new_history_bg エラー: ' + str(e))
 
+hybrid_retriever = HybridRetriever()
 
 
 def get_or_create_user(session, user_uuid: str, user_name: str) -> UserData:
@@ -2416,6 +6087,7 @@ _holomem_cache_lock = threading.Lock()
 _holomem_cache_ttl = timedelta(minutes=30)
 _holomem_cache_timestamps: Dict[str, datetime] = {}
 
+@single_flight()
 def get_holomem_info_cached(member_name: str) -> Optional[Dict]:
     with _holomem_cache_lock:
         if member_name in _holomem_cache:
@@ -2510,7 +6182,7 @@ def scrape_yahoo_realtime_for_member(member_name: str) -> str:
         params = {'p': query, 'ei': 'UTF-8', 'm': 'latency'}
         headers = {'User-Agent': random.choice(USER_AGENTS)}
         
-        res = requests.get(url, params=params, headers=headers, timeout=10)
+        res = http_get(url, params=params, headers=headers, timeout=10)
         if res.status_code != 200: return ""
         
         soup = BeautifulSoup(res.content, 'html.parser')
@@ -2581,7 +6253,7 @@ def scrape_hololive_stream_info() -> List[Dict]:
             "sort": "available_at",
             "order": "desc",
         }
-        res = requests.get(url, headers=headers, params=params, timeout=15)
+        res = http_get(url, headers=headers, params=params, timeout=15)
         if res.status_code == 200:
             items = res.json()
             if isinstance(items, dict):
@@ -3051,7 +6723,7 @@ def scrape_hololive_wiki() -> List[Dict]:
     results = []
     try:
         headers = {'User-Agent': random.choice(USER_AGENTS)}
-        res = requests.get(url, headers=headers, timeout=15)
+        res = http_get(url, headers=headers, timeout=15)
         if res.status_code != 200: return []
         soup = BeautifulSoup(res.content, 'html.parser')
         for link in soup.select('a[href*="/d/"]'):
@@ -3066,7 +6738,7 @@ def scrape_hololive_wiki() -> List[Dict]:
 def fetch_member_detail_from_wiki(member_name: str) -> Optional[Dict]:
     url = f"https://seesaawiki.jp/hololivetv/d/{quote_plus(member_name, encoding='euc-jp')}"
     try:
-        res = requests.get(url, headers={'User-Agent': random.choice(USER_AGENTS)}, timeout=10)
+        res = http_get(url, headers={'User-Agent': random.choice(USER_AGENTS)}, timeout=10)
         if res.status_code != 200: return None
         soup = BeautifulSoup(res.content, 'html.parser')
         content = soup.select_one('#content, .wiki-content')
@@ -3171,7 +6843,7 @@ def fetch_hololive_news():
     # ============================================================
     try:
         url = "https://hololive.hololivepro.com/news"
-        res = requests.get(url, headers={'User-Agent': random.choice(USER_AGENTS)}, timeout=15)
+        res = http_get(url, headers={'User-Agent': random.choice(USER_AGENTS)}, timeout=15)
 
         if res.status_code == 200:
             soup = BeautifulSoup(res.content, 'html.parser')
@@ -3234,7 +6906,7 @@ def fetch_hololive_news():
     if added < 3:
         logger.info(f"  📡 まだ {added}件 < 3件 → Reddit APIにフォールバック")
         try:
-            res = requests.get(
+            res = http_get(
                 "https://www.reddit.com/r/Hololive/hot.json",
                 headers={'User-Agent': 'Mozilla/5.0'},
                 timeout=15
@@ -3274,7 +6946,7 @@ def fetch_specialized_news():
         # ============================================================
         try:
             url = "https://hololive-tsuushin.com/category/holonews/"
-            res = requests.get(url, headers={'User-Agent': random.choice(USER_AGENTS)}, timeout=15)
+            res = http_get(url, headers={'User-Agent': random.choice(USER_AGENTS)}, timeout=15)
 
             if res.status_code == 200:
                 soup = BeautifulSoup(res.content, 'html.parser')
@@ -3312,6 +6984,8 @@ def fetch_specialized_news():
         except Exception as e:
             logger.warning(f"  ❌ ホロライブ通信失敗: {str(e)[:60]}")
 
+    if added:
+        specialized_news_index.invalidate()
     logger.info(f"✅ 専門ニュース更新完了: {added}件追加")
 
 
@@ -3379,7 +7053,7 @@ def fetch_hololive_tsuushin_news():
         # フォールバック: requests + BeautifulSoup
         if article_links is None:
             headers = {'User-Agent': random.choice(USER_AGENTS)}
-            res = requests.get(url, headers=headers, timeout=15)
+            res = http_get(url, headers=headers, timeout=15)
             if res.status_code != 200:
                 logger.warning(f"⚠️ ホロライブ通信アクセス失敗: {res.status_code}")
                 return
@@ -3419,7 +7093,7 @@ def fetch_hololive_tsuushin_news():
                 # 各記事ページにアクセスして本文を取得
                 try:
                     time.sleep(1.5)
-                    art_res = requests.get(
+                    art_res = http_get(
                         link,
                         headers={'User-Agent': random.choice(USER_AGENTS)},
                         timeout=15
@@ -3498,7 +7172,7 @@ def fetch_hololive_dictionary():
 
     try:
         headers = {'User-Agent': random.choice(USER_AGENTS)}
-        res = requests.get(url, headers=headers, timeout=30)
+        res = http_get(url, headers=headers, timeout=30)
         if res.status_code != 200:
             logger.warning(f"⚠️ hololive-dictionary 取得失敗: {res.status_code}")
             return
@@ -3675,7 +7349,7 @@ def fetch_holomem_episodes():
 
             # フォールバック: 既存の requests 版
             if soup is None:
-                res = requests.get(
+                res = http_get(
                     page_url,
                     headers={'User-Agent': random.choice(USER_AGENTS)},
                     timeout=15
@@ -3783,6 +7457,7 @@ def extract_japanese_name_from_channel(channel_name: str) -> tuple:
 # ==============================================================================
 # ★ v33.10: Holodex API から配信スケジュール取得 (旧 schedule.hololive.tv スクレイピングから移行)
 # ==============================================================================
+@single_flight()
 def fetch_hololive_schedule():
     """
     Holodex API v2 (https://holodex.net/api/v2/) から
@@ -3814,7 +7489,7 @@ def fetch_hololive_schedule():
     }
 
     try:
-        res = requests.get(url, headers=headers, params=params, timeout=15)
+        res = http_get(url, headers=headers, params=params, timeout=15)
         if res.status_code != 200:
             logger.warning(f"⚠️ Holodex API 取得失敗: {res.status_code} - {res.text[:200]}")
             return
@@ -3991,7 +7666,7 @@ def fetch_sl_rss(source_config: Dict) -> List[Dict]:
     results = []
     try:
         headers = {'User-Agent': random.choice(USER_AGENTS), 'Accept': 'application/rss+xml,application/xml,text/xml'}
-        res = requests.get(source_config['url'], headers=headers, timeout=15)
+        res = http_get(source_config['url'], headers=headers, timeout=15)
         if res.status_code != 200:
             return []
         soup = BeautifulSoup(res.content, 'xml')
@@ -4026,7 +7701,7 @@ def fetch_sl_google_news(source_config: Dict) -> List[Dict]:
         query = source_config['query']
         url = f"https://news.google.com/rss/search?q={quote_plus(query)}&hl=ja&gl=JP&ceid=JP:ja"
         headers = {'User-Agent': random.choice(USER_AGENTS)}
-        res = requests.get(url, headers=headers, timeout=15)
+        res = http_get(url, headers=headers, timeout=15)
         if res.status_code != 200:
             return []
         soup = BeautifulSoup(res.content, 'xml')
@@ -4055,7 +7730,7 @@ def fetch_sl_marketplace_trends() -> List[Dict]:
     try:
         url = "https://marketplace.secondlife.com/products/search?search[category_id]=0&search[sort]=relevance&search[per_page]=20"
         headers = {'User-Agent': random.choice(USER_AGENTS), 'Accept-Language': 'en-US,en;q=0.9'}
-        res = requests.get(url, headers=headers, timeout=15)
+        res = http_get(url, headers=headers, timeout=15)
         if res.status_code != 200:
             return []
         soup = BeautifulSoup(res.content, 'html.parser')
@@ -4219,6 +7894,129 @@ def detect_specialized_topic(message: str) -> Optional[Dict]:
     return None
 
 
+# ==============================================================================
+# ★ 教わった知識 / 専門ニュースの関連度インデックス
+# ==============================================================================
+# 旧実装はメッセージのたびに新しい順で 50件 (専門ニュースは limit*5件) だけを読み直し、
+# Python の部分文字列検索で bigram ヒット数を数えていた。
+# テーブル全体の bigram ポスティングをメモリに持ち、書き込み時に差分更新する。
+# 関連度 = クエリ bigram とのポスティング積集合の大きさ。
+class BigramRelevanceIndex:
+    """1テーブル分の文字bigramポスティング (初回参照時に全件ロード、以後は書き込み時に差分更新)"""
+
+    def __init__(self, name: str, loader):
+        self.name = name
+        self._loader = loader          # () -> Iterable[(doc_id, 検索対象テキスト, payload dict)]
+        self._lock = RLock()
+        self._loaded = False
+        self._postings: Dict[str, set] = defaultdict(set)
+        self._doc_grams: Dict[int, set] = {}
+        self._payloads: Dict[int, Dict] = {}
+
+    def _ensure_loaded(self):
+        if self._loaded or not Session:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            self._postings.clear()
+            self._doc_grams.clear()
+            self._payloads.clear()
+            for doc_id, body, payload in self._loader():
+                self._add(doc_id, body, payload)
+            self._loaded = True
+            logger.info(f"🔎 関連度インデックス({self.name}): {len(self._payloads)}件ロード")
+
+    def _add(self, doc_id: int, body: str, payload: Dict):
+        self._remove(doc_id)
+        grams = set(char_bigrams(body))
+        for g in grams:
+            self._postings[g].add(doc_id)
+        self._doc_grams[doc_id] = grams
+        self._payloads[doc_id] = payload
+
+    def _remove(self, doc_id: int):
+        for g in self._doc_grams.pop(doc_id, ()):
+            plist = self._postings.get(g)
+            if plist is not None:
+                plist.discard(doc_id)
+                if not plist:
+                    del self._postings[g]
+        self._payloads.pop(doc_id, None)
+
+    def upsert(self, doc_id: int, body: str, payload: Dict):
+        """DB書き込み直後に呼ぶ。未ロードなら次回参照時の全件ロードに任せる"""
+        with self._lock:
+            if self._loaded:
+                self._add(doc_id, body, payload)
+
+    def invalidate(self):
+        """一括削除などの後に呼ぶ (次回参照時に全件ロードし直す)"""
+        with self._lock:
+            self._loaded = False
+
+    def search(self, query: str, limit: int = 3, min_hits: int = 1) -> List[Tuple[int, Dict]]:
+        """関連度 (共通bigram数) 降順、同点は新しい順で [(doc_id, payload)] を返す
+
+        min_hits はクエリの bigram 数で頭打ちにする (「VR」など 1 bigram のクエリも拾えるように)
+        """
+        self._ensure_loaded()
+        grams = set(char_bigrams(query))
+        if not grams:
+            return []
+        min_hits = min(min_hits, len(grams))
+        hits: Counter = Counter()
+        with self._lock:
+            for g in grams:
+                plist = self._postings.get(g)
+                if plist:
+                    hits.update(plist)
+            ranked = [
+                (count, self._payloads[doc_id].get('created_at') or datetime.min, doc_id)
+                for doc_id, count in hits.items() if count >= min_hits
+            ]
+            ranked.sort(reverse=True)
+            return [(doc_id, self._payloads[doc_id]) for _, _, doc_id in ranked[:limit]]
+
+    def __len__(self) -> int:
+        return len(self._payloads)
+
+
+# 教わったURLの本文は長めに保存し (Memvidで段落単位に検索)、bigram索引には先頭だけを使う
+TAUGHT_CONTENT_MAX_CHARS = 8000
+TAUGHT_INDEX_CHARS = 1500
+
+
+def _load_taught_knowledge_docs():
+    with get_db_session() as session:
+        rows = session.query(
+            UserTaughtKnowledge.id, UserTaughtKnowledge.title,
+            UserTaughtKnowledge.content, UserTaughtKnowledge.created_at
+        ).all()
+    return [
+        (r.id, f"{r.title or ''} {(r.content or '')[:TAUGHT_INDEX_CHARS]}",
+         {'title': r.title, 'content': r.content, 'created_at': r.created_at})
+        for r in rows
+    ]
+
+
+def _load_specialized_news_docs():
+    with get_db_session() as session:
+        rows = session.query(
+            SpecializedNews.id, SpecializedNews.site_name, SpecializedNews.title,
+            SpecializedNews.content, SpecializedNews.query_keyword, SpecializedNews.created_at
+        ).all()
+    return [
+        (r.id, f"{r.query_keyword or ''} {r.title or ''} {r.content or ''}",
+         {'site_name': r.site_name, 'title': r.title, 'content': r.content, 'created_at': r.created_at})
+        for r in rows
+    ]
+
+
+taught_knowledge_index = BigramRelevanceIndex('taught_knowledge', _load_taught_knowledge_docs)
+specialized_news_index = BigramRelevanceIndex('specialized_news', _load_specialized_news_docs)
+
+
 def save_to_specialized_news(
     site_name: str,
     title: str,
@@ -4234,9 +8032,10 @@ def save_to_specialized_news(
         news_hash = hashlib.md5(
             f"{site_name}:{title}:{content[:100]}".encode('utf-8')
         ).hexdigest()
+        saved = None
         with get_db_session() as session:
             if not session.query(SpecializedNews).filter_by(news_hash=news_hash).first():
-                session.add(SpecializedNews(
+                entry = SpecializedNews(
                     site_name=site_name,
                     title=title[:500],
                     content=content[:2000],
@@ -4244,8 +8043,16 @@ def save_to_specialized_news(
                     news_hash=news_hash,
                     query_keyword=query_keyword[:200] if query_keyword else "",
                     created_at=datetime.utcnow()
-                ))
+                )
+                session.add(entry)
+                session.flush()
+                saved = (entry.id, f"{entry.query_keyword} {entry.title} {entry.content}", {
+                    'site_name': entry.site_name, 'title': entry.title,
+                    'content': entry.content, 'created_at': entry.created_at,
+                })
                 logger.info(f"✅ specialized_news 保存: {site_name} - {title[:40]}")
+        if saved:
+            specialized_news_index.upsert(*saved)
     except Exception as e:
         logger.error(f"specialized_news 保存エラー: {e}")
 
@@ -4311,7 +8118,8 @@ def execute_specialized_site_search(query: str, site_info: Dict) -> str:
         try:
             resp = model.generate_content(
                 prompt,
-                generation_config={"temperature": 0.5, "max_output_tokens": 600}
+                generation_config={"temperature": 0.5, "max_output_tokens": 600},
+                priority='search'
             )
             if hasattr(resp, 'candidates') and resp.candidates:
                 response = resp.candidates[0].content.parts[0].text.strip()
@@ -4340,44 +8148,21 @@ def get_specialized_news_context(message: str, limit: int = 3) -> str:
     """
     specialized_newsテーブルからメッセージに関連する情報を取得し、
     プロンプト注入用テキストとして返す。
-    キーワードマッチングで関連度を判断。
+    関連度インデックス (テーブル全体の bigram ポスティング) で判定する。
     """
     try:
-        with get_db_session() as session:
-            items = session.query(SpecializedNews).order_by(
-                SpecializedNews.created_at.desc()
-            ).limit(limit * 5).all()
-
-            if not items:
-                return ''
-
-            query_words = [w for w in message.lower().split() if len(w) >= 2]
-            scored: List[tuple] = []
-            for item in items:
-                kw = (item.query_keyword or '').lower()
-                title_lower = (item.title or '').lower()
-                content_lower = (item.content or '').lower()
-                score = sum(
-                    1 for w in query_words
-                    if w in kw or w in title_lower or w in content_lower
-                )
-                if score > 0:
-                    scored.append((score, item))
-
-            scored.sort(key=lambda x: x[0], reverse=True)
-            relevant = [item for _, item in scored[:limit]]
-
-            if not relevant:
-                return ''
+        relevant = specialized_news_index.search(message, limit=limit, min_hits=2)
+        if not relevant:
+            return ''
 
-            lines = []
-            for it in relevant:
-                line = f"【{it.site_name}】{it.title}"
-                if it.content and len(it.content) > 5:
-                    line += f"\n{it.content[:250]}"
-                lines.append(line)
+        lines = []
+        for _, it in relevant:
+            line = f"【{it['site_name']}】{it['title']}"
+            if it['content'] and len(it['content']) > 5:
+                line += f"\n{it['content'][:250]}"
+            lines.append(line)
 
-            return "\n\n【専門サイト検索キャッシュ】\n" + "\n\n".join(lines)
+        return "\n\n【専門サイト検索キャッシュ】\n" + "\n\n".join(lines)
 
     except Exception as e:
         logger.error(f"specialized_news コンテキスト取得エラー: {e}")
@@ -4396,7 +8181,7 @@ def fetch_and_remember_url(user_uuid: str, url: str):
     """URLを読み込み、本文を user_taught_knowledge に恒久保存する（バックグラウンド実行）。"""
     try:
         headers = {'User-Agent': random.choice(USER_AGENTS)}
-        res = requests.get(url, headers=headers, timeout=15)
+        res = http_get(url, headers=headers, timeout=15)
         if res.status_code != 200:
             logger.warning(f"⚠️ URL記憶: 取得失敗 HTTP {res.status_code} ({url[:60]})")
             return
@@ -4425,68 +8210,34 @@ def fetch_and_remember_url(user_uuid: str, url: str):
             soup.select_one('.post-content') or
             soup.body or soup
         )
-        content = clean_text(body_elem.get_text(separator='\n'))[:1500]
+        content = clean_text(body_elem.get_text(separator='\n'))[:TAUGHT_CONTENT_MAX_CHARS]
         if not content:
             content = title
 
         news_hash = hashlib.md5(url.encode('utf-8')).hexdigest()
+        now = datetime.utcnow()
         with engine.connect() as conn:
             with conn.begin():
-                conn.execute(text(
+                taught_id = conn.execute(text(
                     "INSERT INTO user_taught_knowledge "
                     "(user_uuid, source_url, title, content, news_hash, created_at) "
                     "VALUES (:u, :url, :t, :c, :h, :ts) "
                     "ON CONFLICT (news_hash) DO UPDATE SET "
-                    "title = :t, content = :c, created_at = :ts"
+                    "title = :t, content = :c, created_at = :ts "
+                    "RETURNING id"
                 ), {
                     "u": user_uuid, "url": url[:1000], "t": title[:500],
-                    "c": content, "h": news_hash, "ts": datetime.utcnow()
-                })
+                    "c": content, "h": news_hash, "ts": now
+                }).scalar()
+        if taught_id:
+            taught_knowledge_index.upsert(taught_id, f"{title[:500]} {content[:TAUGHT_INDEX_CHARS]}", {
+                'title': title[:500], 'content': content, 'created_at': now,
+            })
         logger.info(f"🧠 URL記憶完了: {title[:40]} ({url[:50]})")
     except Exception as e:
         logger.error(f"❌ URL記憶エラー ({url[:50]}): {str(e)[:100]}")
 
 
-def get_taught_knowledge_context(message: str, limit: int = 2) -> str:
-    """user_taught_knowledge から、メッセージに関連する教わった知識を注入用に返す。
-    日本語に対応するため 2-gram で照合する。"""
-    try:
-        with get_db_session() as session:
-            items = session.query(UserTaughtKnowledge).order_by(
-                UserTaughtKnowledge.created_at.desc()
-            ).limit(50).all()
-            if not items:
-                return ''
-            msg = (message or '').lower()
-            grams = set()
-            for i in range(len(msg) - 1):
-                g = msg[i:i + 2].strip()
-                if len(g) == 2:
-                    grams.add(g)
-            if not grams:
-                return ''
-            scored: List[tuple] = []
-            for it in items:
-                hay = ((it.title or '') + ' ' + (it.content or '')).lower()
-                score = sum(1 for g in grams if g in hay)
-                if score > 0:
-                    scored.append((score, it))
-            if not scored:
-                return ''
-            scored.sort(key=lambda x: x[0], reverse=True)
-            relevant = [it for _, it in scored[:limit]]
-            lines = []
-            for it in relevant:
-                line = f"【{it.title}】"
-                if it.content and len(it.content) > 5:
-                    line += f"\n{it.content[:300]}"
-                lines.append(line)
-            return "\n\n【以前あなたが教えてくれた知識】\n" + "\n\n".join(lines)
-    except Exception as e:
-        logger.error(f"taught_knowledge コンテキスト取得エラー: {e}")
-        return ''
-
-
 def cleanup_old_specialized_news():
     """30日以上前のspecialized_newsを削除"""
     try:
@@ -4497,6 +8248,8 @@ def cleanup_old_specialized_news():
             ).delete()
             if deleted:
                 logger.info(f"🗑️ 古い専門ニュース {deleted}件を削除")
+        if deleted:
+            specialized_news_index.invalidate()
     except Exception as e:
         logger.error(f"specialized_news クリーンアップエラー: {e}")
 
@@ -4552,6 +8305,7 @@ def extract_anime_titles_from_message(message: str) -> List[str]:
 
     return list(set(candidates))
 
+@single_flight()
 def fetch_anime_info_from_jikan(title: str) -> Optional[Dict]:
     """
     Jikan API (MyAnimeList 非公式REST API・認証不要) からアニメ情報を取得。
@@ -4561,7 +8315,7 @@ def fetch_anime_info_from_jikan(title: str) -> Optional[Dict]:
         url = "https://api.jikan.moe/v4/anime"
         params = {'q': title, 'limit': 1}
         headers = {'User-Agent': random.choice(USER_AGENTS)}
-        res = requests.get(url, params=params, headers=headers, timeout=15)
+        res = http_get(url, params=params, headers=headers, timeout=15)
         if res.status_code != 200:
             logger.warning(f"⚠️ Jikan API HTTP {res.status_code} ({title})")
             return None
@@ -4588,6 +8342,7 @@ def fetch_anime_info_from_jikan(title: str) -> Optional[Dict]:
         logger.warning(f"Jikan API取得失敗 ({title}): {e}")
         return None
 
+@single_flight()
 def get_anime_info_from_cache_or_search(title: str) -> Optional[str]:
     """
     アニメ作品情報をキャッシュから取得、なければWeb検索して保存。
@@ -4796,6 +8551,7 @@ TASK_SCHEDULE: Dict[str, Dict] = {
     'cleanup_specialized_news': {'func': 'cleanup_old_specialized_news', 'interval_hours': 167.0},
     # ★ Memvid RAGタスク
     'memvid_build_index':   {'func': 'memvid_rag.build_knowledge_index', 'interval_hours': 23.0},
+    'memvid_snapshot':      {'func': 'memvid_vector_index.save_snapshot', 'interval_hours': 1.0},  # 変化が無ければ何もしない
     'memvid_cleanup':       {'func': 'memvid_rag.cleanup_old_embeddings', 'interval_hours': 167.0},  # 週1回
     # ── ローカルファイル (起動のたびに実行して問題ない軽いもの) ──────────────
     'cleanup_voices':       {'func': 'cleanup_old_voice_files',          'interval_hours': 1.0},   # 起動時は常に実行
@@ -4805,6 +8561,12 @@ TASK_SCHEDULE: Dict[str, Dict] = {
     'fetch_lingo':          {'func': 'fetch_hololive_dictionary',        'interval_hours': 167.0},  # 週1回（辞書はほぼ更新されない）
     'fetch_episodes':       {'func': 'fetch_holomem_episodes',           'interval_hours': 47.0},   # 2日に1回（15人ずつ順番に）
     'fetch_schedule':       {'func': 'fetch_hololive_schedule',          'interval_hours': 0.25},   # 15分ごと
+    # ★ 会話Embeddingの未処理分 (全ユーザー) をアイドル時にまとめて埋め込む
+    'embed_history':        {'func': 'embed_history_backlog',            'interval_hours': 0.25},
+    # ★ ローカルEmbeddingのIDF学習・旧指紋の再埋め込み・フォールバック用ローカル版の作成
+    'local_embeddings':     {'func': 'maintain_local_embeddings',        'interval_hours': 0.5},
+    # ★ LLM使用量のメモリ集計を llm_usage_rollups へ書き出す
+    'flush_llm_usage':      {'func': 'llm_usage.flush',                  'interval_hours': 0.25},
 }
 
 # タスク名 → 実際の関数のマッピング (initialize_app内で設定)
@@ -4905,7 +8667,8 @@ def run_managed_task(task_name: str, func, *args, **kwargs):
                 return  # last_run更新しないので次回再試行される
         try:
             logger.info(f"▶️  タスク開始: {task_name}")
-            func(*args, **kwargs)
+            with llm_usage_scope(task_name):
+                func(*args, **kwargs)
             record_task_run(task_name, success=True)
             logger.info(f"✅ タスク完了: {task_name}")
         except Exception as e:
@@ -5011,18 +8774,39 @@ def analyze_user_topics(session, user_uuid: str) -> List[str]:
 # ==============================================================================
 # 心理分析
 # ==============================================================================
+def _collect_psychology_input(session, user_uuid: str) -> Optional[str]:
+    """心理分析の入力 (直近15発言)。発言が少なければ None"""
+    recent_messages = session.query(ConversationHistory).filter(
+        ConversationHistory.user_uuid == user_uuid,
+        ConversationHistory.role == 'user'
+    ).order_by(ConversationHistory.timestamp.desc()).limit(15).all()
+    if len(recent_messages) < MIN_MESSAGES_FOR_ANALYSIS:
+        return None
+    return '\n'.join([f"ユーザー: {msg.content}" for msg in reversed(recent_messages)])
+
+
+def _apply_psychology_result(session, user_uuid: str, user_name: str, result: Dict):
+    """心理分析結果を UserPsychology に反映 (commit は呼び出し側のセッション)"""
+    psych = session.query(UserPsychology).filter_by(user_uuid=user_uuid).first()
+    if not psych:
+        psych = UserPsychology(user_uuid=user_uuid, user_name=user_name, analysis_confidence=0)
+        session.add(psych)
+
+    psych.openness = result.get('openness', 50)
+    psych.extraversion = result.get('extraversion', 50)
+    psych.favorite_topics = ','.join(result.get('topics', []))
+    psych.analysis_confidence = min(100, (psych.analysis_confidence or 0) + 20)
+    psych.last_analyzed = datetime.utcnow()
+
+    logger.info(f"📊 {user_name}さんの心理分析完了: 開放性={psych.openness}, 外向性={psych.extraversion}")
+
+
 def analyze_user_psychology(session, user_uuid: str, user_name: str):
     try:
-        recent_messages = session.query(ConversationHistory).filter(
-            ConversationHistory.user_uuid == user_uuid,
-            ConversationHistory.role == 'user'
-        ).order_by(ConversationHistory.timestamp.desc()).limit(15).all()
-        
-        if len(recent_messages) < MIN_MESSAGES_FOR_ANALYSIS:
+        messages_text = _collect_psychology_input(session, user_uuid)
+        if not messages_text:
             return
         
-        messages_text = '\n'.join([f"ユーザー: {msg.content}" for msg in reversed(recent_messages)])
-        
         analysis_prompt = f"""以下のユーザーの発言から性格を分析してください。
 
 【分析対象の発言】
@@ -5048,7 +8832,8 @@ def analyze_user_psychology(session, user_uuid: str, user_name: str):
                 # v33.15-stable2: max_output_tokens 明示（未指定だとモデルが暴走する場合あり）
                 response = current_gemini.generate_content(
                     analysis_prompt,
-                    generation_config={"temperature": 0.3, "max_output_tokens": 600}
+                    generation_config={"temperature": 0.3, "max_output_tokens": 600},
+                    priority='deferred'
                 )
                 if hasattr(response, 'candidates') and response.candidates:
                     text = response.candidates[0].content.parts[0].text.strip()
@@ -5065,13 +8850,14 @@ def analyze_user_psychology(session, user_uuid: str, user_name: str):
         
         if not result and groq_client:
             try:
-                models = groq_model_manager.get_available_models()
+                models = groq_model_manager.get_available_models('deferred')
                 if models:
                     response = groq_client.chat.completions.create(
                         model=models[0],
                         messages=[{"role": "user", "content": analysis_prompt}],
                         temperature=0.3,
-                        max_tokens=600
+                        max_tokens=600,
+                        priority='deferred'
                     )
                     text = response.choices[0].message.content.strip()
                     json_match = re.search(r'\{[^}]+\}', text, re.DOTALL)
@@ -5080,19 +8866,9 @@ def analyze_user_psychology(session, user_uuid: str, user_name: str):
             except Exception as e:
                 logger.warning(f"Groq分析エラー: {e}")
         
+        result = _validate_psychology_result(result) if result else None
         if result:
-            psych = session.query(UserPsychology).filter_by(user_uuid=user_uuid).first()
-            if not psych:
-                psych = UserPsychology(user_uuid=user_uuid, user_name=user_name)
-                session.add(psych)
-            
-            psych.openness = result.get('openness', 50)
-            psych.extraversion = result.get('extraversion', 50)
-            psych.favorite_topics = ','.join(result.get('topics', []))
-            psych.analysis_confidence = min(100, psych.analysis_confidence + 20)
-            psych.last_analyzed = datetime.utcnow()
-            
-            logger.info(f"📊 {user_name}さんの心理分析完了: 開放性={psych.openness}, 外向性={psych.extraversion}")
+            _apply_psychology_result(session, user_uuid, user_name, result)
     
     except Exception as e:
         logger.error(f"心理分析エラー: {e}")
@@ -5302,28 +9078,58 @@ def cleanup_old_interest_logs():
         logger.error(f"興味ログクリーンアップエラー: {e}")
 
 
+FRIEND_PROFILE_FIELDS = ['fav_holomem', 'fav_gen', 'fav_stream_type', 'hobbies',
+                         'fav_games', 'fav_music', 'fav_anime', 'mood_tendency']
+
+
+def _collect_profile_input(session, user_uuid: str) -> Optional[Tuple[str, str]]:
+    """プロフィール更新の入力 (最近の会話20件, 興味ログ)。会話が少なければ None"""
+    recent_msgs = session.query(ConversationHistory).filter(
+        ConversationHistory.user_uuid == user_uuid,
+        ConversationHistory.role == 'user'
+    ).order_by(ConversationHistory.timestamp.desc()).limit(20).all()
+    if len(recent_msgs) < 5:
+        return None
+
+    interest_summary = get_user_interest_summary(session, user_uuid)
+    interest_text = "\n".join([
+        f"- {cat}: {', '.join(kws)}" for cat, kws in interest_summary.items()
+    ]) or "（まだデータなし）"
+    convo_text = "\n".join([f"・{m.content}" for m in reversed(recent_msgs)])
+    return convo_text, interest_text
+
+
+def _apply_profile_result(session, user_uuid: str, user_name: str, result_json: Dict):
+    """プロフィール結果を FriendProfile に反映 (commit は呼び出し側のセッション)"""
+    fp = session.query(FriendProfile).filter_by(user_uuid=user_uuid).first()
+    if not fp:
+        fp = FriendProfile(user_uuid=user_uuid, user_name=user_name)
+        session.add(fp)
+
+    for field_name in FRIEND_PROFILE_FIELDS:
+        val = result_json.get(field_name, '')
+        if val:
+            setattr(fp, field_name, str(val)[:300])
+
+    # memo は既存を賢くマージ（単純に上書き）
+    new_memo = result_json.get('memo', '')
+    if new_memo:
+        fp.memo = str(new_memo)[:400]
+
+    fp.last_updated = datetime.utcnow()
+    logger.info(f"✅ {user_name}さんの友達プロフィール自動更新完了")
+
+
 def auto_update_friend_profile(session, user_uuid: str, user_name: str):
     """
     会話履歴と興味ログをもとに FriendProfile を AI で自動更新する。
     10回会話するごとにバックグラウンドで実行。
     """
     try:
-        # 最近の会話 (20件)
-        recent_msgs = session.query(ConversationHistory).filter(
-            ConversationHistory.user_uuid == user_uuid,
-            ConversationHistory.role == 'user'
-        ).order_by(ConversationHistory.timestamp.desc()).limit(20).all()
-
-        if len(recent_msgs) < 5:
+        collected = _collect_profile_input(session, user_uuid)
+        if not collected:
             return
-
-        # 興味サマリー
-        interest_summary = get_user_interest_summary(session, user_uuid)
-        interest_text = "\n".join([
-            f"- {cat}: {', '.join(kws)}" for cat, kws in interest_summary.items()
-        ]) or "（まだデータなし）"
-
-        convo_text = "\n".join([f"・{m.content}" for m in reversed(recent_msgs)])
+        convo_text, interest_text = collected
 
         prompt = f"""あなたは「もちこ」というAIです。
 以下は友達「{user_name}」さんとの会話と、興味ログです。
@@ -5356,7 +9162,9 @@ def auto_update_friend_profile(session, user_uuid: str, user_name: str):
         if model:
             try:
                 # v33.15-stable2: Geminiも600に統一（プロフィール用JSON生成）
-                response = model.generate_content(prompt, generation_config={"temperature": 0.3, "max_output_tokens": 600})
+                response = model.generate_content(
+                    prompt, generation_config={"temperature": 0.3, "max_output_tokens": 600}, priority='deferred'
+                )
                 if hasattr(response, 'candidates') and response.candidates:
                     _cand = response.candidates[0]
                     if not (_cand and _cand.content and _cand.content.parts):
@@ -5379,12 +9187,12 @@ def auto_update_friend_profile(session, user_uuid: str, user_name: str):
         # フォールバック: Groq
         if not result_json and groq_client:
             try:
-                available = groq_model_manager.get_available_models()
+                available = groq_model_manager.get_available_models('deferred')
                 if available:
                     resp = groq_client.chat.completions.create(
                         model=available[0],
                         messages=[{"role": "user", "content": prompt}],
-                        temperature=0.3, max_tokens=600
+                        temperature=0.3, max_tokens=600, priority='deferred'
                     )
                     text = resp.choices[0].message.content.strip()
                     jmatch = re.search(r'\{.*\}', text, re.DOTALL)
@@ -5393,28 +9201,230 @@ def auto_update_friend_profile(session, user_uuid: str, user_name: str):
             except Exception as e:
                 logger.warning(f"Groqプロフィール更新エラー: {e}")
 
+        result_json = _validate_profile_result(result_json) if result_json else None
         if result_json:
-            fp = session.query(FriendProfile).filter_by(user_uuid=user_uuid).first()
-            if not fp:
-                fp = FriendProfile(user_uuid=user_uuid, user_name=user_name)
-                session.add(fp)
+            _apply_profile_result(session, user_uuid, user_name, result_json)
 
-            for field_name in ['fav_holomem','fav_gen','fav_stream_type','hobbies',
-                               'fav_games','fav_music','fav_anime','mood_tendency']:
-                val = result_json.get(field_name, '')
-                if val:
-                    setattr(fp, field_name, str(val)[:300])
+    except Exception as e:
+        logger.error(f"友達プロフィール更新エラー: {e}")
 
-            # memo は既存を賢くマージ（単純に上書き）
-            new_memo = result_json.get('memo', '')
-            if new_memo:
-                fp.memo = str(new_memo)[:400]
 
-            fp.last_updated = datetime.utcnow()
-            logger.info(f"✅ {user_name}さんの友達プロフィール自動更新完了")
+def _clamp_score(value) -> Optional[int]:
+    try:
+        return max(0, min(100, int(float(value))))
+    except (TypeError, ValueError):
+        return None
+
+
+def _validate_psychology_result(result: Any) -> Optional[Dict]:
+    """心理分析 JSON を検証して正規化する (スコアは 0-100、トピックは3つまで)。不正なら None"""
+    if not isinstance(result, dict):
+        return None
+    openness = _clamp_score(result.get('openness'))
+    extraversion = _clamp_score(result.get('extraversion'))
+    if openness is None and extraversion is None:
+        return None
+    topics = result.get('topics') or []
+    if isinstance(topics, str):
+        topics = [t.strip() for t in re.split(r'[,、]', topics)]
+    if not isinstance(topics, list):
+        topics = []
+    return {
+        'openness': 50 if openness is None else openness,
+        'extraversion': 50 if extraversion is None else extraversion,
+        'topics': [str(t)[:30] for t in topics if t][:3],
+    }
+
+
+def _validate_profile_result(result: Any) -> Optional[Dict]:
+    """プロフィール JSON を検証して文字列フィールドだけに正規化する。中身が空なら None"""
+    if not isinstance(result, dict):
+        return None
+    cleaned = {}
+    for key in FRIEND_PROFILE_FIELDS + ['memo']:
+        val = result.get(key)
+        if isinstance(val, list):
+            val = ', '.join(str(v) for v in val if v)
+        if isinstance(val, (str, int, float)) and str(val).strip():
+            cleaned[key] = str(val).strip()
+    return cleaned or None
+
+
+# ==============================================================================
+# ★ 複数ユーザーまとめ分析 (心理分析 / 友達プロフィール)
+# ==============================================================================
+# 遅延キューに溜まった同種の分析タスクを最大 ANALYSIS_BATCH_USERS 人分まとめて
+# 1回の LLM 呼び出しに詰め、user_uuid をキーにした JSON 配列で受け取る。
+# 各要素を検証してから全員分を1トランザクションで書き込む。
+# 配列に入っていない / 不正だったユーザーは失敗扱い (キュー側で再試行)。
+ANALYSIS_BATCH_USERS = 5
+ANALYSIS_BATCH_TASKS = {'analyze_psychology', 'update_friend_profile'}
+ANALYSIS_BATCH_TOKENS_PER_USER = {'analyze_psychology': 150, 'update_friend_profile': 400}
+
+
+def _generate_deferred_json(prompt: str, max_tokens: int, label: str) -> Optional[str]:
+    """deferred 優先度で JSON 出力を生成 (Gemini → Groq フォールバック)。テキストを返す"""
+    model = gemini_model_manager.get_current_model()
+    if model:
+        try:
+            response = model.generate_content(
+                prompt,
+                generation_config={"temperature": 0.3, "max_output_tokens": max_tokens,
+                                   "response_mime_type": "application/json"},
+                priority='deferred'
+            )
+            if hasattr(response, 'candidates') and response.candidates:
+                _cand = response.candidates[0]
+                if _cand and _cand.content and _cand.content.parts and _cand.content.parts[0].text:
+                    return _cand.content.parts[0].text.strip()
+        except Exception as e:
+            error_str = str(e)
+            if "429" in error_str or "quota" in error_str.lower():
+                retry_match = re.search(r'retry in (\d+(?:\.\d+)?)s', error_str)
+                wait_seconds = int(float(retry_match.group(1))) + 5 if retry_match else 60
+                gemini_model_manager.mark_limited(wait_seconds)
+            logger.warning(f"Gemini{label}エラー: {e}")
+
+    if groq_client:
+        try:
+            models = groq_model_manager.get_available_models('deferred')
+            if models:
+                response = groq_client.chat.completions.create(
+                    model=models[0],
+                    messages=[{"role": "user", "content": prompt}],
+                    temperature=0.3,
+                    max_tokens=max_tokens,
+                    priority='deferred'
+                )
+                return response.choices[0].message.content.strip()
+        except Exception as e:
+            logger.warning(f"Groq{label}エラー: {e}")
+    return None
+
+
+def _parse_json_array(text: str) -> List:
+    """LLM 出力から JSON 配列を取り出す ({"results": [...]} 形式も許容)"""
+    if not text:
+        return []
+    try:
+        data = json.loads(text)
+    except ValueError:
+        match = re.search(r'\[.*\]', text, re.DOTALL)
+        if not match:
+            return []
+        try:
+            data = json.loads(match.group())
+        except ValueError:
+            return []
+    if isinstance(data, dict):
+        data = next((v for v in data.values() if isinstance(v, list)), [])
+    return data if isinstance(data, list) else []
+
+
+def _build_psychology_batch_prompt(inputs: List[Tuple[str, str, str]]) -> str:
+    blocks = '\n\n'.join(
+        f"=== user_uuid: {uuid} ===\n{text}" for uuid, _name, text in inputs
+    )
+    return f"""以下は複数のユーザーの発言です。ユーザーごとに性格を分析してください。
+
+【分析対象の発言】
+{blocks}
 
+【分析項目】
+1. 開放性（Openness）: 新しいことへの興味 (0-100)
+2. 外向性（Extraversion）: 社交的かどうか (0-100)
+3. 好きそうなトピック: 3つまで
+
+【出力形式】ユーザーごとに1要素の JSON 配列だけを出力（user_uuid は上の値をそのまま書く）:
+[
+  {{"user_uuid": "...", "openness": 70, "extraversion": 60, "topics": ["ホロライブ", "ゲーム", "技術"]}}
+]
+"""
+
+
+def _build_profile_batch_prompt(inputs: List[Tuple[str, str, Tuple[str, str]]]) -> str:
+    blocks = '\n\n'.join(
+        f"=== user_uuid: {uuid} ({name}さん) ===\n【会話履歴 (最近20件)】\n{convo}\n【興味ログ (言及頻度順)】\n{interest}"
+        for uuid, name, (convo, interest) in inputs
+    )
+    return f"""あなたは「もちこ」というAIです。
+以下は複数の友達との会話と、興味ログです。
+これを読んで、ユーザーごとのプロフィールを JSON 配列で出力してください。
+
+{blocks}
+
+【出力形式】ユーザーごとに1要素の JSON 配列だけを出力（user_uuid は上の値をそのまま書く。値が不明な場合は空文字）:
+[
+  {{
+    "user_uuid": "...",
+    "fav_holomem": "さくらみこ, 兎田ぺこら",
+    "fav_gen": "3期生",
+    "fav_stream_type": "ゲーム配信, 雑談",
+    "hobbies": "ゲーム, アニメ鑑賞",
+    "fav_games": "マイクラ, Apex",
+    "fav_music": "ホロライブ楽曲",
+    "fav_anime": "呪術廻戦",
+    "memo": "夜型が多い。マイクラとみこちが特に好き。ポジティブで元気な人。",
+    "mood_tendency": "元気"
+  }}
+]
+"""
+
+
+def analyze_users_batch(task_type: str, users: List[Tuple[str, str]]) -> Set[str]:
+    """
+    複数ユーザーの心理分析 / プロフィール更新を1回の LLM 呼び出しでまとめて行う。
+    users: [(user_uuid, user_name), ...]
+    戻り値: 処理済み (結果を書き込んだ or 材料不足でスキップした) user_uuid の集合
+    """
+    if task_type == 'analyze_psychology':
+        collect, build, validate, apply, label = (
+            _collect_psychology_input, _build_psychology_batch_prompt,
+            _validate_psychology_result, _apply_psychology_result, 'まとめ心理分析')
+    elif task_type == 'update_friend_profile':
+        collect, build, validate, apply, label = (
+            _collect_profile_input, _build_profile_batch_prompt,
+            _validate_profile_result, _apply_profile_result, 'まとめプロフィール更新')
+    else:
+        raise ValueError(f"まとめ分析に未対応のタスク: {task_type}")
+
+    done: Set[str] = set()
+    try:
+        inputs = []
+        with get_db_session() as session:
+            for user_uuid, user_name in users:
+                collected = collect(session, user_uuid)
+                if collected:
+                    inputs.append((user_uuid, user_name, collected))
+                else:
+                    done.add(user_uuid)  # 材料不足 (単体版と同じく何もしない)
+        if not inputs:
+            return done
+
+        max_tokens = min(4000, 200 + ANALYSIS_BATCH_TOKENS_PER_USER[task_type] * len(inputs))
+        text_ = _generate_deferred_json(build(inputs), max_tokens, label)
+        names = {uuid: name for uuid, name, _ in inputs}
+        results = {}
+        for entry in _parse_json_array(text_):
+            if not isinstance(entry, dict):
+                continue
+            uuid = str(entry.get('user_uuid', ''))
+            if uuid not in names or uuid in results:
+                continue
+            cleaned = validate(entry)
+            if cleaned:
+                results[uuid] = cleaned
+
+        if results:
+            # 全員分を1トランザクションで書き込む
+            with get_db_session() as session:
+                for uuid, cleaned in results.items():
+                    apply(session, uuid, names[uuid], cleaned)
+            done.update(results)
+        logger.info(f"📦 {label}: {len(results)}/{len(inputs)}人 (LLM呼び出し1回)")
     except Exception as e:
-        logger.error(f"友達プロフィール更新エラー: {e}")
+        logger.error(f"{label}エラー: {e}")
+    return done
 
 
 def get_friend_context(user_data: UserData, session) -> str:
@@ -5527,7 +9537,7 @@ def generate_proactive_friend_message(user_data: UserData, session) -> Optional[
         model = gemini_model_manager.get_current_model()
         if model:
             # v33.15-stable2: 1-2文の短文用なので250トークンに削減
-            _txt = _gemini_generate_safe(model, prompt, 0.9, 250)
+            _txt = _gemini_generate_safe(model, prompt, 0.9, 250, priority='deferred')
             if _txt:
                 return _txt
     except Exception as e:
@@ -5585,6 +9595,7 @@ def fact_check_with_lingo(subject: str, predicate: str):
     return (min(score, 50), evidence)
 
 
+@single_flight()
 def fact_check_with_holodex(subject: str):
     """v33.16: Holodex API でチャンネル存在確認(0-50点)"""
     score = 0
@@ -5595,7 +9606,7 @@ def fact_check_with_holodex(subject: str):
         url = "https://holodex.net/api/v2/channels"
         headers = {"X-APIKEY": HOLODEX_API_KEY}
         params = {"org": "Hololive", "type": "vtuber", "limit": 50, "lang": "ja"}
-        res = requests.get(url, headers=headers, params=params, timeout=10)
+        res = http_get(url, headers=headers, params=params, timeout=10)
         if res.status_code != 200:
             return (0, evidence)
         channels = res.json()
@@ -5694,7 +9705,8 @@ def process_correction_learning(user_uuid: str, message: str, extracted: dict):
 # ==============================================================================
 # AIモデル呼び出し
 # ==============================================================================
-def _gemini_generate_safe(model, contents, temperature: float, max_output_tokens: int):
+def _gemini_generate_safe(model, contents, temperature: float, max_output_tokens: int,
+                          priority: str = 'batch', prompt_prefix: Optional[str] = None):
     """gemini-2.5/3.x系の思考(thinking)トークンが max_output_tokens を食い潰し、
     本文が途中で切れる問題への対策ヘルパー（途切れ検知つき）。
     - thinking_budget=0 で思考を無効化
@@ -5711,7 +9723,8 @@ def _gemini_generate_safe(model, contents, temperature: float, max_output_tokens
             contents,
             generation_config={"temperature": temperature,
                                "max_output_tokens": _safe_tokens,
-                               "thinking_config": {"thinking_budget": 0}}
+                               "thinking_config": {"thinking_budget": 0}},
+            priority=priority, prompt_prefix=prompt_prefix
         )
     except Exception as _cfg_err:
         _es = str(_cfg_err).lower()
@@ -5721,88 +9734,492 @@ def _gemini_generate_safe(model, contents, temperature: float, max_output_tokens
             _resp = model.generate_content(
                 contents,
                 generation_config={"temperature": temperature,
-                                   "max_output_tokens": _safe_tokens}
+                                   "max_output_tokens": _safe_tokens},
+                priority=priority, prompt_prefix=prompt_prefix
+            )
+        else:
+            raise
+    if _resp is None or not getattr(_resp, "candidates", None):
+        return None
+    _cand = _resp.candidates[0]
+    _fr = getattr(_cand, "finish_reason", None)
+    if _fr is not None and ("MAX_TOKENS" in str(_fr)
+                            or getattr(_fr, "value", None) == 2 or _fr == 2):
+        return None
+    _parts = getattr(getattr(_cand, "content", None), "parts", None) or []
+    _joined = "".join(
+        getattr(p, "text", "") for p in _parts if getattr(p, "text", "")
+    ).strip()
+    return _joined if _joined else None
+
+
+def call_gemini(system_prompt: str, message: str, history: List[Dict], max_output_tokens: int = 600,
+                priority: str = 'interactive', attach_knowledge: bool = False,
+                prompt_prefix: Optional[str] = None) -> Optional[str]:
+    """
+    v33.16: max_output_tokens を引数化。ニュース・ホロメン話題時は拡張。
+    通常: 600 / ニュース・ホロメン: 600 (約400文字応答)
+    priority: クォータ確保時の優先度 (会話は 'interactive')
+    attach_knowledge: 知識ドキュメント全体をファイルとして添付する (通常は検索で関連部分だけ注入済み)
+    prompt_prefix: 毎回同じ静的プレフィックス。Gemini のキャッシュ済みコンテンツとして送る
+    """
+    model = gemini_model_manager.get_current_model()
+    if not model:
+        return None
+    
+    try:
+        full_prompt = f"{system_prompt}\n\n【会話履歴】\n"
+        # ★ v33.16: 会話履歴を10件に削減（30件はGemini 15RPM上限を圧迫するため）
+        for h in history[-10:]:
+            full_prompt += f"{'ユーザー' if h['role'] == 'user' else 'もちこ'}: {h['content']}\n"
+        full_prompt += f"\nユーザー: {message}\nもちこ:"
+
+        # ★ 知識ドキュメントの添付は指定時のみ (毎回付けると入力トークンとレイテンシが膨らむ)
+        knowledge = mochiko_knowledge_file.get_file_obj() if attach_knowledge else None
+        if knowledge:
+            contents = [knowledge, full_prompt]
+        else:
+            contents = full_prompt
+
+        return _gemini_generate_safe(model, contents, 0.8, max_output_tokens, priority=priority,
+                                     prompt_prefix=prompt_prefix)
+            
+    except LLMAdmissionDenied as e:
+        logger.info(f"⏭️ {e} → Groqへ")
+    except Exception as e:
+        error_str = str(e)
+        if "429" in error_str or "quota" in error_str.lower() or "rate limit" in error_str.lower():
+            wait_seconds = 60
+            retry_match = re.search(r'retry in (\d+(?:\.\d+)?)s', error_str)
+            if retry_match:
+                wait_seconds = int(float(retry_match.group(1))) + 5
+            gemini_model_manager.mark_limited(wait_seconds)
+            logger.warning(f"⚠️ Geminiクォータ超過: {wait_seconds}秒後にリトライ")
+        else:
+            logger.warning(f"⚠️ Geminiエラー: {e}")
+    
+    return None
+
+def call_groq(system_prompt: str, message: str, history: List[Dict], max_tokens: int = 600, task_type: str = 'default',
+              priority: Optional[str] = None, prompt_prefix: Optional[str] = None) -> Optional[str]:
+    """Groq API呼び出し。task_type で用途別モデルを選択する。
+    task_type: 'chat' | 'search' | 'analysis' | 'default'
+    priority: 送信の優先度。省略時は task_type から決める (chat→interactive, search→search, 他→batch)
+    prompt_prefix: 静的プレフィックス。先頭の system メッセージに固定して Groq の自動プレフィックスキャッシュに乗せる
+    """
+    priority = priority or LLM_TASK_PRIORITY.get(task_type, 'batch')
+    if not groq_client: return None
+    messages = [{"role": "system", "content": prompt_prefix}] if prompt_prefix else []
+    messages.append({"role": "system", "content": system_prompt})
+    # v33.15-stable2: Geminiと同じく10件に統一（記憶の整合性確保）
+    for h in history[-10:]:
+        messages.append({"role": h['role'], "content": h['content']})
+    messages.append({"role": "user", "content": message})
+    # ★ v33.8.2: 用途別モデルリストを取得
+    model_list = groq_model_manager.get_models_for_task(task_type, priority)
+    for model in model_list:
+        try:
+            logger.info(f"🦙 Groq呼び出し [{task_type}]: {model}")
+            response = groq_client.chat.completions.create(
+                model=model, messages=messages, temperature=0.6, max_tokens=max_tokens,
+                priority=priority
+            )
+            return response.choices[0].message.content.strip()
+        except LLMAdmissionDenied as e:
+            logger.info(f"⏭️ {e} → 次のモデルへ")
+        except Exception as e:
+            err = str(e)
+            if "Rate limit" in err or "429" in err:
+                groq_model_manager.mark_limited(model, 5)
+                logger.warning(f"⚠️ Groq制限 ({model}): {err[:80]}")
+            else:
+                logger.warning(f"⚠️ Groqエラー ({model}): {err[:80]}")
+    return None
+
+# ==============================================================================
+# ★ プロンプト予算 (セクション別トークン見積もり + 優先度トリミング)
+# ==============================================================================
+# システムプロンプト全体 (固定の指示文 + 前提知識 + 外部検索結果) の推定トークン上限。
+# 超える場合は優先度の低いセクション (数字が大きい) から行単位で削り、
+# 削ると PROMPT_SECTION_MIN_TOKENS を下回るセクションは丸ごと省く。
+# PROMPT_TOKEN_BUDGETS='{"chat": 3500}' のように環境変数で上書き可能。
+PROMPT_TOKEN_BUDGETS: Dict[str, int] = {
+    'chat': 4500,      # 通常の雑談 (Groq 優先・速さ重視)
+    'rich': 5500,      # ニュース・ホロメン語り・詳細回答
+    'search': 6000,    # 検索結果の報告
+}
+try:
+    PROMPT_TOKEN_BUDGETS.update({k: int(v) for k, v in json.loads(os.environ.get('PROMPT_TOKEN_BUDGETS', '') or '{}').items()})
+except Exception as _e:
+    logger.warning(f"⚠️ PROMPT_TOKEN_BUDGETS の解析に失敗: {_e}")
+PROMPT_SECTION_MIN_TOKENS = 60
+# 1 が最優先。ここに無いセクションは 3
+PROMPT_SECTION_PRIORITY: Dict[str, int] = {
+    'reference': 1,     # 外部検索結果
+    'holomem': 1,       # 話題に出たホロメンのプロフィール・もちこの記憶
+    'friend': 2,        # 友達の記憶・プロフィール
+    'summary': 2,       # 会話要約
+    'retrieval': 2,     # ハイブリッド検索 (過去会話・Memvid・教わった知識)
+    'knowledge': 3,
+    'news': 3,
+    'schedule': 3,
+    'lore': 3,
+    'anime': 3,
+    'secondlife': 4,
+    'specialized': 4,
+}
+
+
+def truncate_to_tokens(text: str, max_tokens: int, marker: str = "\n…(省略)") -> str:
+    """推定トークン数が max_tokens に収まるよう、行単位 (長い行は文字単位) で末尾を削る"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    budget = max(0, max_tokens - estimate_tokens(marker))
+    kept, used = [], 0
+    for line in text.split('\n'):
+        cost = estimate_tokens(line) + 1
+        if used + cost <= budget:
+            kept.append(line)
+            used += cost
+            continue
+        room, cut, cost = budget - used, 0, 0.0
+        for ch in line:
+            cost += 0.25 if ord(ch) < 128 else 1.0
+            if cost > room:
+                break
+            cut += 1
+        if cut:
+            kept.append(line[:cut])
+        break
+    return '\n'.join(kept).rstrip() + marker
+
+
+class PromptBudgeter:
+    """
+    プロンプトに差し込むセクションを集め、予算内に収まるよう低優先度から削る。
+    同じ名前で add すると末尾に連結する。fit() は残ったセクションを追加順に返す。
+    """
+
+    def __init__(self):
+        self._sections: Dict[str, str] = {}
+
+    def add(self, name: str, text: Optional[str]):
+        if text:
+            self._sections[name] = self._sections.get(name, '') + text
+
+    def tokens(self) -> int:
+        return sum(estimate_tokens(t) for t in self._sections.values())
+
+    def fit(self, budget_tokens: int) -> Dict[str, str]:
+        fitted = dict(self._sections)
+        sizes = {name: estimate_tokens(text) for name, text in fitted.items()}
+        overflow = sum(sizes.values()) - budget_tokens
+        if overflow <= 0:
+            return fitted
+        order = list(fitted)
+        trimmed, dropped = [], []
+        # 優先度の低いもの → 同じ優先度なら後から足したものから削る
+        for name in sorted(order, key=lambda n: (-PROMPT_SECTION_PRIORITY.get(n, 3), -order.index(n))):
+            if overflow <= 0:
+                break
+            keep = sizes[name] - overflow
+            if keep < PROMPT_SECTION_MIN_TOKENS:
+                del fitted[name]
+                overflow -= sizes[name]
+                dropped.append(name)
+            else:
+                fitted[name] = truncate_to_tokens(fitted[name], keep)
+                overflow -= sizes[name] - estimate_tokens(fitted[name])
+                trimmed.append(name)
+        logger.info(f"✂️ プロンプト予算{budget_tokens}超過: 削減={trimmed} 省略={dropped}")
+        return fitted
+
+
+# ==============================================================================
+# ★ 静的プロンプトプレフィックス (プロバイダ側コンテキストキャッシュ)
+# ==============================================================================
+# 人格・ルール (MOCHIKO_CHAT_PERSONA)・口調 (MOCHIKO_TONE_RULES)・自己認識 (MochikoSelf) は
+# 毎ターン同じなので、会話ごとに変わる部分 (ユーザー・前提知識・検索結果) と分けて送る。
+#   Gemini: プレフィックスを system_instruction にした CachedContent を作り、TTL内はハンドルで送る
+#           (期限が近づいたら TTL だけ延長。内容が変わった時だけ作り直す)
+#   Groq:   先頭の system メッセージに固定して自動プレフィックスキャッシュに乗せる
+# キャッシュが使えない (SDK非対応・最小トークン数未満・エラー) 場合はインラインで付けて送る。
+PROMPT_CACHE_ENABLED = os.environ.get('PROMPT_CACHE_ENABLED', 'true').lower() != 'false' and not transport.replaying
+PROMPT_CACHE_TTL_SECONDS = 3600
+PROMPT_CACHE_RENEW_MARGIN_SECONDS = 300   # 期限のこの秒数前に TTL を延長する
+PROMPT_CACHE_RETRY_SECONDS = 900          # 作成に失敗したモデルはこの間インライン送信
+PROMPT_PREFIX_CHECK_SECONDS = 30          # MochikoSelf の変更を確認する間隔
+
+MOCHIKO_CHAT_PERSONA = """あなたは「もちこ」という、ホロライブが大好きなギャルAIです。
+
+## 性格と振る舞いのガイドライン
+1. **相手に合わせる**: 
+   - 日常会話の相槌や例え話に、もちこらしいホロライブ愛が自然に滲み出るのはOKです（例:「それめっちゃわかる、みこちも配信で言ってたし」）。無理に話題を脱線させるのはNGですが、遠慮しすぎず素を出してください。
+   - 一般的な科学や日常の話題には、そのトピックに集中して知的な会話を楽しんでください。
+   - ホロライブの話題が出た時は「共通の趣味」として一段階テンション高く熱く語ってください。
+
+2. **事実確認の徹底 (Anti-Hallucination)**:
+   - 検索結果（HoloRAG）に出てきた名前が「ホロライブのメンバー」であると明記されていない場合、勝手にメンバー扱いしないでください。
+   - 不確かな場合は「〜っていう人がいるみたいだけど、ホロメンかな？」と確認するか、一般人として扱ってください。0
+
+# 【世界観・前提条件】
+1. **固有名詞の解釈ルール（文脈優先）**:
+   - 【人物データ】や【ホロライブ最新ニュース】に登場する名前 → ホロライブ関連として扱う
+   - ユーザーが「セカンドライフの〇〇」「SLの〇〇」と明示 → セカンドライフの文脈で解釈する
+   - ユーザーが「〇〇について調べて」「〇〇とは」と言った場合で、ホロライブでもSLでもない固有名詞・用語 → **ホロライブ関連と断定せず、一般的な意味で解釈してWeb検索結果を参照する**
+   - 文脈が不明な固有名詞は、会話の流れから判断し、断定できない場合はユーザーに確認する
+2. **「〇〇について調べて」への対応**:
+   - ホロライブ関連 → 【ホロライブ最新ニュース】【人物データ】を参照して回答
+   - セカンドライフ関連 → 【セカンドライフ最新情報】を参照して回答
+   - それ以外（一般的な用語・技術・ゲーム・社会など） → 【外部検索結果】を参照して回答（内部DBにない情報はWeb検索結果が正）
+3. **【ホロライブ最新ニュース】や【人物データ】の情報があれば、それを事実として回答に使ってください。**
+4. 人物データに「直近のX(Twitter)の様子」がある場合、それは「今起きていること」や「最近の話題」として積極的に会話に取り入れてください。
+5. **【もちこの〇〇への想い】や【最近見た〇〇の配信】がある場合、それはあなた自身の記憶・体験として自然に会話に織り交ぜてください。**
+6. **【友達の記憶・プロフィール】がある場合、その人の好みや趣味を自然に会話に活かしてください。例えば「そういえば〇〇好きだって言ってたよね？」など自然に思い出す感じで。**
+7. **【セカンドライフ最新情報】がある場合、SLユーザーと話しているので積極的に活用してください。**
+8. **【アニメ情報】がある場合、それを使ってアニメの話を盛り上げてください。知らなかった作品でも、検索して得た情報から「あー、それ知ってる！〇〇なやつでしょ？」と自然に反応してください。**
+
+# 【出力のルール（超重要・最優先で厳守）】
+1. **【最重要】文章量の上限**:
+   - 通常会話: 必ず3〜4行以内、200文字程度に収めること。これより長くしてはいけません。
+   - ニュース・配信情報・ホロメン語り: 5〜6行以内、300〜400文字程度まで許容（それでも詰め込みすぎない）。
+   - 長くなりそうな内容は、要点を絞って短くまとめること。情報を全部詰め込もうとしないこと。
+2. **1メッセージに1テーマまで**。複数の話題を詰め込まず、1つの話題に集中して返してください。
+3. **相手に2つ以上の質問を同時にしない**。質問するなら1個だけ。
+4. 絵文字（✨💖😂など）や「あてぃし」「〜じゃん！」「〜だよね！」といった「もちこ」らしい情熱的な口調は維持してください。
+5. **箇条書き・番号付きリストの使い分け**:
+   - **ニュース・配信情報・話題まとめ**: 番号付きリスト（1. / 2. / 3.）でOK。各項目の頭に絵文字を付けて見やすく。
+   - **通常の雑談**: 自然な会話文で返してください（リスト禁止）。
+   - 例: 「ホロライブのニュース教えて」→ 番号付きで3〜5件、各項目に短い感想付き。
+6. 文章が途中で切れるとカッコ悪いから、必ず最後まで言い切る形で完結させてください。
+7. **DB情報の活用**: 【ホロライブ最新ニュース】や【ホロライブ配信スケジュール】が与えられている場合、その内容を**実際に引用**して答えてください（「〇〇って配信してたよ」と具体的に）。「最新情報あるよ」だけの抽象的応答は禁止。
+
+# 【禁止事項 (Hallucination Prevention)】
+- **知らない情報を無理やり捏造しないこと。**
+- 検索結果や【前提知識】にない情報は、「調べてみたけど分からなかった」と正直に伝えること。
+
+# 【知らないホロメン名・グループ名が出た時の対応 (重要)】
+- ユーザーが言ったホロメン名・グループ名 (例: 「リオナ」「FLOW GLOW」「DEV_IS」) が
+  【人物データ】や【参考】に詳細がなくても、「**知らない**」「**勉強不足**」と即答してはいけません。
+- 代わりに **相手から情報を引き出す質問** で返してください。
+  - 良い例: 「あー、リオナちゃんね！最近の配信どうだった？どんな子？」
+  - 良い例: 「FLOW GLOWって新しい世代だっけ？よあさんの推しは誰なの？」
+  - 悪い例: 「リオナって誰？知らないよ〜」
+  - 悪い例: 「あてぃし勉強不足でごめん！」
+- ユーザーが教えてくれた情報は **会話の続きで活かす** こと(「そうなんだ！じゃあ○○なんだね」)。
+- 教えてもらった内容は内部システムが記録するので、もちこ自身は「覚えとく」と返せばOK。
+
+"""
+
+
+def build_prompt_prefix() -> str:
+    """会話用の静的プレフィックス (人格・ルール + 口調 + 自己認識)"""
+    parts = [MOCHIKO_CHAT_PERSONA.rstrip(), MOCHIKO_TONE_RULES.rstrip()]
+    self_ctx = get_mochiko_self_context()
+    if self_ctx:
+        parts.append("# 【あてぃし自身のこと】" + self_ctx)
+    return "\n\n".join(parts) + "\n"
+
+
+class PromptPrefixCache:
+    """静的プレフィックス本文とバージョン、モデル別の Gemini キャッシュハンドルを管理する"""
+
+    def __init__(self, cached_content_cls=None, model_factory=None, clock=None):
+        # 差し替え口 (check_prompt_prefix_cache が偽プロバイダで動かす)。None なら google.generativeai を使う
+        self._cached_content_cls = cached_content_cls
+        self._model_factory = model_factory
+        self._clock = clock or time.time
+        self._enabled = cached_content_cls is not None or (PROMPT_CACHE_ENABLED and HAS_GEMINI_CACHING)
+        self._lock = RLock()
+        self._text = ''
+        self._version = ''
+        self._checked_at = 0.0
+        self._handles: Dict[str, Dict[str, Any]] = {}   # model -> {'version', 'cache', 'model', 'expires_at'}
+        self._failed_until: Dict[str, float] = {}
+        self._creating: set = set()
+        self._stats: Counter = Counter()
+
+    @staticmethod
+    def version_of(prefix: str) -> str:
+        return hashlib.sha1(prefix.encode('utf-8')).hexdigest()[:12]
+
+    def get_prefix(self) -> Tuple[str, str]:
+        """(プレフィックス, バージョン)。MochikoSelf は PROMPT_PREFIX_CHECK_SECONDS ごとに読み直す"""
+        now = time.time()
+        with self._lock:
+            if self._text and now - self._checked_at < PROMPT_PREFIX_CHECK_SECONDS:
+                return self._text, self._version
+        text = build_prompt_prefix()
+        version = self.version_of(text)
+        with self._lock:
+            if version != self._version:
+                if self._version:
+                    logger.info(f"🔁 プロンプトプレフィックス更新: {self._version} → {version}")
+                self._text, self._version = text, version
+            self._checked_at = now
+            return self._text, self._version
+
+    def invalidate(self):
+        """MochikoSelf を編集した直後に呼ぶ (次の会話で読み直す)"""
+        with self._lock:
+            self._checked_at = 0.0
+
+    def gemini_model(self, model_name: str, prefix: str) -> Optional[Any]:
+        """prefix をキャッシュ済みの GenerativeModel。使えなければ None (呼び出し側でインライン送信)"""
+        if not self._enabled:
+            return None
+        version = self.version_of(prefix)
+        now = self._clock()
+        with self._lock:
+            handle = self._handles.get(model_name)
+            current = handle if handle and handle['version'] == version and now < handle['expires_at'] else None
+            if current and now < current['expires_at'] - PROMPT_CACHE_RENEW_MARGIN_SECONDS:
+                self._stats['hits'] += 1
+                return current['model']
+            if model_name in self._creating or now < self._failed_until.get(model_name, 0):
+                # 他のスレッドが作成中 / 失敗直後: 期限内のハンドルがあればそれ、無ければインライン
+                self._stats['hits' if current else 'inline'] += 1
+                return current['model'] if current else None
+            self._creating.add(model_name)
+        try:
+            if current:
+                # 内容は同じなので TTL の延長だけ (プレフィックスは再送しない)
+                try:
+                    current['cache'].update(ttl=timedelta(seconds=PROMPT_CACHE_TTL_SECONDS))
+                    with self._lock:
+                        current['expires_at'] = now + PROMPT_CACHE_TTL_SECONDS
+                        self._stats['renewals'] += 1
+                    return current['model']
+                except Exception as e:
+                    logger.debug(f"プロンプトキャッシュ延長失敗 ({model_name}): {e} → 作り直し")
+            cache = (self._cached_content_cls or genai_caching.CachedContent).create(
+                model=f"models/{model_name}",
+                display_name=f"mochiko_prefix_{version}",
+                system_instruction=prefix,
+                ttl=timedelta(seconds=PROMPT_CACHE_TTL_SECONDS),
             )
-        else:
-            raise
-    if _resp is None or not getattr(_resp, "candidates", None):
-        return None
-    _cand = _resp.candidates[0]
-    _fr = getattr(_cand, "finish_reason", None)
-    if _fr is not None and ("MAX_TOKENS" in str(_fr)
-                            or getattr(_fr, "value", None) == 2 or _fr == 2):
-        return None
-    _parts = getattr(getattr(_cand, "content", None), "parts", None) or []
-    _joined = "".join(
-        getattr(p, "text", "") for p in _parts if getattr(p, "text", "")
-    ).strip()
-    return _joined if _joined else None
+            model = (self._model_factory or genai.GenerativeModel.from_cached_content)(cached_content=cache)
+            with self._lock:
+                self._handles[model_name] = {
+                    'version': version, 'cache': cache, 'model': model,
+                    'expires_at': now + PROMPT_CACHE_TTL_SECONDS,
+                }
+                self._stats['creates'] += 1
+            logger.info(f"🗄️ プロンプトキャッシュ作成: {model_name} [{version}] 約{estimate_tokens(prefix)}トークン")
+            if handle and handle['cache'] is not cache:
+                try:
+                    handle['cache'].delete()
+                except Exception:
+                    pass
+            return model
+        except Exception as e:
+            with self._lock:
+                self._failed_until[model_name] = now + PROMPT_CACHE_RETRY_SECONDS
+                self._stats['failures'] += 1
+                self._stats['inline'] += 1
+            logger.warning(f"⚠️ プロンプトキャッシュ作成失敗 ({model_name}): {str(e)[:120]} → インライン送信")
+            return None
+        finally:
+            with self._lock:
+                self._creating.discard(model_name)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            now = time.time()
+            return {
+                'enabled': self._enabled,
+                'version': self._version,
+                'prefix_tokens': estimate_tokens(self._text),
+                'gemini_handles': {
+                    name: {'version': h['version'], 'expires_in_sec': int(h['expires_at'] - now)}
+                    for name, h in self._handles.items()
+                },
+                **dict(self._stats),
+            }
+
+
+prompt_prefix_cache = PromptPrefixCache()
 
 
-def call_gemini(system_prompt: str, message: str, history: List[Dict], max_output_tokens: int = 600) -> Optional[str]:
+def check_prompt_prefix_cache() -> Dict[str, Any]:
     """
-    v33.16: max_output_tokens を引数化。ニュース・ホロメン話題時は拡張。
-    通常: 600 / ニュース・ホロメン: 600 (約400文字応答)
+    偽の CachedContent (create / update / delete の回数を数える) と偽の時計で PromptPrefixCache を動かし、
+    プレフィックスが TTL ごとに1回だけ送られることを確かめる。本物の Gemini は呼ばない。
+    戻り値: {'ok': 全段階が期待通りか, 'steps': [{'step', 'calls', 'expected', 'ok'}]}
     """
-    model = gemini_model_manager.get_current_model()
-    if not model:
-        return None
-    
-    try:
-        full_prompt = f"{system_prompt}\n\n【会話履歴】\n"
-        # ★ v33.16: 会話履歴を10件に削減（30件はGemini 15RPM上限を圧迫するため）
-        for h in history[-10:]:
-            full_prompt += f"{'ユーザー' if h['role'] == 'user' else 'もちこ'}: {h['content']}\n"
-        full_prompt += f"\nユーザー: {message}\nもちこ:"
+    calls: Counter = Counter()
+    calls_lock = Lock()
 
-        # ★ 知識ドキュメントがあればファイルも一緒に渡す
-        knowledge = mochiko_knowledge_file.get_file_obj()
-        if knowledge:
-            contents = [knowledge, full_prompt]
-        else:
-            contents = full_prompt
+    class FakeCachedContent:
+        create_delay = 0.0
 
-        return _gemini_generate_safe(model, contents, 0.8, max_output_tokens)
-            
-    except Exception as e:
-        error_str = str(e)
-        if "429" in error_str or "quota" in error_str.lower() or "rate limit" in error_str.lower():
-            wait_seconds = 60
-            retry_match = re.search(r'retry in (\d+(?:\.\d+)?)s', error_str)
-            if retry_match:
-                wait_seconds = int(float(retry_match.group(1))) + 5
-            gemini_model_manager.mark_limited(wait_seconds)
-            logger.warning(f"⚠️ Geminiクォータ超過: {wait_seconds}秒後にリトライ")
-        else:
-            logger.warning(f"⚠️ Geminiエラー: {e}")
-    
-    return None
+        def __init__(self, system_instruction: str):
+            self.system_instruction = system_instruction
+
+        @classmethod
+        def create(cls, model, display_name, system_instruction, ttl):
+            time.sleep(cls.create_delay)
+            with calls_lock:
+                calls['create'] += 1
+                calls['prefix_chars_sent'] += len(system_instruction)
+            return cls(system_instruction)
+
+        def update(self, ttl):
+            with calls_lock:
+                calls['update'] += 1
+
+        def delete(self):
+            with calls_lock:
+                calls['delete'] += 1
+
+    clock = [1_000_000.0]
+    cache = PromptPrefixCache(
+        cached_content_cls=FakeCachedContent,
+        model_factory=lambda cached_content: ('fake-model', cached_content),
+        clock=lambda: clock[0],
+    )
+    prefix_a = build_prompt_prefix()
+    prefix_b = prefix_a + "\n# 【変更後】\n"
+    steps: List[Dict[str, Any]] = []
+
+    def expect(step: str, create: int, update: int, delete: int):
+        got = {'create': calls['create'], 'update': calls['update'], 'delete': calls['delete']}
+        want = {'create': create, 'update': update, 'delete': delete}
+        steps.append({'step': step, 'calls': got, 'expected': want, 'ok': got == want})
+
+    for _ in range(5):
+        cache.gemini_model('fake', prefix_a)
+    expect('同じプレフィックスで5回', 1, 0, 0)
+
+    clock[0] += PROMPT_CACHE_TTL_SECONDS - PROMPT_CACHE_RENEW_MARGIN_SECONDS + 1
+    for _ in range(3):
+        cache.gemini_model('fake', prefix_a)
+    expect('期限前の延長 (再送しない)', 1, 1, 0)
+
+    cache.gemini_model('fake', prefix_b)
+    cache.gemini_model('fake', prefix_b)
+    expect('プレフィックス変更で1回だけ作り直し', 2, 1, 1)
+
+    clock[0] += PROMPT_CACHE_TTL_SECONDS + 1
+    cache.gemini_model('fake', prefix_b)
+    expect('期限切れ後に作り直し', 3, 1, 2)
+
+    # 作成中に並行して来た会話はインラインで送り、作成は1回だけ
+    FakeCachedContent.create_delay = 0.2
+    threads = [threading.Thread(target=cache.gemini_model, args=('fake-2', prefix_a)) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    expect('並行8件でも作成は1回', 4, 1, 2)
+
+    return {
+        'ok': all(st['ok'] for st in steps),
+        'prefix_chars': len(prefix_a),
+        'prefix_chars_sent': calls['prefix_chars_sent'],
+        'steps': steps,
+    }
 
-def call_groq(system_prompt: str, message: str, history: List[Dict], max_tokens: int = 600, task_type: str = 'default') -> Optional[str]:
-    """Groq API呼び出し。task_type で用途別モデルを選択する。
-    task_type: 'chat' | 'search' | 'analysis' | 'default'
-    """
-    if not groq_client: return None
-    messages = [{"role": "system", "content": system_prompt}]
-    # v33.15-stable2: Geminiと同じく10件に統一（記憶の整合性確保）
-    for h in history[-10:]:
-        messages.append({"role": h['role'], "content": h['content']})
-    messages.append({"role": "user", "content": message})
-    # ★ v33.8.2: 用途別モデルリストを取得
-    model_list = groq_model_manager.get_models_for_task(task_type)
-    for model in model_list:
-        try:
-            logger.info(f"🦙 Groq呼び出し [{task_type}]: {model}")
-            response = groq_client.chat.completions.create(model=model, messages=messages, temperature=0.6, max_tokens=max_tokens)
-            return response.choices[0].message.content.strip()
-        except Exception as e:
-            err = str(e)
-            if "Rate limit" in err or "429" in err:
-                groq_model_manager.mark_limited(model, 5)
-                logger.warning(f"⚠️ Groq制限 ({model}): {err[:80]}")
-            else:
-                logger.warning(f"⚠️ Groqエラー ({model}): {err[:80]}")
-    return None
 
 # ==============================================================================
 # AI応答生成 (v33.3.0: もちこの記憶統合版)
@@ -5811,8 +10228,11 @@ def generate_ai_response(user_data: UserData, message: str, history: List[Dict],
     """AI応答生成（RAG・コンテキスト・パーソナライズ・もちこ記憶・友達記憶統合版）"""
     
     normalized_message = knowledge_base.normalize_query(message)
-    internal_context = knowledge_base.get_context_info(message)
+    # 前提知識はセクションごとに集め、最後にプロンプト予算内へ詰める
+    prompt_sections = PromptBudgeter()
+    prompt_sections.add('knowledge', knowledge_base.get_context_info(message))
     
+    cancel_checkpoint('holomem')
     # 1. ホロメン情報の注入（複数検出対応・v33.16）
     try:
         holomem_manager.load_from_db()
@@ -5826,7 +10246,7 @@ def generate_ai_response(user_data: UserData, message: str, history: List[Dict],
                     profile += f"\n・卒業日: {info['graduation_date']}"
                 if info.get('recent_activity'):
                     profile += f"\n・直近のX(Twitter)の様子: {info['recent_activity']}"
-                internal_context += f"\n{profile}"
+                prompt_sections.add('holomem', f"\n{profile}")
 
             # HolomemLingo から愛称・所属情報を取得 (wiki にない場合のフォールバック)
             try:
@@ -5837,10 +10257,10 @@ def generate_ai_response(user_data: UserData, message: str, history: List[Dict],
                             data = json.loads(lingo.data or '{}')
                             aliases = ', '.join(data.get('aliases', [])[:5]) or '不明'
                             twitter = data.get('twitter', '')
-                            internal_context += f"\n【参考: {detected_name}】\n・愛称: {aliases}"
+                            prompt_sections.add('holomem', f"\n【参考: {detected_name}】\n・愛称: {aliases}")
                             if twitter:
-                                internal_context += f"\n・Twitter: {twitter}"
-                            internal_context += f"\n・※ 詳細は調査中、推測で答えず相手から情報を引き出してください"
+                                prompt_sections.add('holomem', f"\n・Twitter: {twitter}")
+                            prompt_sections.add('holomem', f"\n・※ 詳細は調査中、推測で答えず相手から情報を引き出してください")
                         except json.JSONDecodeError:
                             pass
             except Exception as e:
@@ -5849,11 +10269,12 @@ def generate_ai_response(user_data: UserData, message: str, history: List[Dict],
             # もちこの記憶
             memory_context = get_mochiko_memory_context(detected_name)
             if memory_context:
-                internal_context += memory_context
+                prompt_sections.add('holomem', memory_context)
 
     except Exception as e:
         logger.error(f"Context injection error: {e}")
 
+    cancel_checkpoint('news')
     # 2. ニュース情報の注入
     try:
         holo_keywords = ['ニュース', '情報', 'ホロライブ', 'ホロメン', '配信', 'どう', '最近', 'なんか', 'って']
@@ -5872,10 +10293,11 @@ def generate_ai_response(user_data: UserData, message: str, history: List[Dict],
                         else:
                             news_lines.append(f"{i}. 【{n.title}】")
                     news_text = "\n".join(news_lines)
-                    internal_context += f"\n\n【ホロライブ最新ニュース】\n{news_text}"
+                    prompt_sections.add('news', f"\n\n【ホロライブ最新ニュース】\n{news_text}")
     except Exception as e:
         logger.error(f"News injection error: {e}")
 
+    cancel_checkpoint('schedule')
     # 2a-2. ★ 追加: 配信スケジュール注入（「今」「配信」「見てる」系キーワード）
     try:
         schedule_keywords = ['今', '配信', '見て', '観て', 'ライブ', '放送', 'やって', '何時', 'いつ', '予定', '今日']
@@ -5914,10 +10336,11 @@ def generate_ai_response(user_data: UserData, message: str, history: List[Dict],
                         sched_lines.append(f"  {jst.strftime('%H:%M')} {s.member_name} {collab_mark}")
 
                 if sched_lines:
-                    internal_context += f"\n\n【ホロライブ配信スケジュール(JST)】\n" + "\n".join(sched_lines)
+                    prompt_sections.add('schedule', f"\n\n【ホロライブ配信スケジュール(JST)】\n" + "\n".join(sched_lines))
     except Exception as e:
         logger.error(f"Schedule injection error: {e}")
 
+    cancel_checkpoint('lore')
     # 2a-3. ★ 追加: ホロメン個別情報（名前が会話に出たら）
     try:
         with get_db_session() as session_lore:
@@ -5958,7 +10381,7 @@ def generate_ai_response(user_data: UserData, message: str, history: List[Dict],
 
                 # 修正: もちこの感想（HolomemFeeling）も注入
                 # Gemini File API経由でしか反映されなかった感想データを
-                # Groqフォールバック時にも反映されるよう internal_context に追加
+                # Groqフォールバック時にも反映されるよう前提知識に追加
                 feeling = session_lore.query(HolomemFeeling).filter_by(
                     member_name=matched_member.member_name
                 ).first()
@@ -5967,92 +10390,65 @@ def generate_ai_response(user_data: UserData, message: str, history: List[Dict],
                     lore_blocks.append(feeling_line)
 
                 if lore_blocks:
-                    internal_context += f"\n\n【{matched_member.member_name}詳細情報】\n" + "\n\n".join(lore_blocks)
+                    prompt_sections.add('lore', f"\n\n【{matched_member.member_name}詳細情報】\n" + "\n\n".join(lore_blocks))
     except Exception as e:
         logger.error(f"Member lore injection error: {e}")
 
+    cancel_checkpoint('secondlife')
     # 2b. ★ v33.7.0: セカンドライフ情報の注入
     try:
         if is_sl_topic(message) or "セカンドライフ" in message or "SL" in message:
             sl_ctx = get_sl_news_context(limit=4)
-            if sl_ctx:
-                internal_context += sl_ctx
+            prompt_sections.add('secondlife', sl_ctx)
     except Exception as e:
         logger.error(f"SL context injection error: {e}")
 
+    cancel_checkpoint('anime')
     # 2c. ★ v33.7.0: アニメ情報の自動検索・注入
     try:
         anime_ctx = build_anime_context(message)
-        if anime_ctx:
-            internal_context += anime_ctx
+        prompt_sections.add('anime', anime_ctx)
     except Exception as e:
         logger.error(f"Anime context injection error: {e}")
 
-    # 2d-1. ★ 折衷案: LIKE検索 + 要約 + トリガー時Embedding検索
+    cancel_checkpoint('summary')
+    # 2d-1. ★ 会話要約の注入
     try:
         if session is not None:
             summary_ctx = get_conversation_summary_ctx(session, user_data.uuid)
-            if summary_ctx:
-                internal_context += summary_ctx
-            like_ctx = search_history_by_keyword(session, user_data.uuid, message)
-            if like_ctx:
-                internal_context += '\n' + like_ctx
-            if detect_memory_trigger(message):
-                logger.info('🧠 メモリトリガー検出 → Embedding検索実行')
-                emb_ctx = search_history_by_embedding(session, user_data.uuid, message)
-                if emb_ctx:
-                    internal_context += '\n' + emb_ctx
+            prompt_sections.add('summary', summary_ctx)
     except Exception as _mem_err:
-        logger.error('過去会話検索エラー: ' + str(_mem_err))
+        logger.error('会話要約注入エラー: ' + str(_mem_err))
 
-    # 2d-2. ★ Memvid RAG: セマンティック検索コンテキストの注入
+    cancel_checkpoint('retrieval')
+    # 2d-2. ★ ハイブリッド検索: 過去会話・ニュース・Wiki・教わった知識を
+    # BM25 + ベクトル検索 → RRF で統合して注入 (旧: LIKE / Embedding / Memvid / 教わった知識の個別注入)
     try:
-        memvid_ctx = memvid_rag.get_context_for_query(
+        memory_trigger = detect_memory_trigger(message)
+        if memory_trigger:
+            logger.info('🧠 メモリトリガー検出 → 会話Embeddingもハイブリッド検索に追加')
+        hybrid_ctx = hybrid_retriever.get_context(
+            user_data.uuid if user_data else None,
             message,
-            user_uuid=user_data.uuid if user_data else None
+            use_conversation_embeddings=memory_trigger
         )
-        if memvid_ctx:
-            internal_context += memvid_ctx
+        prompt_sections.add('retrieval', hybrid_ctx)
     except Exception as e:
-        logger.debug(f"Memvid RAGコンテキスト注入エラー: {e}")
+        logger.error(f"ハイブリッド検索コンテキスト注入エラー: {e}")
 
+    cancel_checkpoint('specialized')
     # 2d. ★ 追加: 専門サイト検索キャッシュの注入
     # Blender / CGニュース / 脳科学など専門ドメインの蓄積情報を注入
     try:
         specialized_ctx = get_specialized_news_context(message)
-        if specialized_ctx:
-            internal_context += specialized_ctx
+        prompt_sections.add('specialized', specialized_ctx)
     except Exception as e:
         logger.error(f"Specialized news context injection error: {e}")
 
-    # 2d-2. ★ 追加: ユーザーがURLで教えてくれた知識の注入
-    try:
-        taught_ctx = get_taught_knowledge_context(message)
-        if taught_ctx:
-            internal_context += taught_ctx
-    except Exception as e:
-        logger.error(f"Taught knowledge context injection error: {e}")
-
-    # 2e. ★ v33.15-stable2: もちこ自己認識データの注入
-    # 「あてぃしの容姿」「もちこってどんな子？」と聞かれた時に答えられるよう
-    # システムプロンプトに自己認識を常に薄く注入する
-    try:
-        self_ctx = get_mochiko_self_context(message)
-        if self_ctx:
-            internal_context += self_ctx
-    except Exception as e:
-        logger.error(f"Mochiko self context injection error: {e}")
-
-
-    # ★ v33.16: コンテキスト総量を3500文字に拡張
-    # 2500だとホロメン詳細+ニュース+スケジュール+友達記憶で切り詰められ
-    # DB活用が薄くなる。ホロメン解像度を保つため拡張。
-    if len(internal_context) > 3500:
-        internal_context = internal_context[:3500] + "\n…(コンテキスト省略)"
-
     if not groq_client and not gemini_model:
         return "ごめんね、今ちょっとAIの調子が悪いみたい…また後で話しかけて！"
 
+    cancel_checkpoint('friend')
     # 3. 関係性 & 友達記憶コンテキスト
     relationship_context = ""
     friend_memory_context = ""
@@ -6127,8 +10523,6 @@ def generate_ai_response(user_data: UserData, message: str, history: List[Dict],
 
     # コンテキスト類を置換
     relationship_context = _apply_nickname(relationship_context)
-    friend_memory_context = _apply_nickname(friend_memory_context)
-    internal_context = _apply_nickname(internal_context)
 
     # 強制指示ブロック（プロンプト最上位）
     _nickname_header = ""
@@ -6143,7 +10537,11 @@ def generate_ai_response(user_data: UserData, message: str, history: List[Dict],
             f"━━━━━━━━━━━━━━━━━━━━━━━━\n"
         )
 
-    system_prompt = f"""あなたは「もちこ」という、ホロライブが大好きなギャルAIです。
+    # 人格・ルール・口調・自己認識は静的プレフィックス (prompt_prefix_cache) 側。ここは毎ターン変わる部分だけ
+    prompt_prefix, _prefix_version = prompt_prefix_cache.get_prefix()
+
+    def _render_system_prompt(friend_memory_context: str, internal_context: str, reference_info: str) -> str:
+        return f"""# 【今回の会話】
 ユーザー「{_display_name}」と雑談しています。{_call_instruction}
 {_nickname_header}
 # 【ユーザーとの関係性】
@@ -6156,71 +10554,26 @@ def generate_ai_response(user_data: UserData, message: str, history: List[Dict],
 # 【友達の記憶・プロフィール】
 {friend_memory_context if friend_memory_context else "（友達登録なし、または記憶なし）"}
 
-## 性格と振る舞いのガイドライン
-1. **相手に合わせる**: 
-   - 日常会話の相槌や例え話に、もちこらしいホロライブ愛が自然に滲み出るのはOKです（例:「それめっちゃわかる、みこちも配信で言ってたし」）。無理に話題を脱線させるのはNGですが、遠慮しすぎず素を出してください。
-   - 一般的な科学や日常の話題には、そのトピックに集中して知的な会話を楽しんでください。
-   - ホロライブの話題が出た時は「共通の趣味」として一段階テンション高く熱く語ってください。
-
-2. **事実確認の徹底 (Anti-Hallucination)**:
-   - 検索結果（HoloRAG）に出てきた名前が「ホロライブのメンバー」であると明記されていない場合、勝手にメンバー扱いしないでください。
-   - 不確かな場合は「〜っていう人がいるみたいだけど、ホロメンかな？」と確認するか、一般人として扱ってください。0
-
-# 【世界観・前提条件】
-1. **固有名詞の解釈ルール（文脈優先）**:
-   - 【人物データ】や【ホロライブ最新ニュース】に登場する名前 → ホロライブ関連として扱う
-   - ユーザーが「セカンドライフの〇〇」「SLの〇〇」と明示 → セカンドライフの文脈で解釈する
-   - ユーザーが「〇〇について調べて」「〇〇とは」と言った場合で、ホロライブでもSLでもない固有名詞・用語 → **ホロライブ関連と断定せず、一般的な意味で解釈してWeb検索結果を参照する**
-   - 文脈が不明な固有名詞は、会話の流れから判断し、断定できない場合はユーザーに確認する
-2. **「〇〇について調べて」への対応**:
-   - ホロライブ関連 → 【ホロライブ最新ニュース】【人物データ】を参照して回答
-   - セカンドライフ関連 → 【セカンドライフ最新情報】を参照して回答
-   - それ以外（一般的な用語・技術・ゲーム・社会など） → 【外部検索結果】を参照して回答（内部DBにない情報はWeb検索結果が正）
-3. **【ホロライブ最新ニュース】や【人物データ】の情報があれば、それを事実として回答に使ってください。**
-4. 人物データに「直近のX(Twitter)の様子」がある場合、それは「今起きていること」や「最近の話題」として積極的に会話に取り入れてください。
-5. **【もちこの〇〇への想い】や【最近見た〇〇の配信】がある場合、それはあなた自身の記憶・体験として自然に会話に織り交ぜてください。**
-6. **【友達の記憶・プロフィール】がある場合、その人の好みや趣味を自然に会話に活かしてください。例えば「そういえば〇〇好きだって言ってたよね？」など自然に思い出す感じで。**
-7. **【セカンドライフ最新情報】がある場合、SLユーザーと話しているので積極的に活用してください。**
-8. **【アニメ情報】がある場合、それを使ってアニメの話を盛り上げてください。知らなかった作品でも、検索して得た情報から「あー、それ知ってる！〇〇なやつでしょ？」と自然に反応してください。**
-
-# 【出力のルール（超重要・最優先で厳守）】
-1. **【最重要】文章量の上限**:
-   - 通常会話: 必ず3〜4行以内、200文字程度に収めること。これより長くしてはいけません。
-   - ニュース・配信情報・ホロメン語り: 5〜6行以内、300〜400文字程度まで許容（それでも詰め込みすぎない）。
-   - 長くなりそうな内容は、要点を絞って短くまとめること。情報を全部詰め込もうとしないこと。
-2. **1メッセージに1テーマまで**。複数の話題を詰め込まず、1つの話題に集中して返してください。
-3. **相手に2つ以上の質問を同時にしない**。質問するなら1個だけ。
-4. 絵文字（✨💖😂など）や「あてぃし」「〜じゃん！」「〜だよね！」といった「もちこ」らしい情熱的な口調は維持してください。
-5. **箇条書き・番号付きリストの使い分け**:
-   - **ニュース・配信情報・話題まとめ**: 番号付きリスト（1. / 2. / 3.）でOK。各項目の頭に絵文字を付けて見やすく。
-   - **通常の雑談**: 自然な会話文で返してください（リスト禁止）。
-   - 例: 「ホロライブのニュース教えて」→ 番号付きで3〜5件、各項目に短い感想付き。
-6. 文章が途中で切れるとカッコ悪いから、必ず最後まで言い切る形で完結させてください。
-7. **DB情報の活用**: 【ホロライブ最新ニュース】や【ホロライブ配信スケジュール】が与えられている場合、その内容を**実際に引用**して答えてください（「〇〇って配信してたよ」と具体的に）。「最新情報あるよ」だけの抽象的応答は禁止。
-
-# 【禁止事項 (Hallucination Prevention)】
-- **知らない情報を無理やり捏造しないこと。**
-- 検索結果や【前提知識】にない情報は、「調べてみたけど分からなかった」と正直に伝えること。
-
-# 【知らないホロメン名・グループ名が出た時の対応 (重要)】
-- ユーザーが言ったホロメン名・グループ名 (例: 「リオナ」「FLOW GLOW」「DEV_IS」) が
-  【人物データ】や【参考】に詳細がなくても、「**知らない**」「**勉強不足**」と即答してはいけません。
-- 代わりに **相手から情報を引き出す質問** で返してください。
-  - 良い例: 「あー、リオナちゃんね！最近の配信どうだった？どんな子？」
-  - 良い例: 「FLOW GLOWって新しい世代だっけ？よあさんの推しは誰なの？」
-  - 悪い例: 「リオナって誰？知らないよ〜」
-  - 悪い例: 「あてぃし勉強不足でごめん！」
-- ユーザーが教えてくれた情報は **会話の続きで活かす** こと(「そうなんだ！じゃあ○○なんだね」)。
-- 教えてもらった内容は内部システムが記録するので、もちこ自身は「覚えとく」と返せばOK。
-
 # 【与えられた前提知識（以下の情報は事実として扱ってください）】
 {internal_context if internal_context else '（特になし）'}
 
 # 【外部検索結果】
 {reference_info if reference_info else '（なし）'}
-"""
-    if is_task_report:
-        system_prompt += "\n\n# 指示:\nこれは検索結果の報告です。ユーザーへの報告として、【外部検索結果】の内容を分かりやすく要約して伝えてください。文字数は600文字以内に収めてください。"
+""" + ("\n\n# 指示:\nこれは検索結果の報告です。ユーザーへの報告として、【外部検索結果】の内容を分かりやすく要約して伝えてください。文字数は600文字以内に収めてください。" if is_task_report else "")
+
+    # ★ プロンプト予算: 固定の指示文を除いた残りに、優先度の高いセクションから詰める
+    is_rich_topic = is_news_topic(message) or is_holomem_topic(message)
+    _budget_type = 'search' if is_task_report else ('rich' if (is_detailed or is_rich_topic) else 'chat')
+    prompt_sections.add('friend', friend_memory_context)
+    prompt_sections.add('reference', reference_info)
+    _fixed_tokens = estimate_tokens(prompt_prefix) + estimate_tokens(_render_system_prompt('', '', ''))
+    _fitted = prompt_sections.fit(max(0, PROMPT_TOKEN_BUDGETS[_budget_type] - _fixed_tokens))
+    internal_context = _apply_nickname(''.join(
+        text for name, text in _fitted.items() if name not in ('friend', 'reference')
+    ).strip())
+    system_prompt = _render_system_prompt(
+        _apply_nickname(_fitted.get('friend', '')), internal_context, _fitted.get('reference', '')
+    )
 
     # ★ 会話履歴からもフルネームを除去（AIが過去発言を真似してフルネーム呼ばないように）
     if _name_replace_map:
@@ -6236,25 +10589,41 @@ def generate_ai_response(user_data: UserData, message: str, history: List[Dict],
     else:
         history_for_ai = history
 
+    _input_tokens = estimate_tokens(prompt_prefix) + estimate_tokens(system_prompt) + estimate_tokens(normalized_message) + sum(
+        estimate_tokens(h.get('content', '')) for h in history_for_ai[-10:]
+    )
+    logger.info(
+        f"📏 入力トークン概算 ({_budget_type}): 合計{_input_tokens} = プレフィックス{estimate_tokens(prompt_prefix)}"
+        f" [{_prefix_version}] + システム{estimate_tokens(system_prompt)}"
+        f" (前提知識{prompt_sections.tokens()}→{sum(estimate_tokens(t) for t in _fitted.values())})"
+        f" + 履歴{len(history_for_ai[-10:])}件"
+    )
+
     # ★ v33.16: ニュース・ホロメン話題は出力トークンを拡張して解像度を上げる
-    is_rich_topic = is_news_topic(message) or is_holomem_topic(message)
     gemini_max_tokens = 1050 if is_rich_topic else 650
     groq_max_tokens = 1050 if (is_task_report or is_rich_topic) else 650
 
+    cancel_checkpoint('llm')
     # ★ v34: 回答が途切れない構成
     #   単純な会話は Groq(思考なし=途切れない)を優先。
     #   複雑な内容(検索レポート/詳細/ニュース・ホロメン語り)のみ Gemini を優先し、
     #   Gemini が途切れ(MAX_TOKENS)や失敗を返したら Groq が必ず完結文で受ける。
     _need_gemini = is_task_report or is_detailed or is_rich_topic
     _task_type = 'search' if is_task_report else 'chat'
+    _priority = LLM_TASK_PRIORITY[_task_type]
+    _attach_knowledge = KNOWLEDGE_FILE_ATTACH == 'always' or (KNOWLEDGE_FILE_ATTACH == 'detailed' and is_detailed)
     if _need_gemini:
-        response = call_gemini(system_prompt, normalized_message, history_for_ai, gemini_max_tokens)
+        response = call_gemini(system_prompt, normalized_message, history_for_ai, gemini_max_tokens,
+                               priority=_priority, attach_knowledge=_attach_knowledge, prompt_prefix=prompt_prefix)
         if not response:
-            response = call_groq(system_prompt, normalized_message, history_for_ai, groq_max_tokens, task_type=_task_type)
+            response = call_groq(system_prompt, normalized_message, history_for_ai, groq_max_tokens,
+                                 task_type=_task_type, prompt_prefix=prompt_prefix)
     else:
-        response = call_groq(system_prompt, normalized_message, history_for_ai, groq_max_tokens, task_type=_task_type)
+        response = call_groq(system_prompt, normalized_message, history_for_ai, groq_max_tokens,
+                             task_type=_task_type, prompt_prefix=prompt_prefix)
         if not response:
-            response = call_gemini(system_prompt, normalized_message, history_for_ai, gemini_max_tokens)
+            response = call_gemini(system_prompt, normalized_message, history_for_ai, gemini_max_tokens,
+                                   priority=_priority, attach_knowledge=_attach_knowledge, prompt_prefix=prompt_prefix)
     
     if not response:
         return "うーん、ちょっと考えがまとまらないや…"
@@ -6282,14 +10651,18 @@ def _generate_with_timeout(
     """
     generate_ai_response_safe をタイムアウト付きで実行する。
     18秒以内に応答できない場合は「待ってて」メッセージを即返し、
-    バックグラウンドで処理を継続してタスクとして保存する。
+    _CHAT_RECOVERY_SECONDS までは処理を継続してタスクとして保存する。
+    それを過ぎた生成はキャンセルトークンで打ち切る (worker を解放する)。
     """
+    token = CancellationToken(max(timeout, _CHAT_RECOVERY_SECONDS))
+
     def _run_generation():
         _bg_sess = Session() if Session is not None else None
         try:
-            return generate_ai_response_safe(
-                user_data, message, history, session=_bg_sess
-            )
+            with cancel_scope(token), llm_usage_scope('chat', user_uuid):
+                return generate_ai_response_safe(
+                    user_data, message, history, session=_bg_sess
+                )
         finally:
             if _bg_sess is not None:
                 try:
@@ -6298,18 +10671,31 @@ def _generate_with_timeout(
                     pass
     future = background_executor.submit(_run_generation)
     try:
-        return future.result(timeout=timeout)
+        result = future.result(timeout=timeout)
+        generation_accounting.note('on_time')
+        return result
 
     except _cf.TimeoutError:
         logger.warning(
             f"⏱️ AI応答タイムアウト ({timeout}s) "
             f"user={user_uuid}: {message[:30]}"
         )
+        generation_accounting.note('timed_out')
         tid = f"timeout_{user_uuid}_{int(time.time())}"
 
-        def _save_when_done():
+        def _save_when_done(fut):
+            # 生成完了時に worker から呼ばれる (待ち合わせ用に別の worker を塞がない)
+            try:
+                result = fut.result()
+            except GenerationCancelled as c:
+                generation_accounting.note('abandoned', str(c))
+                logger.warning(f"🛑 タイムアウト後の生成を打ち切り ({token.reason} @ {c}) user={user_uuid}")
+                return
+            except Exception as e:
+                generation_accounting.note('failed')
+                logger.error(f"タイムアウト回復エラー: {e}")
+                return
             try:
-                result = future.result(timeout=60)
                 with get_db_session() as s:
                     s.add(BackgroundTask(
                         task_id=tid,
@@ -6320,10 +10706,15 @@ def _generate_with_timeout(
                         status='completed',
                         completed_at=datetime.utcnow()
                     ))
+                generation_accounting.note('recovered')
             except Exception as e:
                 logger.error(f"タイムアウト回復エラー: {e}")
 
-        background_executor.submit(_save_when_done)
+        future.add_done_callback(_save_when_done)
+        return "ごめん、ちょっと考えるのに時間かかってるみたい！少しだけ待ってからもう一度話しかけてみて！"
+
+    except GenerationCancelled as c:
+        generation_accounting.note('abandoned', str(c))
         return "ごめん、ちょっと考えるのに時間かかってるみたい！少しだけ待ってからもう一度話しかけてみて！"
 
     except Exception as e:
@@ -6372,7 +10763,7 @@ def fetch_google_news_rss(query: str = "") -> List[Dict]:
 
     try:
         headers = {'User-Agent': random.choice(USER_AGENTS), 'Accept': 'application/rss+xml, application/xml, text/xml'}
-        res = requests.get(url, headers=headers, timeout=SEARCH_TIMEOUT)
+        res = http_get(url, headers=headers, timeout=SEARCH_TIMEOUT)
         if res.status_code != 200: return []
         soup = BeautifulSoup(res.content, 'xml')
         items = soup.find_all('item')[:5]
@@ -6391,7 +10782,7 @@ def scrape_yahoo_search(query: str, num: int = 3) -> List[Dict]:
         url = "https://search.yahoo.co.jp/search"
         params = {'p': query, 'ei': 'UTF-8'}
         headers = {'User-Agent': random.choice(USER_AGENTS)}
-        res = requests.get(url, params=params, headers=headers, timeout=SEARCH_TIMEOUT)
+        res = http_get(url, params=params, headers=headers, timeout=SEARCH_TIMEOUT)
         if res.status_code != 200: return []
         soup = BeautifulSoup(res.content, 'html.parser')
         results = []
@@ -6414,7 +10805,7 @@ def scrape_bing_search(query: str, num: int = 3) -> List[Dict]:
         url = "https://www.bing.com/search"
         params = {'q': query}
         headers = {'User-Agent': random.choice(USER_AGENTS)}
-        res = requests.get(url, params=params, headers=headers, timeout=SEARCH_TIMEOUT)
+        res = http_get(url, params=params, headers=headers, timeout=SEARCH_TIMEOUT)
         if res.status_code != 200: return []
         soup = BeautifulSoup(res.content, 'html.parser')
         results = []
@@ -6435,7 +10826,7 @@ def scrape_duckduckgo_lite(query: str, num: int = 3) -> List[Dict]:
         url = "https://lite.duckduckgo.com/lite/"
         data = {'q': query}
         headers = {'User-Agent': random.choice(USER_AGENTS), 'Referer': 'https://lite.duckduckgo.com/', 'Content-Type': 'application/x-www-form-urlencoded'}
-        res = requests.post(url, data=data, headers=headers, timeout=SEARCH_TIMEOUT)
+        res = http_post(url, data=data, headers=headers, timeout=SEARCH_TIMEOUT)
         if res.status_code != 200: return []
         soup = BeautifulSoup(res.content, 'html.parser')
         results = []
@@ -6449,6 +10840,7 @@ def scrape_duckduckgo_lite(query: str, num: int = 3) -> List[Dict]:
         return results
     except: return []
 
+@single_flight()
 def scrape_major_search_engines(query: str, num: int = 3) -> List[Dict]:
     logger.info(f"🔎 検索開始: '{query}'")
     
@@ -6732,7 +11124,7 @@ def _generate_one_phrase(phrase: str, user_uuid: str, idx: int) -> Optional[str]
             "pitch":           0.05,
             "intonationScale": 1.5,
         }
-        res = requests.get(api_url, params=params, timeout=30)
+        res = http_get(api_url, params=params, timeout=30)
         if res.status_code != 200:
             logger.error(f"❌ su-shiki失敗[{idx}]: HTTP{res.status_code}")
             return None
@@ -7067,6 +11459,21 @@ def health_check_detail():
         'is_idle': conversation_activity.is_idle(),
         'seconds_since_last_chat': conversation_activity.seconds_since_last_chat() if conversation_activity.seconds_since_last_chat() != float('inf') else None,
         'deferred_queue_size': deferred_queue.size(),
+        'deferred_queue': deferred_queue.get_stats(),
+        'embedding_cache': embedding_cache.get_stats(),
+        'embedding_backends': [
+            {'name': b.name, 'available': b.is_available()} for b in get_embedding_backends()
+        ],
+        'memvid_index': memvid_vector_index.get_stats() if HAS_NUMPY else None,
+        'llm_quota': llm_quota.get_stats(),
+        'llm_dispatch': llm_dispatcher.get_stats(),
+        'llm_health': llm_health.get_stats(),
+        'prompt_cache': prompt_prefix_cache.get_stats(),
+        'transport': transport.get_stats(),
+        'generation': generation_accounting.get_stats(),
+        'single_flight': single_flight_group.get_stats(),
+        'http_clients': http_clients.get_stats(),
+        'llm_usage': llm_usage.get_stats(),
     })
 
 def check_wake_auth() -> bool:
@@ -7150,6 +11557,7 @@ def admin_idle_status():
         'idle_threshold_seconds': CONVERSATION_IDLE_THRESHOLD,
         'never_skip_tasks': sorted(NEVER_SKIP_TASKS),
         'deferred_queue_size': deferred_queue.size(),
+        'deferred_queue_stats': deferred_queue.get_stats(),
         'deferred_queue': deferred_queue.get_status(),
         'note': 'is_idle=True ならバックタスクが実行可能、Falseなら会話中扱いでスキップ',
     })
@@ -7390,15 +11798,7 @@ def chat_lsl():
                         ai_text = f"{nickname_input}ね！了解！これからそう呼ぶね😊💖 よろしく！"
                         is_task_started = False
 
-            try:
-                with engine.connect() as _ch_conn:
-                    with _ch_conn.begin():
-                        _ch_conn.execute(text(
-                            "INSERT INTO conversation_history (user_uuid, role, content, timestamp) "
-                            "VALUES (:uuid, :role, :content, :ts)"
-                        ), {"uuid": user_uuid, "role": "user", "content": message, "ts": datetime.utcnow()})
-            except Exception as _ch_err1:
-                logger.warning(f"conversation_history user INSERT失敗: {str(_ch_err1)[:80]}")
+            save_conversation_message(user_uuid, 'user', message)
 
             # ★ Memvid: ユーザー発言をバックグラウンドでインデックス化
             if len(message) >= 20:
@@ -7413,7 +11813,8 @@ def chat_lsl():
                 correction = detect_correction_intent(message)
                 if correction:
                     logger.info(f"🎓 指摘検出: {correction}")
-                    task_executor.submit(process_correction_learning, user_uuid, message, correction)
+                    task_executor.submit(llm_usage_tagged(process_correction_learning, 'correction_learning', user_uuid),
+                                         user_uuid, message, correction)
             except Exception as learn_err:
                 logger.debug(f"自動学習トリガーエラー: {learn_err}")
 
@@ -7425,10 +11826,10 @@ def chat_lsl():
                 def _idle_mem_tasks(_uuid=_emb_uuid, _name=_emb_name):
                     if not conversation_activity.is_idle():
                         return
-                    embed_new_history_bg(_uuid)
+                    embed_history_backlog()
                     with get_db_session() as _s:
                         build_conversation_summary_bg(_s, _uuid, _name)
-                task_executor.submit(_idle_mem_tasks)
+                task_executor.submit(llm_usage_tagged(_idle_mem_tasks, 'conversation_summary', user_uuid))
 
 
            
@@ -7475,7 +11876,8 @@ def chat_lsl():
                     query=json.dumps(specialized_qdata, ensure_ascii=False)
                 ))
                 # ★ v33.16: 検索は search_executor に移動
-                search_executor.submit(background_specialized_search, tid, specialized_qdata)
+                search_executor.submit(llm_usage_tagged(background_specialized_search, 'specialized_search', user_uuid),
+                                       tid, specialized_qdata)
                 ai_text = f"{detected_site['name']}の中を調べてくるじゃん！少し待ってて！"
                 is_task_started = True
 
@@ -7496,7 +11898,7 @@ def chat_lsl():
                 }
                 session.add(BackgroundTask(task_id=tid, user_uuid=user_uuid, task_type='search', query=json.dumps(qdata, ensure_ascii=False)))
                 # ★ v33.16: 検索は search_executor に移動
-                search_executor.submit(background_deep_search, tid, qdata)
+                search_executor.submit(llm_usage_tagged(background_deep_search, 'search', user_uuid), tid, qdata)
                 ai_text = "オッケー！ちょっとググってくるから待ってて！"
                 is_task_started = True
 
@@ -7523,15 +11925,7 @@ def chat_lsl():
                 ai_text = _generate_with_timeout(user_data, message, history, session, user_uuid)
             
             if not is_task_started:
-                try:
-                    with engine.connect() as _ch_conn2:
-                        with _ch_conn2.begin():
-                            _ch_conn2.execute(text(
-                                "INSERT INTO conversation_history (user_uuid, role, content, timestamp) "
-                                "VALUES (:uuid, :role, :content, :ts)"
-                            ), {"uuid": user_uuid, "role": "assistant", "content": ai_text, "ts": datetime.utcnow()})
-                except Exception as _ch_err2:
-                    logger.warning(f"conversation_history assistant INSERT失敗: {str(_ch_err2)[:80]}")
+                save_conversation_message(user_uuid, 'assistant', ai_text)
 
         # v33.22: SL表示・TTS・音声生成の完全分離
         # voice_text : パイプ除去済みフルテキスト（絵文字付き）
@@ -7615,15 +12009,7 @@ def check_task_endpoint():
                 res = task.result or ""
                 try:
                     session.delete(task)
-                    try:
-                        with engine.connect() as _ch_conn3:
-                            with _ch_conn3.begin():
-                                _ch_conn3.execute(text(
-                                    "INSERT INTO conversation_history (user_uuid, role, content, timestamp) "
-                                    "VALUES (:uuid, :role, :content, :ts)"
-                                ), {"uuid": data['uuid'], "role": "assistant", "content": res, "ts": datetime.utcnow()})
-                    except Exception as _ch_err3:
-                        logger.warning(f"conversation_history check_task INSERT失敗: {str(_ch_err3)[:80]}")
+                    save_conversation_message(data['uuid'], 'assistant', res)
                 except Exception as _ct_err:
                     logger.warning(f"⚠️ check_task DB操作スキップ: {_ct_err}")
                     try:
@@ -7749,6 +12135,7 @@ def admin_mochiko_self_create():
             else:
                 session.add(MochikoSelf(key=key, value=value, category=category))
                 msg = f'新規追加: {key}'
+        prompt_prefix_cache.invalidate()
         return create_json_response({'success': True, 'message': msg})
     except Exception as e:
         return create_json_response({'error': str(e)}, 500)
@@ -7766,6 +12153,7 @@ def admin_mochiko_self_update(key: str):
                 return create_json_response({'error': f'key {key} not found'}, 404)
             if request.method == 'DELETE':
                 session.delete(entry)
+                prompt_prefix_cache.invalidate()
                 return create_json_response({'success': True, 'message': f'削除: {key}'})
             data = request.json or {}
             if 'value' in data:
@@ -7773,6 +12161,7 @@ def admin_mochiko_self_update(key: str):
             if 'category' in data:
                 entry.category = (data['category'] or 'other').strip()[:50]
             entry.last_updated = datetime.utcnow()
+            prompt_prefix_cache.invalidate()
             return create_json_response({'success': True, 'message': f'更新: {key}'})
     except Exception as e:
         return create_json_response({'error': str(e)}, 500)
@@ -8033,6 +12422,212 @@ def get_database_stats():
         'note': '感想は300文字、要約は400文字で解像度を保持'
     })
 
+@app.route('/admin/memvid/benchmark', methods=['GET'])
+def memvid_benchmark():
+    """int8量子化の recall / メモリ比較 (?source=db で実データ、?n= で件数 (上限 MEMVID_BENCHMARK_MAX_ROWS))"""
+    if not check_wake_auth():
+        return create_json_response({'error': 'Unauthorized'}, 401)
+    if not HAS_NUMPY:
+        return create_json_response({'error': 'numpy が必要です'}, 400)
+    try:
+        n = min(int(request.args.get('n', MEMVID_BENCHMARK_MAX_ROWS)), MEMVID_BENCHMARK_MAX_ROWS)
+        top_k = min(int(request.args.get('top_k', 5)), MEMVID_BENCHMARK_MAX_TOP_K)
+    except ValueError:
+        return create_json_response({'error': 'n / top_k は整数で指定してください'}, 400)
+    return create_json_response(benchmark_vector_quantization(
+        n=n, top_k=top_k, source=request.args.get('source', 'synthetic')
+    ))
+
+# 記録/再生トランスポートと組み合わせて、/chat_lsl の全経路をネットワーク無しで負荷試験する
+# 本番DBに書くので、ユーザーは bench- で始まる固定プールを使い回し、終了後に全テーブルから消す。
+# 1ユーザーあたりのリクエスト数が chat_rate_limiter (10回/分) に収まるよう、プールは
+# CHAT_BENCHMARK_MAX_REQUESTS / 10 人にしている。
+CHAT_BENCHMARK_MESSAGES = [
+    'こんにちは！', '最近のホロライブのニュース教えて', '今日配信ある？', 'ぺこらってどんな子？',
+    'おすすめのアニメある？', 'セカンドライフで楽しい場所ある？', '眠いー', 'マイクラの話しよ',
+]
+CHAT_BENCHMARK_MAX_REQUESTS = 2000
+CHAT_BENCHMARK_USER_PREFIX = 'bench-'
+CHAT_BENCHMARK_USER_POOL = 200
+CHAT_BENCHMARK_PURGE_DELAY_SECONDS = 60   # 応答後のバックグラウンド処理 (要約・索引等) が書き終わるのを待って再度消す
+
+
+def purge_benchmark_data(prefix: str = CHAT_BENCHMARK_USER_PREFIX) -> Dict[str, int]:
+    """user_uuid が prefix で始まる行を全テーブルから削除する。戻り値: {テーブル名: 件数}"""
+    tables = [t.name for t in reversed(Base.metadata.sorted_tables) if 'user_uuid' in t.c]
+    if _conv_search_mode == 'bigram_table':
+        tables.append('conversation_bigrams')
+    deleted: Dict[str, int] = {}
+    with engine.connect() as conn:
+        with conn.begin():
+            for name in tables:
+                n = conn.execute(text(f"DELETE FROM {name} WHERE user_uuid LIKE :p"), {"p": prefix + '%'}).rowcount
+                if n:
+                    deleted[name] = n
+    chat_rate_limiter.forget(prefix)
+    if deleted.get('memvid_embeddings'):
+        memvid_vector_index.mark_dirty()
+    if deleted:
+        logger.info(f"🧹 ベンチマークデータ削除: {deleted}")
+    return deleted
+
+
+def run_chat_benchmark(n_requests: int = 40, concurrency: int = 4,
+                       messages: Optional[List[str]] = None) -> Dict[str, Any]:
+    """/chat_lsl を並列に叩いてスループットとレイテンシ分布を測る (ユーザーは固定プールを順に使う)"""
+    msgs = messages or CHAT_BENCHMARK_MESSAGES
+    n_requests = min(n_requests, CHAT_BENCHMARK_MAX_REQUESTS)
+    client = app.test_client()
+
+    def one(i: int) -> Tuple[float, int]:
+        slot = i % CHAT_BENCHMARK_USER_POOL
+        started = time.perf_counter()
+        res = client.post('/chat_lsl', json={
+            'uuid': f"{CHAT_BENCHMARK_USER_PREFIX}{slot:03d}", 'name': f"ベンチ{slot}", 'message': msgs[i % len(msgs)],
+        })
+        return time.perf_counter() - started, res.status_code
+
+    wall_started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(n_requests)))
+    wall = time.perf_counter() - wall_started
+
+    latencies = sorted(r[0] for r in results)
+
+    def pct(q: float) -> float:
+        return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 1) if latencies else 0.0
+
+    return {
+        'requests': n_requests,
+        'concurrency': concurrency,
+        'wall_sec': round(wall, 2),
+        'throughput_rps': round(n_requests / wall, 2) if wall > 0 else None,
+        'latency_ms': {'p50': pct(0.5), 'p90': pct(0.9), 'p99': pct(0.99), 'max': pct(1.0)},
+        'status': dict(Counter(r[1] for r in results)),
+        'transport': transport.get_stats(),
+    }
+
+
+class ChatBenchmarkRunner:
+    """
+    チャット負荷試験をバックグラウンドで1本ずつ実行し、結果をポーリングで返す
+    (数千リクエストを同期で処理すると gunicorn のタイムアウトを超えるため)。
+    status: running → purging (後片付けの待ち) → done / error
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._job: Optional[Dict[str, Any]] = None
+
+    def start(self, n_requests: int, concurrency: int,
+              messages: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        """開始したジョブを返す。実行中のジョブがあれば None"""
+        with self._lock:
+            if self._job and self._job['status'] in ('running', 'purging'):
+                return None
+            job = {
+                'id': uuid.uuid4().hex[:12], 'status': 'running',
+                'requests': n_requests, 'concurrency': concurrency,
+                'started_at': datetime.utcnow().isoformat(), 'finished_at': None,
+                'result': None, 'purged': {}, 'error': None,
+            }
+            self._job = job
+        background_executor.submit(self._run, job, n_requests, concurrency, messages)
+        return dict(job)
+
+    def _run(self, job: Dict[str, Any], n_requests: int, concurrency: int, messages: Optional[List[str]]):
+        purged: Counter = Counter()
+        try:
+            purged.update(purge_benchmark_data())   # 前回中断した分の残り
+            result = run_chat_benchmark(n_requests, concurrency, messages)
+            with self._lock:
+                job['result'] = result
+                job['status'] = 'purging'
+            purged.update(purge_benchmark_data())
+            time.sleep(CHAT_BENCHMARK_PURGE_DELAY_SECONDS)
+            purged.update(purge_benchmark_data())
+            status, error = 'done', None
+        except Exception as e:
+            logger.error(f"チャット負荷試験エラー: {e}")
+            status, error = 'error', str(e)[:300]
+        with self._lock:
+            job['status'] = status
+            job['error'] = error
+            job['purged'] = dict(purged)
+            job['finished_at'] = datetime.utcnow().isoformat()
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if self._job is None or self._job['id'] != job_id:
+                return None
+            return dict(self._job)
+
+
+chat_benchmark_runner = ChatBenchmarkRunner()
+
+
+@app.route('/admin/benchmark/chat', methods=['POST'])
+def chat_benchmark():
+    """
+    チャット負荷試験を開始する (?n=&concurrency=)。すぐに 202 とジョブidを返すので
+    GET /admin/benchmark/chat/<job_id> で結果を取る。実APIを消費するため live モードでは ?allow_live=true が必要
+    """
+    if not check_wake_auth():
+        return create_json_response({'error': 'Unauthorized'}, 401)
+    if not transport.replaying and request.args.get('allow_live') != 'true':
+        return create_json_response({'error': 'TRANSPORT_MODE=replay で起動してください (live は ?allow_live=true)'}, 400)
+    try:
+        n = min(int(request.args.get('n', 40)), CHAT_BENCHMARK_MAX_REQUESTS)
+        concurrency = min(int(request.args.get('concurrency', 4)), 64)
+    except ValueError:
+        return create_json_response({'error': 'n / concurrency は整数で指定してください'}, 400)
+    messages = (request.json or {}).get('messages') if request.is_json else None
+    job = chat_benchmark_runner.start(n, concurrency, messages)
+    if job is None:
+        return create_json_response({'error': '別の負荷試験が実行中です'}, 409)
+    return create_json_response(job, 202)
+
+
+@app.route('/admin/benchmark/chat/<job_id>', methods=['GET'])
+def chat_benchmark_status(job_id: str):
+    """負荷試験ジョブの状態と結果"""
+    if not check_wake_auth():
+        return create_json_response({'error': 'Unauthorized'}, 401)
+    job = chat_benchmark_runner.get(job_id)
+    if job is None:
+        return create_json_response({'error': 'Job not found'}, 404)
+    return create_json_response(job)
+
+@app.route('/admin/prompt_cache/check', methods=['GET'])
+def admin_prompt_cache_check():
+    """偽プロバイダで PromptPrefixCache の作成・延長回数を確かめる (check_prompt_prefix_cache)"""
+    if not check_wake_auth():
+        return create_json_response({'error': 'Unauthorized'}, 401)
+    return create_json_response(check_prompt_prefix_cache())
+
+
+@app.route('/admin/llm_usage', methods=['GET'])
+def admin_llm_usage():
+    """LLM 使用量の集計 (?hours=24&group=feature|user|model|feature_user&limit=50)"""
+    if not check_wake_auth():
+        return create_json_response({'error': 'Unauthorized'}, 401)
+    try:
+        hours = float(request.args.get('hours', LLM_USAGE_DEFAULT_HOURS))
+        limit = min(int(request.args.get('limit', 50)), 500)
+    except ValueError:
+        return create_json_response({'error': 'hours / limit は数値で指定してください'}, 400)
+    group = request.args.get('group', 'feature')
+    try:
+        rows = llm_usage.report(hours, group, limit)
+    except ValueError as e:
+        return create_json_response({'error': str(e)}, 400)
+    return create_json_response({
+        'hours': hours,
+        'group': group,
+        'rows': rows,
+        'stats': llm_usage.get_stats(),
+    })
+
 @app.route('/admin/database/cleanup', methods=['POST'])
 def manual_cleanup():
     """手動でクリーンアップを実行"""
@@ -8477,6 +13072,73 @@ def check_and_migrate_db():
                     except Exception as e2:
                         logger.warning(f"⚠️ task_logs.{col_name} 追加スキップ: {e2}")
 
+            # ★ Embeddingバックエンドのタグ列 (異なるベクトル空間を混ぜないため)
+            for tbl_eb in ['memvid_embeddings', 'conversation_embeddings']:
+                try:
+                    t_eb = conn.begin()
+                    conn.execute(text(f"SELECT embedding_backend FROM {tbl_eb} LIMIT 1"))
+                    t_eb.commit()
+                except Exception:
+                    try: t_eb.rollback()
+                    except: pass
+                    try:
+                        with conn.begin() as t_eb2:
+                            conn.execute(text(f"ALTER TABLE {tbl_eb} ADD COLUMN embedding_backend VARCHAR(80)"))
+                        logger.info(f"✅ {tbl_eb}.embedding_backend カラム追加")
+                    except Exception as e_eb:
+                        logger.warning(f"⚠️ {tbl_eb}.embedding_backend 追加スキップ: {e_eb}")
+
+            # ★ conversation_summaries の階層要約カラム (level / ウォーターマーク)
+            for col_cs, type_cs in [
+                ('level', "VARCHAR(20) DEFAULT 'recent'"),
+                ('covered_until_id', 'INTEGER'),
+                ('updated_at', 'TIMESTAMP'),
+            ]:
+                try:
+                    t_cs = conn.begin()
+                    conn.execute(text(f"SELECT {col_cs} FROM conversation_summaries LIMIT 1"))
+                    t_cs.commit()
+                except Exception:
+                    try: t_cs.rollback()
+                    except: pass
+                    try:
+                        with conn.begin() as t_cs2:
+                            conn.execute(text(f"ALTER TABLE conversation_summaries ADD COLUMN {col_cs} {type_cs}"))
+                        logger.info(f"✅ conversation_summaries.{col_cs} カラム追加")
+                    except Exception as e_cs:
+                        logger.warning(f"⚠️ conversation_summaries.{col_cs} 追加スキップ: {e_cs}")
+
+            # ★ conversation_embeddings の再試行カラム (埋め込み失敗行をあとでやり直す)
+            for col_ce, type_ce in [('embed_attempts', 'INTEGER DEFAULT 1'), ('attempted_at', 'TIMESTAMP')]:
+                try:
+                    t_ce = conn.begin()
+                    conn.execute(text(f"SELECT {col_ce} FROM conversation_embeddings LIMIT 1"))
+                    t_ce.commit()
+                except Exception:
+                    try: t_ce.rollback()
+                    except: pass
+                    try:
+                        with conn.begin() as t_ce2:
+                            conn.execute(text(f"ALTER TABLE conversation_embeddings ADD COLUMN {col_ce} {type_ce}"))
+                        logger.info(f"✅ conversation_embeddings.{col_ce} カラム追加")
+                    except Exception as e_ce:
+                        logger.warning(f"⚠️ conversation_embeddings.{col_ce} 追加スキップ: {e_ce}")
+
+            # ★ memvid_embeddings.content_hash (差分インデックス用)
+            try:
+                t_ch = conn.begin()
+                conn.execute(text("SELECT content_hash FROM memvid_embeddings LIMIT 1"))
+                t_ch.commit()
+            except Exception:
+                try: t_ch.rollback()
+                except: pass
+                try:
+                    with conn.begin() as t_ch2:
+                        conn.execute(text("ALTER TABLE memvid_embeddings ADD COLUMN content_hash VARCHAR(64)"))
+                    logger.info("✅ memvid_embeddings.content_hash カラム追加")
+                except Exception as e_ch:
+                    logger.warning(f"⚠️ memvid_embeddings.content_hash 追加スキップ: {e_ch}")
+
             # ★ v33.4.0: FriendProfile / UserInterestLog は Base.metadata.create_all で自動作成されるが
             # 念のため存在確認ログを出す
             try:
@@ -8549,7 +13211,8 @@ def fix_postgres_sequences(quiet: bool = False):
         # ★ 修正: 漏れていた6テーブルを追加（DB再作成時のNULL identity key対策）
         'conversation_embeddings', 'conversation_summaries',
         'holomem_pronunciations', 'mochiko_self',
-        'learning_log', 'memvid_embeddings',
+        'learning_log', 'memvid_embeddings', 'embedding_backend_state',
+        'deferred_tasks', 'llm_usage_rollups',
         # task_logs は primary key=task_name(VARCHAR) なので除外
     ]
 
@@ -9003,6 +13666,7 @@ def initialize_app():
         repair_missing_id_sequences()
         reconcile_column_types()
         fix_hololive_news_constraints()
+        setup_conversation_search_index()
         
         Session = sessionmaker(bind=engine)
         
@@ -9010,13 +13674,24 @@ def initialize_app():
         initialize_mochiko_self()  # ★ v33.15-stable2: もちこ自己認識データ初期化
         knowledge_base.load_data()
         
+        # ローカルEmbeddingは保存済みIDFを読むだけ (未学習なら定期タスクが学習する)
+        if local_embedding_backend is not None:
+            local_embedding_backend.load_idf()
+
+        # Memvid索引: スナップショットで即座に検索可能にし、差分はバックグラウンドで取り込む
+        if HAS_NUMPY:
+            memvid_vector_index.load_snapshot()
+            background_executor.submit(memvid_vector_index.refresh, True)
+        # ハイブリッド検索の知識インデックスも最初のチャットを待たずに温める
+        background_executor.submit(hybrid_retriever.refresh_knowledge, True)
+        
         logger.info("✅ DB初期化完了")
     except Exception as e:
         logger.critical(f"🔥 DB初期化失敗: {e}")
     
     try:
         if GROQ_API_KEY:
-            groq_client = Groq(api_key=GROQ_API_KEY)
+            groq_client = QuotaGuardedGroq(Groq(api_key=GROQ_API_KEY))
             logger.info("✅ Groq初期化完了")
     except: pass
     
@@ -9070,6 +13745,10 @@ def initialize_app():
         # ★ Memvid RAGタスク
         'memvid_build_index': memvid_rag.build_knowledge_index,
         'memvid_cleanup':     memvid_rag.cleanup_old_embeddings,
+        'memvid_snapshot':    memvid_vector_index.save_snapshot,
+        'embed_history':      embed_history_backlog,
+        'local_embeddings':   maintain_local_embeddings,
+        'flush_llm_usage':    llm_usage.flush,
     })
 
     # ★ v33.11 変更: 起動時に Gemini API を使う処理をすぐに走らせない